@@ -1,6 +1,7 @@
 """競馬情報のフェッチ."""
 
 import logging
+from datetime import datetime, timezone
 
 import dateutil.parser
 from aws_xray_sdk.core import patch_all
@@ -17,14 +18,85 @@ logger.setLevel(logging.INFO)
 def lambda_handler(event, context):
     """Lambda handler.
 
+    イベントの 'profile' または環境変数PROFILEが有効なら、起動全体を計測して
+    結果をバケットのPROFILE_PREFIX以下 (起動毎のプレフィックス) に保存する。
+
     Arguments:
         event {dict} -- Event data
         context {object} -- Lambda Context runtime methods and attributes
 
     """
-    del context
+    if 'time' in event:
+        logger.info('start: event.time=%s', event["time"])
+        nowtime = dateutil.parser.parse(event['time'])
+    else:
+        nowtime = datetime.now(timezone.utc)
+
+    logic.use_disk_cache(settings.DISK_CACHE_DIR, settings.DISK_CACHE_BYTES)
+
+    profiler = logic.use_profiler(
+        bool(event.get('profile')) or settings.PROFILE,
+        settings.PROFILE_SNAPSHOTS)
+    prefix = (
+        f'{settings.PROFILE_PREFIX}{nowtime:%Y%m%d%H%M%S}-'
+        f'{getattr(context, "aws_request_id", "local")}/')
+    with profiler.run(settings.BUCKET_NAME, prefix):
+        return handle(event, context, nowtime)
+
+
+def handle(event, context, nowtime):
+    """イベントを処理する.
+
+    イベントの種類によって動作を切り替える。
+    - SQSイベントソース ('Records'あり): 渡されたメッセージを処理するワーカー
+    - mode=worker: 指定シャードのリースを取得して処理するワーカー
+    - シャード数が2以上: カレンダー登録とワーカー起動を行うコーディネーター
+    - SQSイベントソースが有効: カレンダー登録のみ (キューはイベントソースが処理する)
+    - それ以外: 単一キューを処理する
+
+    Arguments:
+        event {dict} -- Event data
+        context {object} -- Lambda Context runtime methods and attributes
+        nowtime {datetime} -- 開始時刻
+
+    Returns:
+        object -- Lambdaの応答
+    """
+    if 'Records' in event:
+        return logic.process_records(
+            event['Records'], settings.QUEUE_NAME, settings.BUCKET_NAME,
+            nowtime, shard_count=settings.SHARD_COUNT,
+            partition=settings.PARTITION,
+            dead_letter_queue_name=settings.DEAD_LETTER_QUEUE_NAME)
+
+    if event.get('mode') == 'worker':
+        logic.work_shard(
+            settings.QUEUE_NAME, settings.BUCKET_NAME, nowtime,
+            event['shard'], engine=settings.ENGINE,
+            shard_count=settings.SHARD_COUNT,
+            partition=settings.PARTITION,
+            dead_letter_queue_name=settings.DEAD_LETTER_QUEUE_NAME,
+            journal=settings.CRAWL_JOURNAL)
+    elif settings.SHARD_COUNT > 1:
+        logic.coordinate(
+            settings.QUEUE_NAME, nowtime, context.function_name,
+            settings.SHARD_COUNT,
+            seed_queue_names=settings.SEED_QUEUE_NAMES,
+            days_back=settings.CALENDAR_DAYS_BACK,
+            days_forward=settings.CALENDAR_DAYS_FORWARD)
+    elif settings.USE_EVENT_SOURCE:
+        # 同じキューをmain_loopでも受信するとイベントソースと取り合いになる
+        logic.add_calendar_if_idle(
+            settings.SEED_QUEUE_NAMES or [settings.QUEUE_NAME], nowtime,
+            settings.CALENDAR_DAYS_BACK, settings.CALENDAR_DAYS_FORWARD)
+    else:
+        logic.entry(
+            settings.QUEUE_NAME, settings.BUCKET_NAME, nowtime,
+            engine=settings.ENGINE,
+            seed_queue_names=settings.SEED_QUEUE_NAMES,
+            days_back=settings.CALENDAR_DAYS_BACK,
+            days_forward=settings.CALENDAR_DAYS_FORWARD,
+            dead_letter_queue_name=settings.DEAD_LETTER_QUEUE_NAME,
+            journal=settings.CRAWL_JOURNAL)
 
-    logger.info('start: event.time=%s', event["time"])
-    nowtime = dateutil.parser.parse(event['time'])
-    logic.entry(settings.QUEUE_NAME, settings.BUCKET_NAME, nowtime)
     return "OK"
@@ -1,126 +1,2867 @@
 """競馬コンテンツフェッチ処理のロジック部."""
 from abc import ABCMeta, abstractmethod
+import asyncio
+import cProfile
+import hashlib
 import json
 import logging
+import marshal
+import mmap
+import os
+import pstats
 import re
+import sys
+import tempfile
+import threading
 import time
+import tracemalloc
+import uuid
+import zlib
+from collections import OrderedDict, deque, namedtuple
+from contextlib import AsyncExitStack, asynccontextmanager, contextmanager
 from datetime import datetime, timedelta, timezone
 from urllib.parse import parse_qs, urljoin, urlparse
 
 import boto3
 import requests
-from bs4 import BeautifulSoup
+from botocore.exceptions import ClientError
 from dateutil.relativedelta import relativedelta
-from more_itertools import chunked
+from lxml import etree
+from more_itertools import constrained_batches
+
+try:
+    import aiohttp
+    from aiobotocore.session import get_session
+except ImportError:
+    # 非同期エンジン (engine='async') を使わない場合は不要
+    aiohttp = None
+    get_session = None
 
 logger = logging.getLogger()
 
+# SQSメッセージ1件 (および送信バッチ1回) あたりの最大サイズ
+MAX_MESSAGE_SIZE = 256 * 1024
+# SQSメッセージ1件あたりの最大タスク数
+# (アクセス間隔1秒ならMESSAGE_SECONDS以内に処理し終える件数にする。
+# 上流サイトが不調で間に合わない分は期限で打ち切って再登録する)
+MAX_TASKS_PER_MESSAGE = 20
+# 一時的な失敗を再試行するときの遅延秒数の基準値 (試行毎に倍にする)
+RETRY_BASE_SECONDS = 30
+# 再試行の遅延秒数の上限 (SQSのDelaySecondsの上限)
+MAX_RETRY_DELAY_SECONDS = 15 * 60
+# 同一URIの最大試行回数
+MAX_ATTEMPTS = 5
+# 処理結果の登録に失敗したときに登録し直す回数
+SEND_ATTEMPTS = 2
+# シャードのリース期間 (Lambdaのタイムアウトより長くする)
+LEASE_SECONDS = 15 * 60
+# 同一ホストへのアクセス間隔秒数
+ACCESS_INTERVAL_SECONDS = 1
+# 1回の起動でメッセージを受信する秒数
+RUN_SECONDS = 10 * 60
+# 非同期エンジンで受信終了後に処理中のメッセージを待つ秒数
+DRAIN_SECONDS = 2 * 60
+# 非同期エンジンで処理中のメッセージに設定する可視性タイムアウト秒数
+# (受信時に設定し、この半分の間隔で延長し続ける。キューの既定値が短くても
+# アクセス待ちの間に再配信されないようにする)
+VISIBILITY_TIMEOUT_SECONDS = 2 * 60
+# タスク1件の最悪の処理秒数
+# (HTTPタイムアウトの上限10秒 + 上流サイト不調時の待ちの上限30秒 + S3への保存)
+MAX_TASK_SECONDS = 45
+# 同期エンジンでメッセージ1件を処理する期限秒数
+# (期限直前に始めたタスクと結果の登録を含めて可視性タイムアウト内に収める。
+# 同じバッチで受信した残りのメッセージは1件毎に可視性タイムアウトを延長する)
+MESSAGE_SECONDS = VISIBILITY_TIMEOUT_SECONDS - MAX_TASK_SECONDS - 15
+# 非同期エンジンでアクセス待ちがこの秒数分たまったら受信を控える
+INTAKE_SECONDS = 30
+# HTTPの本文を読み込む単位
+STREAM_CHUNK_SIZE = 64 * 1024
+# S3マルチパートアップロードのパートの最小サイズ (最後のパート以外)
+MIN_PART_SIZE = 5 * 1024 * 1024
+# 解析対象の表
+DATA_TABLE = (
+    '//table[contains(concat(" ", normalize-space(@class), " "),'
+    ' " tbl-data-04 ")]')
+# JBISの日付 (レース日など) のタイムゾーン
+JST = timezone(timedelta(hours=9), 'JST')
+# クロールジャーナルを再生する期間秒数 (これより古いジャーナルは削除する)
+JOURNAL_REPLAY_SECONDS = 2 * 60 * 60
+# クロールジャーナルをS3に書き出す間隔秒数
+JOURNAL_FLUSH_SECONDS = 10
+# クロールジャーナルのローカルファイルの保存先
+JOURNAL_DIR = os.path.join(tempfile.gettempdir(), 'keiba-fetcher-journal')
+
+
+class FetchError(Exception):
+    """フェッチ失敗の基底例外."""
+
+    category = 'transient'
+
+
+class TransientFetchError(FetchError):
+    """時間をおけば成功する見込みのあるフェッチ失敗."""
+
+    category = 'transient'
+
+
+class PermanentFetchError(FetchError):
+    """再試行しても成功しないフェッチ失敗."""
+
+    category = 'permanent'
+
+
+class CircuitOpenError(TransientFetchError):
+    """上流サイトのサーキットが開いているためアクセスしなかった."""
+
+
+class ParseError(FetchError):
+    """取得したコンテンツの解析失敗."""
+
+    category = 'parse'
+
+
+def classify_error(error):
+    """例外を失敗の種類に分類する.
+
+    Arguments:
+        error {Exception} -- 例外
+
+    Returns:
+        str -- 'transient', 'permanent', 'parse' のいずれか
+    """
+    if isinstance(error, FetchError):
+        return error.category
+
+    if isinstance(error, (
+            IndexError, KeyError, AttributeError, TypeError, ValueError)):
+        return ParseError.category
+
+    # 通信エラー・S3のスロットリングなどは一時的な失敗として扱う
+    return TransientFetchError.category
 
-def entry(queue_name, bucket_name, nowtime):
+
+def entry(queue_name, bucket_name, nowtime, engine='sync', **options):
     """ロジックのエントリーポイント.
 
     Arguments:
         queue_name {str} -- キュー名
         bucket_name {str} -- バケット名
         nowtime {datetime} -- 開始時刻
+        engine {str} -- 実行エンジン ('sync' または 'async')
+        options {dict} -- main_loop()へのオプション引数
+    """
+    if engine == 'async':
+        asyncio.run(
+            async_main_loop(queue_name, bucket_name, nowtime, **options))
+    else:
+        main_loop(queue_name, bucket_name, nowtime, **options)
+
+
+def coordinate(
+        queue_name, nowtime, function_name, shard_count,
+        seed_queue_names=None, days_back=7, days_forward=7):
+    """コーディネーター処理.
+
+    カレンダーを登録してから、シャード毎のワーカーを非同期起動する。
+
+    Arguments:
+        queue_name {str} -- キュー名 (シャードキュー名の基底)
+        nowtime {datetime} -- 開始時刻
+        function_name {str} -- ワーカーとして起動するLambda関数名
+        shard_count {int} -- シャード数
+        seed_queue_names {list(str)} -- カレンダー登録先キュー名
+        days_back {int} -- カレンダー取得範囲 (過去方向の日数)
+        days_forward {int} -- カレンダー取得範囲 (未来方向の日数)
+    """
+    frontier = Frontier(queue_name, shard_count)
+    seed_queue_names = seed_queue_names or frontier.queue_names
+
+    if all(is_queue_idle(x) for x in seed_queue_names):
+        add_calendar_message(
+            seed_queue_names, nowtime, days_back, days_forward)
+
+    client = boto3.client('lambda')
+    for shard in range(shard_count):
+        payload = {
+            'mode': 'worker', 'shard': shard, 'time': nowtime.isoformat()}
+        client.invoke(
+            FunctionName=function_name, InvocationType='Event',
+            Payload=json.dumps(payload).encode())
+
+
+def work_shard(queue_name, bucket_name, nowtime, shard, **options):
+    """ワーカー処理.
+
+    シャードのリースを取得できた場合のみ、そのシャードのキューを処理する。
+
+    Arguments:
+        queue_name {str} -- キュー名 (シャードキュー名の基底)
+        bucket_name {str} -- バケット名
+        nowtime {datetime} -- 開始時刻
+        shard {int} -- 担当シャード番号
+        options {dict} -- entry()へのオプション引数
     """
-    main_loop(queue_name, bucket_name, nowtime)
+    store = S3LeaseStore(bucket_name)
+    owner = uuid.uuid4().hex
+    lease_name = f'{queue_name}/{shard}'
+
+    if not store.acquire(lease_name, owner, LEASE_SECONDS):
+        logger.info('shard %s is leased by another worker', shard)
+        return
+
+    try:
+        entry(
+            queue_name, bucket_name, nowtime, shard=shard, seed=False,
+            shared_rate_limit=True, **options)
+    finally:
+        store.release(lease_name, owner)
 
 
-def main_loop(queue_name, bucket_name, nowtime):
+def process_records(
+        records, queue_name, bucket_name, nowtime, shard_count=1,
+        partition='uri', dead_letter_queue_name=None):
+    """SQSイベントソースから渡されたレコードを処理する.
+
+    クロールジャーナルは使わない (数件毎の起動それぞれがジャーナルを
+    再生・追加すると、起動回数に対してS3の読み込みが増え続けるため)。
+
+    Arguments:
+        records {list(dict)} -- SQSイベントのレコード
+        queue_name {str} -- キュー名 (シャードキュー名の基底)
+        bucket_name {str} -- バケット名
+        nowtime {datetime} -- 開始時刻
+        shard_count {int} -- シャード数
+        partition {str} -- シャードの分割方法 ('uri' または 'type')
+        dead_letter_queue_name {str} -- デッドレターキュー名
+
+    Returns:
+        dict -- 部分バッチ応答 (処理に失敗したメッセージID)
+    """
+    use_shared_rate_limit(bucket_name)
+    # ウォームスタートで前回の起動のジャーナルが残っていても使わない
+    use_crawl_journal(None, queue_name)
+    frontier = Frontier(
+        queue_name, shard_count, partition, dead_letter_queue_name)
+    deadline = datetime.now(timezone.utc) + timedelta(seconds=RUN_SECONDS)
+    failures = []
+    for x in records:
+        # 成功したメッセージはLambdaが削除する
+        if upstream_health.is_open or not process_message(
+                frontier, x['body'], bucket_name, nowtime, deadline,
+                x['messageId']):
+            failures.append({'itemIdentifier': x['messageId']})
+    return {'batchItemFailures': failures}
+
+
+def main_loop(
+        queue_name, bucket_name, nowtime, seed_queue_names=None,
+        days_back=7, days_forward=7, shard_count=1, shard=0,
+        partition='uri', seed=True, shared_rate_limit=False,
+        dead_letter_queue_name=None, journal=False):
     """メインループ.
 
     Arguments:
-        queue_name {str} -- キュー名
+        queue_name {str} -- キュー名 (シャードキュー名の基底)
         bucket_name {str} -- バケット名
         nowtime {datetime} -- 開始時刻
+        seed_queue_names {list(str)} -- カレンダー登録先キュー名 (省略時は全シャード)
+        days_back {int} -- カレンダー取得範囲 (過去方向の日数)
+        days_forward {int} -- カレンダー取得範囲 (未来方向の日数)
+        shard_count {int} -- シャード数
+        shard {int} -- 受信するシャード番号
+        partition {str} -- シャードの分割方法 ('uri' または 'type')
+        seed {bool} -- カレンダーを登録するかどうか
+        shared_rate_limit {bool} -- 起動間で共有するアクセス間隔制御を使うかどうか
+        dead_letter_queue_name {str} -- デッドレターキュー名
+        journal {bool} -- クロールジャーナルを使うかどうか
     """
-    sqs = boto3.resource('sqs')
-    queue = sqs.get_queue_by_name(QueueName=queue_name)
-    endtime = nowtime + timedelta(seconds=60 * 10)
+    if shared_rate_limit:
+        use_shared_rate_limit(bucket_name)
+
+    frontier = Frontier(
+        queue_name, shard_count, partition, dead_letter_queue_name)
+    queue = frontier.get_queue(shard)
+    use_crawl_journal(
+        bucket_name if journal else None, frontier.get_queue_name(shard))
+    endtime = nowtime + timedelta(seconds=RUN_SECONDS)
+    seed_queue_names = seed_queue_names or frontier.queue_names
 
-    calendar_added = False
+    def add_calendar():
+        add_calendar_message(
+            seed_queue_names, nowtime, days_back, days_forward)
+
+    # 処理中のメッセージが無ければ、受信を待たずにカレンダーを登録する
+    calendar_added = not seed or add_calendar_if_idle(
+        seed_queue_names, nowtime, days_back, days_forward)
 
     while datetime.now(timezone.utc) < endtime:
         msg_list = queue.receive_messages(
-            MaxNumberOfMessages=10, WaitTimeSeconds=1)
+            MaxNumberOfMessages=10, WaitTimeSeconds=1,
+            VisibilityTimeout=VISIBILITY_TIMEOUT_SECONDS)
         if msg_list:
-            for message in msg_list:
-                try:
-                    message_object = json.loads(message.body)
-                    target = message_object['target']
-                    referer = message_object['referer']
-                    uris = fetch(target, referer, bucket_name, nowtime)
-                    if uris is None:
-                        continue
-                    if uris:
-                        uridicts = (
-                            {'target': x, 'referer': target} for x in uris)
-                        messages = (
-                            {'Id': f'{i}', 'MessageBody': json.dumps(x)}
-                            for (i, x) in enumerate(uridicts))
-                        for chunk in chunked(messages, 10):
-                            queue.send_messages(Entries=chunk)
-
+            pending = list(msg_list)
+            while pending:
+                if upstream_health.is_open:
+                    # 上流サイトが不調なので未処理のメッセージを解放して早めに終わる
+                    for x in pending:
+                        x.change_visibility(VisibilityTimeout=0)
+                    break
+                message = pending.pop(0)
+                deadline = min(endtime, datetime.now(timezone.utc) + timedelta(
+                    seconds=MESSAGE_SECONDS))
+                if process_message(
+                        frontier, message.body, bucket_name, nowtime,
+                        deadline, message.message_id):
                     message.delete()
-                except Exception as e:
-                    logger.error(f'Exception occured. {e}')
+                    crawl_journal.get_record(message.message_id).ack()
+                crawl_journal.flush()
+                if pending and not upstream_health.is_open:
+                    pending = extend_visibility(pending)
+
+            if upstream_health.is_open:
+                logger.warning('upstream is unhealthy. stop fetching')
+                break
         elif not calendar_added:
-            add_calendar_message(queue_name, nowtime)
+            add_calendar()
             calendar_added = True
         else:
             break
 
+    crawl_journal.close()
+
+
+def extend_visibility(messages):
+    """受信済みのメッセージの可視性タイムアウトを延長する.
+
+    延長できなかったメッセージは既に再配信されている可能性があるので処理しない。
+
+    Arguments:
+        messages {list(sqs.Message)} -- メッセージ
+
+    Returns:
+        list(sqs.Message) -- 延長できたメッセージ
+    """
+    extended = []
+    for x in messages:
+        try:
+            x.change_visibility(VisibilityTimeout=VISIBILITY_TIMEOUT_SECONDS)
+        except Exception as e:
+            logger.warning(
+                f'failed to extend visibility: {x.message_id} {e}')
+        else:
+            extended.append(x)
+    return extended
+
+
+async def async_main_loop(
+        queue_name, bucket_name, nowtime, seed_queue_names=None,
+        days_back=7, days_forward=7, shard_count=1, shard=0,
+        partition='uri', seed=True, shared_rate_limit=False,
+        dead_letter_queue_name=None, max_in_flight=100, journal=False):
+    """非同期エンジンのメインループ.
+
+    受信したメッセージをそれぞれタスクとして並行に処理する。
+    HTTPアクセスはアクセス間隔制御と上流サイトの状態に応じた並列数で絞り、
+    アクセス待ちがINTAKE_SECONDS分たまったら受信を控える。
+    処理中のメッセージは可視性タイムアウトを延長し続け、受信終了後
+    DRAIN_SECONDS以内に終わらなかったものは中断して解放する。
+
+    Arguments:
+        queue_name {str} -- キュー名 (シャードキュー名の基底)
+        bucket_name {str} -- バケット名
+        nowtime {datetime} -- 開始時刻
+        seed_queue_names {list(str)} -- カレンダー登録先キュー名 (省略時は全シャード)
+        days_back {int} -- カレンダー取得範囲 (過去方向の日数)
+        days_forward {int} -- カレンダー取得範囲 (未来方向の日数)
+        shard_count {int} -- シャード数
+        shard {int} -- 受信するシャード番号
+        partition {str} -- シャードの分割方法 ('uri' または 'type')
+        seed {bool} -- カレンダーを登録するかどうか
+        shared_rate_limit {bool} -- 起動間で共有するアクセス間隔制御を使うかどうか
+        dead_letter_queue_name {str} -- デッドレターキュー名
+        max_in_flight {int} -- 同時に処理するメッセージ数の上限
+        journal {bool} -- クロールジャーナルを使うかどうか
+    """
+    if aiohttp is None:
+        raise RuntimeError('aiohttp and aiobotocore are required')
+
+    if shared_rate_limit:
+        use_shared_rate_limit(bucket_name)
+
+    frontier = Frontier(
+        queue_name, shard_count, partition, dead_letter_queue_name)
+    receive_queue_name = frontier.get_queue_name(shard)
+    endtime = nowtime + timedelta(seconds=RUN_SECONDS)
+    seed_queue_names = seed_queue_names or frontier.queue_names
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(
+        None, use_crawl_journal, bucket_name if journal else None,
+        receive_queue_name)
+
+    def add_calendar():
+        return loop.run_in_executor(
+            None, add_calendar_message, seed_queue_names, nowtime,
+            days_back, days_forward)
+
+    calendar_added = not seed or await loop.run_in_executor(
+        None, add_calendar_if_idle, seed_queue_names, nowtime, days_back,
+        days_forward)
+
+    async with AsyncExitStack() as stack:
+        session = get_session()
+        s3 = await stack.enter_async_context(session.create_client('s3'))
+        sqs = await stack.enter_async_context(session.create_client('sqs'))
+        http = await stack.enter_async_context(aiohttp.ClientSession())
+        aio = AsyncIo(s3, sqs, http)
+        pending = set()
+
+        while datetime.now(timezone.utc) < endtime:
+            if upstream_health.is_open:
+                logger.warning('upstream is unhealthy. stop fetching')
+                break
+
+            if pending and (
+                    len(pending) + 10 > max_in_flight or
+                    aio.backlog_seconds > INTAKE_SECONDS):
+                await asyncio.wait(
+                    pending, timeout=1, return_when=asyncio.FIRST_COMPLETED)
+                continue
+
+            messages = await aio.receive_messages(receive_queue_name)
+            if messages:
+                for message in messages:
+                    task = asyncio.ensure_future(handle_message_async(
+                        frontier, receive_queue_name, message, bucket_name,
+                        nowtime, aio, endtime))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+                # 受信したメッセージの処理を進めてから次の受信を判断する
+                await asyncio.sleep(0)
+            elif pending:
+                await asyncio.wait(
+                    pending, timeout=1, return_when=asyncio.FIRST_COMPLETED)
+            elif not calendar_added:
+                await add_calendar()
+                calendar_added = True
+            else:
+                break
+
+        if pending:
+            await asyncio.wait(pending, timeout=DRAIN_SECONDS)
+
+        unfinished = list(pending)
+        for task in unfinished:
+            task.cancel()
+        if unfinished:
+            await asyncio.wait(unfinished)
+
+    await loop.run_in_executor(None, crawl_journal.close)
 
-def add_calendar_message(queue_name, nowtime):
-    """カレンダー取得メッセージを登録する.
+
+async def keep_message_visible(queue_name, message, aio):
+    """処理中のメッセージの可視性タイムアウトを延長し続ける.
 
     Arguments:
         queue_name {str} -- キュー名
+        message {dict} -- 受信したメッセージ
+        aio {AsyncIo} -- 非同期I/O
+    """
+    try:
+        while True:
+            await asyncio.sleep(VISIBILITY_TIMEOUT_SECONDS / 2)
+            await aio.change_message_visibility(
+                queue_name, message['ReceiptHandle'],
+                VISIBILITY_TIMEOUT_SECONDS)
+    except Exception as e:
+        logger.error(f'Exception occured. {e}')
+
+
+async def handle_message_async(
+        frontier, queue_name, message, bucket_name, nowtime, aio, deadline):
+    """受信したメッセージを処理して削除する.
+
+    処理中は可視性タイムアウトを延長し、中断された場合はすぐに再配信させる。
+
+    Arguments:
+        frontier {Frontier} -- 登録先キュー群
+        queue_name {str} -- 受信したキュー名
+        message {dict} -- 受信したメッセージ
+        bucket_name {str} -- バケット名
         nowtime {datetime} -- 開始時刻
+        aio {AsyncIo} -- 非同期I/O
+        deadline {datetime} -- 処理期限
     """
-    delta = timedelta(days=7)
-    daterange = [nowtime - delta, nowtime + delta]
-    rangeyearmonth = {(x.year, x.month) for x in daterange}
-    urlbase = 'https://www.jbis.or.jp/race/calendar/'
-    uris = (
-        urlbase + f'?year={x[0]:04}&month={x[1]:02}'
-        for x in rangeyearmonth)
+    keeper = asyncio.ensure_future(
+        keep_message_visible(queue_name, message, aio))
+    message_id = message.get('MessageId')
+    try:
+        if await process_message_async(
+                frontier, message['Body'], bucket_name, nowtime, aio,
+                deadline, message_id):
+            await aio.delete_message(queue_name, message['ReceiptHandle'])
+            crawl_journal.get_record(message_id).ack()
+        await crawl_journal.flush_async()
+    except asyncio.CancelledError:
+        # 時間切れで中断したメッセージはすぐに再配信させる
+        await aio.change_message_visibility(
+            queue_name, message['ReceiptHandle'], 0)
+        raise
+    except Exception as e:
+        logger.error(f'Exception occured. {e}')
+    finally:
+        keeper.cancel()
+
+
+def add_calendar_if_idle(queue_names, nowtime, days_back, days_forward):
+    """全キューにメッセージが無ければカレンダー取得メッセージを登録する.
 
-    sqs = boto3.resource('sqs')
-    queue = sqs.get_queue_by_name(QueueName=queue_name)
-    entries = [
-        {
-            'Id': f'{i}',
-            'MessageBody': json.dumps({'target': x, 'referer': None})
-        }
-        for (i, x) in enumerate(uris)]
-    queue.send_messages(Entries=entries)
+    Arguments:
+        queue_names {list(str)} -- 登録先キュー名のリスト
+        nowtime {datetime} -- 開始時刻
+        days_back {int} -- 過去方向の日数
+        days_forward {int} -- 未来方向の日数
+
+    Returns:
+        bool -- 登録した場合はTrue
+    """
+    if not all(is_queue_idle(x) for x in queue_names):
+        return False
+
+    add_calendar_message(queue_names, nowtime, days_back, days_forward)
+    return True
+
+
+def process_message(
+        frontier, body, bucket_name, nowtime, deadline=None, message_id=None):
+    """メッセージに含まれるタスクを処理する.
+
+    タスク単位でフェッチを行い、次のタスクを登録する。
+    失敗したタスクはTaskOutcomesの規則で再登録またはデッドレターキューに送る。
+    期限を過ぎたら残りのタスクはフェッチせずに再登録する。
+    クロールジャーナルに記録済みのタスクはフェッチせずに記録した結果を使う。
+
+    Arguments:
+        frontier {Frontier} -- 登録先キュー群
+        body {str} -- メッセージ本文
+        bucket_name {str} -- バケット名
+        nowtime {datetime} -- 開始時刻
+        deadline {datetime} -- 処理期限
+        message_id {str} -- メッセージID (クロールジャーナルの記録単位)
+
+    Returns:
+        bool -- メッセージを削除してよい場合はTrue
+    """
+    profiler.snapshot('message')
+    try:
+        tasks = parse_message_body(body)
+    except (ValueError, KeyError, TypeError) as e:
+        logger.error(f'Invalid message. {e}')
+        try:
+            frontier.send_invalid_message(body, e)
+        except Exception as e:
+            logger.error(f'Exception occured. {e}')
+            return False
+        return True
+
+    record = crawl_journal.get_record(message_id)
+    if record.completed:
+        logger.info(f'already processed: {message_id}')
+        return True
+
+    outcomes = TaskOutcomes(frontier.seen, record)
+    for (i, task) in enumerate(tasks):
+        if record.replay(i, task, outcomes):
+            continue
+        if deadline is not None and datetime.now(timezone.utc) >= deadline:
+            outcomes.add_deferred(task)
+            continue
+
+        record.start(i)
+        try:
+            uris = fetch(task.target, task.referer_uri, bucket_name, nowtime)
+        except Exception as e:
+            outcomes.add_error(task, e)
+            record.failed(i, e)
+        else:
+            outcomes.add_result(task, uris)
+            record.stored(i, uris)
+
+    for _ in range(SEND_ATTEMPTS):
+        try:
+            outcomes.send(frontier)
+            record.set_enqueued()
+            return True
+        except Exception as e:
+            error = e
+
+    return outcomes.settle(error)
+
+
+async def process_message_async(
+        frontier, body, bucket_name, nowtime, aio, deadline=None,
+        message_id=None):
+    """メッセージに含まれるタスクを非同期に処理する.
+
+    メッセージ内のタスクは並行にフェッチする。
+    期限までに終わらなかったタスクは中断して再登録する。
+    クロールジャーナルに記録済みのタスクはフェッチせずに記録した結果を使う。
+
+    Arguments:
+        frontier {Frontier} -- 登録先キュー群
+        body {str} -- メッセージ本文
+        bucket_name {str} -- バケット名
+        nowtime {datetime} -- 開始時刻
+        aio {AsyncIo} -- 非同期I/O
+        deadline {datetime} -- 処理期限
+        message_id {str} -- メッセージID (クロールジャーナルの記録単位)
+
+    Returns:
+        bool -- メッセージを削除してよい場合はTrue
+    """
+    profiler.snapshot('message')
+    try:
+        tasks = parse_message_body(body)
+    except (ValueError, KeyError, TypeError) as e:
+        logger.error(f'Invalid message. {e}')
+        try:
+            await aio.send_invalid_message(frontier, body, e)
+        except Exception as e:
+            logger.error(f'Exception occured. {e}')
+            return False
+        return True
+
+    record = crawl_journal.get_record(message_id)
+    if record.completed:
+        logger.info(f'already processed: {message_id}')
+        return True
+
+    futures = {}
+    for (i, x) in enumerate(tasks):
+        if i not in record.results:
+            record.start(i)
+            futures[i] = asyncio.ensure_future(fetch_async(
+                x.target, x.referer_uri, bucket_name, nowtime, aio))
+    timeout = None
+    if deadline is not None:
+        timeout = (deadline - datetime.now(timezone.utc)).total_seconds()
+    if futures:
+        (_, unfinished) = await asyncio.wait(
+            futures.values(),
+            timeout=max(0, timeout) if timeout is not None else None)
+        for future in unfinished:
+            future.cancel()
+        if unfinished:
+            await asyncio.wait(unfinished)
+
+    outcomes = TaskOutcomes(frontier.seen, record)
+    for (i, task) in enumerate(tasks):
+        future = futures.get(i)
+        if future is None:
+            record.replay(i, task, outcomes)
+        elif future.cancelled():
+            outcomes.add_deferred(task)
+        elif future.exception() is not None:
+            outcomes.add_error(task, future.exception())
+            record.failed(i, future.exception())
+        else:
+            outcomes.add_result(task, future.result())
+            record.stored(i, future.result())
+
+    for _ in range(SEND_ATTEMPTS):
+        try:
+            await outcomes.send_async(frontier, aio)
+            record.set_enqueued()
+            return True
+        except Exception as e:
+            error = e
+
+    return outcomes.settle(error)
+
+
+class TaskOutcomes:
+    """メッセージ内のタスクの処理結果をまとめるクラス.
+
+    成功したタスクの次のタスク、再試行するタスク (遅延秒数毎)、
+    デッドレターキューに送るタスクに振り分ける。
+    一時的な失敗は遅延を倍々に増やして再試行し、恒久的な失敗・解析エラー・
+    試行回数超過はデッドレターキューに送る。
+    登録済みの単位は記録し、登録し直すときは残りの単位だけを登録する。
+    クロールジャーナルの記録があれば、以前の起動で登録済みの単位も登録しない。
+    次のタスクはseenで起動中の重複を除き、登録できなかった分はseenから戻す。
+    """
+
+    __slots__ = (
+        'next_tasks', 'retry_tasks', 'dead_tasks', '_seen', '_claimed',
+        '_sent', '_record')
+
+    def __init__(self, seen=None, record=None):
+        """コンストラクタ.
+
+        Arguments:
+            seen {set} -- 起動中に登録済みのページ (次のタスクの重複除去用)
+            record {MessageJournal} -- メッセージのクロールジャーナル
+        """
+        self.next_tasks = []
+        self.retry_tasks = {}
+        self.dead_tasks = []
+        self._seen = seen
+        self._claimed = []
+        self._sent = set(record.sent) if record is not None else set()
+        self._record = record
+
+    @property
+    def sent(self):
+        """1件でもタスクを登録済みかどうか."""
+        return any(tasks for (key, tasks, _) in self._parcels()
+                   if key in self._sent)
+
+    @property
+    def unsent_tasks(self):
+        """未登録のタスク."""
+        return [task for (key, tasks, _) in self._parcels()
+                if key not in self._sent for task in tasks]
+
+    def _parcels(self):
+        """登録単位を列挙する.
+
+        Returns:
+            generator(tuple) -- (キー, タスクリスト, 遅延秒数)。
+                デッドレターの遅延秒数はNone
+        """
+        yield ('next', self.next_tasks, 0)
+        for (delay, group) in self.retry_tasks.items():
+            yield (f'retry/{delay}', group, delay)
+        yield ('dead', self.dead_tasks, None)
+
+    def add_deferred(self, task):
+        """期限切れで処理しなかったタスクを追加する.
+
+        試行回数は変えずにそのまま再登録する。
+
+        Arguments:
+            task {CrawlTask} -- 処理しなかったタスク
+        """
+        self.next_tasks.append(task)
+
+    @staticmethod
+    def get_seen_key(task):
+        """起動中の重複除去に使うキーを求める.
+
+        競走成績は参照元のレース日で再取得を判定するため、参照元も含める。
+
+        Arguments:
+            task {CrawlTask} -- 次のタスク
+
+        Returns:
+            object -- キー
+        """
+        if task.page_type == 'horse_record':
+            return (task.page, task.referer)
+        return task.page
+
+    def add_result(self, task, uris):
+        """フェッチ結果を追加する.
+
+        起動中にすでに登録した (または登録中の) ページは次のタスクに加えない。
+
+        Arguments:
+            task {CrawlTask} -- 処理したタスク
+            uris {list(str)} -- 次に処理するURIリスト。フェッチ対象外ならNone
+        """
+        if uris is None:
+            self.add_error(
+                task, PermanentFetchError(f'not fetchable: {task.target}'))
+            return
+
+        for uri in uris:
+            child = CrawlTask(to_page(uri), task.page)
+            if self._seen is not None:
+                key = self.get_seen_key(child)
+                if key in self._seen:
+                    continue
+                # 並行して処理中のメッセージと重複しないよう登録前に確保する
+                self._seen.add(key)
+                self._claimed.append(key)
+            self.next_tasks.append(child)
+
+    def add_error(self, task, error):
+        """フェッチ失敗を追加する.
+
+        Arguments:
+            task {CrawlTask} -- 処理したタスク
+            error {Exception} -- 発生した例外
+        """
+        category = classify_error(error)
+        logger.error(f'Exception occured. ({category}) {error}')
+        # サーキットが開いていてアクセスしなかった分は試行回数に数えない
+        attempt = task.attempt
+        if not isinstance(error, CircuitOpenError):
+            attempt += 1
+
+        if category == TransientFetchError.category and (
+                attempt < MAX_ATTEMPTS):
+            delay = get_retry_delay(max(attempt, 1))
+            self.retry_tasks.setdefault(delay, []).append(
+                CrawlTask(task.page, task.referer, attempt))
+        else:
+            self.dead_tasks.append(CrawlTask(
+                task.page, task.referer, attempt, f'{category}: {error}'))
+
+    def send(self, frontier):
+        """振り分けたタスクのうち未登録のものをキューに登録する.
+
+        Arguments:
+            frontier {Frontier} -- 登録先キュー群
+        """
+        for (key, tasks, delay) in self._parcels():
+            if key in self._sent:
+                continue
+            if delay is None:
+                frontier.send_dead_letters(tasks)
+            else:
+                frontier.send(tasks, delay_seconds=delay)
+            self._mark_sent(key)
+
+    async def send_async(self, frontier, aio):
+        """振り分けたタスクのうち未登録のものを非同期I/Oでキューに登録する.
+
+        Arguments:
+            frontier {Frontier} -- 登録先キュー群
+            aio {AsyncIo} -- 非同期I/O
+        """
+        for (key, tasks, delay) in self._parcels():
+            if key in self._sent:
+                continue
+            if delay is None:
+                await aio.send_dead_letters(frontier, tasks)
+            else:
+                await aio.send(frontier, tasks, delay_seconds=delay)
+            self._mark_sent(key)
+
+    def _mark_sent(self, key):
+        """登録単位を登録済みにする.
+
+        Arguments:
+            key {str} -- 登録単位のキー
+        """
+        self._sent.add(key)
+        if self._record is not None:
+            self._record.add_sent(key)
+
+    def settle(self, error):
+        """登録に失敗したときにメッセージを削除してよいかを決める.
+
+        1件も登録していなければメッセージを残して再配信させる。
+        一部でも登録済みなら再配信すると重複するため、
+        残りはログに残して破棄する。
+        どちらの場合も次のタスクが未登録なら、確保したページをseenから戻し、
+        再配信や他のメッセージから登録できるようにする。
+
+        Arguments:
+            error {Exception} -- 登録時に発生した例外
+
+        Returns:
+            bool -- メッセージを削除してよい場合はTrue
+        """
+        logger.error(f'Exception occured. {error}')
+        if self._seen is not None and 'next' not in self._sent:
+            self._seen.difference_update(self._claimed)
+            self._claimed.clear()
+
+        if not self.sent:
+            return False
+
+        for task in self.unsent_tasks:
+            logger.error(f'dropped: {task}')
+        return True
+
+
+def get_retry_delay(attempt):
+    """再試行までの遅延秒数を求める.
+
+    Arguments:
+        attempt {int} -- 失敗済みの試行回数
+
+    Returns:
+        int -- 遅延秒数
+    """
+    return min(
+        RETRY_BASE_SECONDS * 2 ** (attempt - 1), MAX_RETRY_DELAY_SECONDS)
+
+
+def parse_message_body(body):
+    """メッセージ本文からタスクのリストを取得する.
+
+    ページ種類毎の圧縮形式 ({'page', 'tasks'}) のほか、
+    以前の単一タスク形式 ({'target', 'referer'}) とバッチ形式
+    ({'fetcher', 'targets'}) も受け付ける。
+
+    Arguments:
+        body {str} -- メッセージ本文
+
+    Returns:
+        list(CrawlTask) -- タスクリスト
+    """
+    message_object = json.loads(body)
+    if 'tasks' in message_object:
+        page_type = message_object['page']
+        return [CrawlTask.decode(page_type, x)
+                for x in message_object['tasks']]
+
+    if 'targets' in message_object:
+        objects = message_object['targets']
+    else:
+        objects = [message_object]
+
+    return [
+        CrawlTask(
+            to_page(x['target']),
+            to_page(x['referer']) if x['referer'] else None,
+            int(x.get('attempt') or 0))
+        for x in objects]
+
+
+# JBISのページ種類毎のURIの形式 (IDの部分を{}で表す)
+JBIS_PAGE_FORMATS = {
+    'calendar': 'https://www.jbis.or.jp/race/calendar/?year={}&month={}',
+    'race_list': 'https://www.jbis.or.jp/race/calendar/{}/{}/',
+    'race_result': 'https://www.jbis.or.jp/race/result/{}/{}/{}/',
+    'race_entry': 'https://www.jbis.or.jp/race/{}/{}/{}.html',
+    'horse_record': 'https://www.jbis.or.jp/horse/{}/record/all/',
+    'horse': 'https://www.jbis.or.jp/horse/{}/',
+}
+
+# URIからIDを取り出す正規表現 (形式どおりに組み立て直せるものだけ一致する)
+JBIS_PAGE_PATTERNS = {
+    k: re.compile(re.escape(v).replace(r'\{\}', r'(\d+)'))
+    for (k, v) in JBIS_PAGE_FORMATS.items()}
+
+
+class PageRef(namedtuple('PageRef', ['page_type', 'ids'])):
+    """JBISのページをページ種類とIDの組で表す参照.
+
+    URI文字列の代わりに持ち、IDは同じものを共有する (sys.intern)。
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_uri(cls, uri):
+        """URIから参照を作る.
+
+        Arguments:
+            uri {str} -- URI
+
+        Returns:
+            PageRef -- 参照。JBISのページの形式でなければNone
+        """
+        for (page_type, pattern) in JBIS_PAGE_PATTERNS.items():
+            m = pattern.fullmatch(uri)
+            if m:
+                return cls(page_type, tuple(sys.intern(x) for x in m.groups()))
+
+        return None
+
+    @classmethod
+    def from_key(cls, key):
+        """キー文字列から参照を作る.
+
+        Arguments:
+            key {str} -- 'ページ種類:ID/ID'形式のキー
+
+        Returns:
+            PageRef -- 参照
+        """
+        (page_type, ids) = key.split(':', 1)
+        return cls.from_ids(page_type, ids)
+
+    @classmethod
+    def from_ids(cls, page_type, ids):
+        """ページ種類と'/'区切りのIDから参照を作る.
+
+        Arguments:
+            page_type {str} -- ページ種類
+            ids {str} -- '/'区切りのID
+
+        Returns:
+            PageRef -- 参照
+        """
+        if page_type not in JBIS_PAGE_FORMATS:
+            raise ValueError(f'unknown page type: {page_type}')
+
+        return cls(
+            sys.intern(page_type),
+            tuple(sys.intern(x) for x in ids.split('/')))
+
+    @property
+    def key(self):
+        """'ページ種類:ID/ID'形式のキー文字列."""
+        return f'{self.page_type}:{"/".join(self.ids)}'
+
+    @property
+    def uri(self):
+        """URI."""
+        return JBIS_PAGE_FORMATS[self.page_type].format(*self.ids)
+
+    @property
+    def date(self):
+        """ページの対象日 (カレンダーは月初、レース関係はレース日).
+
+        対象日の無いページ (競走馬) はNone。
+        """
+        if self.page_type == 'calendar':
+            return datetime(int(self.ids[0]), int(self.ids[1]), 1, tzinfo=JST)
+        if self.page_type in ('race_list', 'race_result', 'race_entry'):
+            return datetime.strptime(self.ids[0], '%Y%m%d').replace(
+                tzinfo=JST)
+        return None
+
+
+def to_page(uri):
+    """URIをタスクに持たせる形に変換する.
+
+    Arguments:
+        uri {str} -- URI
+
+    Returns:
+        PageRef -- JBISのページならその参照、それ以外はURIのまま
+    """
+    return PageRef.from_uri(uri) or uri
+
+
+class CrawlTask:
+    """クロール対象のタスク.
+
+    対象と参照元はJBISのページならPageRef、それ以外はURI文字列で持つ。
+    キューにはページ種類毎にまとめ、[ID, 参照元, 試行回数, エラー内容]の
+    リストに圧縮して登録する (末尾の省略可能な項目は省く)。
+    """
+
+    __slots__ = ('page', 'referer', 'attempt', 'error')
+
+    def __init__(self, page, referer=None, attempt=0, error=None):
+        """コンストラクタ.
+
+        Arguments:
+            page {PageRef} -- 対象 (またはURI)
+            referer {PageRef} -- 参照元 (またはURI)
+            attempt {int} -- 失敗済みの試行回数
+            error {str} -- デッドレターにする理由
+        """
+        self.page = page
+        self.referer = referer
+        self.attempt = attempt
+        self.error = error
+
+    @classmethod
+    def from_uri(cls, uri, referer=None):
+        """URIからタスクを作る.
+
+        Arguments:
+            uri {str} -- 対象URI
+            referer {str} -- 参照元URI
+
+        Returns:
+            CrawlTask -- タスク
+        """
+        return cls(to_page(uri), to_page(referer) if referer else None)
+
+    @classmethod
+    def decode(cls, page_type, item):
+        """圧縮形式からタスクを復元する.
+
+        Arguments:
+            page_type {str} -- ページ種類 (JBIS以外はNone)
+            item {list} -- 圧縮形式のタスク
+
+        Returns:
+            CrawlTask -- タスク
+        """
+        (ids, referer, attempt, error) = (list(item) + [None] * 3)[:4]
+        if page_type is None:
+            page = ids
+        else:
+            page = PageRef.from_ids(page_type, ids)
+        if referer and '://' not in referer:
+            referer = PageRef.from_key(referer)
+        return cls(page, referer, int(attempt or 0), error)
+
+    @property
+    def page_type(self):
+        """ページ種類 (JBIS以外はNone)."""
+        return self.page.page_type if isinstance(self.page, PageRef) else None
+
+    @property
+    def target(self):
+        """対象URI."""
+        return self.page.uri if isinstance(self.page, PageRef) else self.page
+
+    @property
+    def referer_uri(self):
+        """参照元URI."""
+        if isinstance(self.referer, PageRef):
+            return self.referer.uri
+        return self.referer
+
+    def encode(self):
+        """圧縮形式に変換する.
+
+        Returns:
+            list -- 圧縮形式のタスク
+        """
+        if isinstance(self.page, PageRef):
+            item = ['/'.join(self.page.ids)]
+        else:
+            item = [self.page]
+        if isinstance(self.referer, PageRef):
+            item.append(self.referer.key)
+        else:
+            item.append(self.referer)
+        if self.attempt or self.error:
+            item.append(self.attempt)
+        if self.error:
+            item.append(self.error)
+        return item
+
+    def to_dict(self):
+        """URIで表した辞書形式に変換する.
+
+        Returns:
+            dict -- {'target', 'referer'}形式 (試行回数 'attempt'、
+                エラー内容 'error' があれば付ける)
+        """
+        result = {'target': self.target, 'referer': self.referer_uri}
+        if self.attempt:
+            result['attempt'] = self.attempt
+        if self.error:
+            result['error'] = self.error
+        return result
+
+    def __eq__(self, other):
+        """同じ内容のタスクならTrue."""
+        if not isinstance(other, CrawlTask):
+            return NotImplemented
+        return (
+            (self.page, self.referer, self.attempt, self.error) ==
+            (other.page, other.referer, other.attempt, other.error))
+
+    def __repr__(self):
+        """デバッグ用の表現."""
+        return f'CrawlTask({self.to_dict()})'
+
+
+def get_fetcher_type(uri):
+    """URIに対応するフェッチクラスの名前を取得する.
+
+    Arguments:
+        uri {str} -- URI
+
+    Returns:
+        str -- フェッチクラス名
+    """
+    return type(get_fetcher(uri, None)).__name__
+
+
+def make_batch_bodies(tasks):
+    """タスクをページ種類毎にまとめた圧縮形式のメッセージ本文を生成する.
+
+    1メッセージがMAX_MESSAGE_SIZEとMAX_TASKS_PER_MESSAGEを超えないように分割する。
+
+    Arguments:
+        tasks {iterable(CrawlTask)} -- タスク
+
+    Returns:
+        generator(str) -- メッセージ本文
+    """
+    groups = {}
+    for task in tasks:
+        groups.setdefault(task.page_type, []).append(task)
+
+    for (page_type, group) in groups.items():
+        overhead = len(json.dumps({'page': page_type, 'tasks': []}))
+        # 区切り文字 ', ' の分を各タスクの長さに加える
+        batches = constrained_batches(
+            (json.dumps(x.encode()) for x in group),
+            MAX_MESSAGE_SIZE - overhead, max_count=MAX_TASKS_PER_MESSAGE,
+            get_len=lambda x: len(x) + 2)
+        for batch in batches:
+            yield (
+                f'{{"page": {json.dumps(page_type)}, '
+                f'"tasks": [{", ".join(batch)}]}}')
+
+
+def make_send_entries(tasks, delay_seconds=0):
+    """タスクからSQSの送信バッチを生成する.
+
+    Arguments:
+        tasks {iterable(CrawlTask)} -- タスク
+        delay_seconds {int} -- 配信遅延秒数
+
+    Returns:
+        generator(list(dict)) -- 送信バッチ1回分のエントリーリスト
+    """
+    chunks = constrained_batches(
+        make_batch_bodies(tasks), MAX_MESSAGE_SIZE, max_count=10)
+    for chunk in chunks:
+        yield [
+            {'Id': f'{i}', 'MessageBody': x, 'DelaySeconds': delay_seconds}
+            for (i, x) in enumerate(chunk)]
+
+
+def make_invalid_message_body(body, error):
+    """解析できなかったメッセージをデッドレターキューに送る本文を作る.
+
+    エスケープで増えてもMAX_MESSAGE_SIZEに収まるように元の本文を切り詰める。
+
+    Arguments:
+        body {str} -- 元のメッセージ本文
+        error {Exception} -- 解析時に発生した例外
+
+    Returns:
+        str -- メッセージ本文
+    """
+    # JSONのエスケープは1文字あたり最大6バイトになる
+    length = (MAX_MESSAGE_SIZE - 1024) // 6
+    return json.dumps({'invalid': body[:length], 'error': f'invalid: {error}'})
+
+
+def send_tasks(queue, tasks, delay_seconds=0):
+    """タスクをバッチ形式のメッセージとしてキューに登録する.
+
+    Arguments:
+        queue {SQS.Queue} -- キュー
+        tasks {iterable(CrawlTask)} -- タスク
+        delay_seconds {int} -- 配信遅延秒数
+    """
+    for entries in make_send_entries(tasks, delay_seconds):
+        queue.send_messages(Entries=entries)
+
+
+def get_shard(key, shard_count):
+    """キーからシャード番号を求める.
+
+    Arguments:
+        key {str} -- シャード分割に使うキー
+        shard_count {int} -- シャード数
+
+    Returns:
+        int -- シャード番号
+    """
+    return zlib.crc32(key.encode()) % shard_count
+
+
+def get_shard_queue_name(queue_name, shard, shard_count):
+    """シャードのキュー名を取得する.
+
+    シャード数が1の場合は基底のキュー名をそのまま使う。
+
+    Arguments:
+        queue_name {str} -- 基底のキュー名
+        shard {int} -- シャード番号
+        shard_count {int} -- シャード数
+
+    Returns:
+        str -- シャードのキュー名
+    """
+    if shard_count == 1:
+        return queue_name
+
+    return f'{queue_name}-{shard}'
+
+
+class Frontier:
+    """シャード分割されたクロール対象キュー群.
+
+    seenには起動中に次のタスクとして登録したページのキー
+    (TaskOutcomes.get_seen_key()参照) を持ち、重複登録を防ぐ。
+    """
+
+    def __init__(
+            self, queue_name, shard_count=1, partition='uri',
+            dead_letter_queue_name=None):
+        """コンストラクタ.
+
+        Arguments:
+            queue_name {str} -- 基底のキュー名
+            shard_count {int} -- シャード数
+            partition {str} -- シャードの分割方法 ('uri' または 'type')
+            dead_letter_queue_name {str} -- デッドレターキュー名
+        """
+        self._queue_name = queue_name
+        self._dead_letter_queue_name = dead_letter_queue_name
+        self._shard_count = shard_count
+        self._partition = partition
+        self._queues = {}
+        self._dead_letter_queue = None
+        self.seen = set()
+
+    @property
+    def queue_names(self):
+        """全シャードのキュー名."""
+        return [self.get_queue_name(x) for x in range(self._shard_count)]
+
+    @property
+    def dead_letter_queue_name(self):
+        """デッドレターキュー名."""
+        return self._dead_letter_queue_name
+
+    def get_queue_name(self, shard):
+        """シャードのキュー名を取得する.
+
+        Arguments:
+            shard {int} -- シャード番号
+
+        Returns:
+            str -- キュー名
+        """
+        return get_shard_queue_name(self._queue_name, shard, self._shard_count)
+
+    def get_queue(self, shard):
+        """シャードのキューを取得する.
+
+        Arguments:
+            shard {int} -- シャード番号
+
+        Returns:
+            SQS.Queue -- キュー
+        """
+        if shard not in self._queues:
+            sqs = boto3.resource('sqs')
+            self._queues[shard] = sqs.get_queue_by_name(
+                QueueName=self.get_queue_name(shard))
+
+        return self._queues[shard]
+
+    def get_task_shard(self, task):
+        """タスクの振り分け先シャード番号を求める.
+
+        Arguments:
+            task {CrawlTask} -- タスク
+
+        Returns:
+            int -- シャード番号
+        """
+        if self._partition == 'type':
+            key = get_fetcher_type(task.target)
+        else:
+            key = task.target
+
+        return get_shard(key, self._shard_count)
+
+    def group_by_shard(self, tasks):
+        """タスクをシャード毎に振り分ける.
+
+        Arguments:
+            tasks {iterable(CrawlTask)} -- タスク
+
+        Returns:
+            dict(int, list(CrawlTask)) -- シャード番号毎のタスクリスト
+        """
+        groups = {}
+        for task in tasks:
+            groups.setdefault(self.get_task_shard(task), []).append(task)
+
+        return groups
+
+    def send(self, tasks, delay_seconds=0):
+        """タスクをシャード毎に振り分けてキューに登録する.
+
+        Arguments:
+            tasks {iterable(CrawlTask)} -- タスク
+            delay_seconds {int} -- 配信遅延秒数
+        """
+        for (shard, group) in self.group_by_shard(tasks).items():
+            send_tasks(self.get_queue(shard), group, delay_seconds)
+
+    def send_dead_letters(self, tasks):
+        """処理できなかったタスクをデッドレターキューに登録する.
+
+        デッドレターキューが未設定の場合はログに残して破棄する。
+
+        Arguments:
+            tasks {list(CrawlTask)} -- エラー内容 error を付けたタスク
+        """
+        if not tasks:
+            return
+
+        if self._dead_letter_queue_name is None:
+            for task in tasks:
+                logger.error(f'dropped: {task}')
+            return
+
+        send_tasks(self.get_dead_letter_queue(), tasks)
+
+    def send_invalid_message(self, body, error):
+        """解析できなかったメッセージをデッドレターキューに登録する.
+
+        デッドレターキューが未設定の場合はログに残して破棄する。
+
+        Arguments:
+            body {str} -- メッセージ本文
+            error {Exception} -- 解析時に発生した例外
+        """
+        if self._dead_letter_queue_name is None:
+            logger.error(f'dropped: {body}')
+            return
+
+        self.get_dead_letter_queue().send_message(
+            MessageBody=make_invalid_message_body(body, error))
+
+    def get_dead_letter_queue(self):
+        """デッドレターキューを取得する.
+
+        Returns:
+            SQS.Queue -- キュー
+        """
+        if self._dead_letter_queue is None:
+            sqs = boto3.resource('sqs')
+            self._dead_letter_queue = sqs.get_queue_by_name(
+                QueueName=self._dead_letter_queue_name)
+
+        return self._dead_letter_queue
+
+
+def is_condition_failed(error):
+    """S3の条件付き書き込みが競合したエラーかどうかを返す.
+
+    Arguments:
+        error {ClientError} -- エラー
+
+    Returns:
+        bool -- 条件不成立・競合ならTrue
+    """
+    code = error.response.get('Error', {}).get('Code')
+    return code in ('PreconditionFailed', 'ConditionalRequestConflict', '412')
+
+
+class S3LeaseStore:
+    """S3の条件付き書き込みを使ったリースとチケットの管理クラス.
+
+    シャードのリースと、起動間で共有するアクセス枠 (チケット) を扱う。
+    """
+
+    def __init__(self, bucket, prefix='coordination/'):
+        """コンストラクタ.
+
+        Arguments:
+            bucket {str} -- バケット名
+            prefix {str} -- キーのプレフィックス
+        """
+        self._bucket = bucket
+        self._prefix = prefix
+
+    def _object(self, name):
+        s3 = boto3.resource('s3')
+        return s3.Object(self._bucket, self._prefix + name)
+
+    def _create(self, name, body):
+        try:
+            self._object(name).put(Body=body, IfNoneMatch='*')
+        except ClientError as e:
+            if is_condition_failed(e):
+                return False
+            raise
+
+        return True
+
+    def acquire(self, name, owner, seconds):
+        """リースを取得する.
+
+        期限切れのリースは上書きして取得する。
+
+        Arguments:
+            name {str} -- リース名
+            owner {str} -- 取得者の識別子
+            seconds {int} -- リース期間秒数
+
+        Returns:
+            bool -- 取得できた場合はTrue
+        """
+        now = time.time()
+        body = json.dumps({'owner': owner, 'expires': now + seconds})
+        if self._create(f'lease/{name}', body):
+            return True
+
+        obj = self._object(f'lease/{name}')
+        current = obj.get()
+        lease = json.loads(current['Body'].read())
+        if lease['expires'] > now:
+            return False
+
+        try:
+            obj.put(Body=body, IfMatch=current['ETag'])
+        except ClientError as e:
+            if is_condition_failed(e):
+                return False
+            raise
+
+        return True
+
+    def release(self, name, owner):
+        """リースを解放する.
+
+        Arguments:
+            name {str} -- リース名
+            owner {str} -- 取得者の識別子
+        """
+        obj = self._object(f'lease/{name}')
+        lease = json.loads(obj.get()['Body'].read())
+        if lease['owner'] == owner:
+            obj.delete()
+
+    def take_ticket(self, name, slot):
+        """アクセス枠を取得する.
+
+        Arguments:
+            name {str} -- 枠の名前 (ホスト名)
+            slot {int} -- 枠の番号
+
+        Returns:
+            bool -- 取得できた場合はTrue
+        """
+        return self._create(f'ticket/{name}/{slot}', b'')
+
+    def return_ticket(self, name, slot):
+        """使用済みのアクセス枠を削除する.
+
+        Arguments:
+            name {str} -- 枠の名前 (ホスト名)
+            slot {int} -- 枠の番号
+        """
+        self._object(f'ticket/{name}/{slot}').delete()
+
+
+class RateLimiter(metaclass=ABCMeta):
+    """アクセス間隔制御用抽象クラス."""
+
+    @abstractmethod
+    def wait(self, host):
+        """ホストにアクセスしてよくなるまで待つ.
+
+        Arguments:
+            host {str} -- アクセス先ホスト名
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def wait_async(self, host):
+        """ホストにアクセスしてよくなるまで非同期に待つ.
+
+        Arguments:
+            host {str} -- アクセス先ホスト名
+        """
+        raise NotImplementedError()
+
+
+class IntervalRateLimiter(RateLimiter):
+    """起動内でホスト毎のアクセス間隔を空けるクラス."""
+
+    def __init__(self, interval):
+        """コンストラクタ.
+
+        Arguments:
+            interval {float} -- アクセス間隔秒数
+        """
+        self.interval = interval
+        self._last = {}
+
+    def _reserve(self, host):
+        # 並行して待つ呼び出しが同じ時刻を取らないよう、先にアクセス時刻を予約する
+        now = time.monotonic()
+        last = self._last.get(host, now - self.interval)
+        at = max(now, last + self.interval)
+        self._last[host] = at
+        return at - now
+
+    def wait(self, host):
+        """ホストにアクセスしてよくなるまで待つ.
+
+        Arguments:
+            host {str} -- アクセス先ホスト名
+        """
+        delay = self._reserve(host)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait_async(self, host):
+        """ホストにアクセスしてよくなるまで非同期に待つ.
+
+        Arguments:
+            host {str} -- アクセス先ホスト名
+        """
+        delay = self._reserve(host)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class TicketRateLimiter(RateLimiter):
+    """複数の起動で共有するアクセス枠を使ってアクセス間隔を空けるクラス.
+
+    時刻をinterval毎の枠に区切り、S3上で枠を先取りできた起動だけが
+    その枠の開始時刻にアクセスする。
+    取得した枠は開始時刻を過ぎてから削除する (非同期エンジンでは先の枠を
+    並行して取得するため、使う前に削除すると他の起動に取られてしまう)。
+    起動終了時に残る枠はバケットのライフサイクルルールで削除する想定。
+    """
+
+    def __init__(self, store, interval):
+        """コンストラクタ.
+
+        Arguments:
+            store {S3LeaseStore} -- 枠を管理するストア
+            interval {float} -- アクセス間隔秒数
+        """
+        self.interval = interval
+        self._store = store
+        self._taken = {}
+        self._lock = threading.Lock()
+
+    def _take(self, host):
+        # 非同期エンジンからはexecutorのスレッドで並行に呼ばれる
+        slot = int(time.time() // self.interval) + 1
+        while not self._store.take_ticket(host, slot):
+            slot += 1
+
+        with self._lock:
+            taken = self._taken.setdefault(host, [])
+            taken.append(slot)
+            # 開始時刻を過ぎた枠は誰も取得しないので削除してよい
+            current = time.time() // self.interval
+            passed = [x for x in taken if x <= current]
+            taken[:] = [x for x in taken if x > current]
+
+        for x in passed:
+            self._store.return_ticket(host, x)
+        return slot * self.interval - time.time()
+
+    def wait(self, host):
+        """ホストにアクセスしてよくなるまで待つ.
+
+        Arguments:
+            host {str} -- アクセス先ホスト名
+        """
+        delay = self._take(host)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait_async(self, host):
+        """ホストにアクセスしてよくなるまで非同期に待つ.
+
+        Arguments:
+            host {str} -- アクセス先ホスト名
+        """
+        loop = asyncio.get_event_loop()
+        delay = await loop.run_in_executor(None, self._take, host)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+rate_limiter = IntervalRateLimiter(ACCESS_INTERVAL_SECONDS)
+
+
+def use_shared_rate_limit(bucket_name):
+    """起動間で共有するアクセス間隔制御に切り替える.
+
+    Arguments:
+        bucket_name {str} -- 枠を管理するバケット名
+    """
+    global rate_limiter
+    rate_limiter = TicketRateLimiter(
+        S3LeaseStore(bucket_name), ACCESS_INTERVAL_SECONDS)
+
+
+class DiskCache:
+    """S3オブジェクトの内容をローカルディスクに保持するLRUキャッシュ.
+
+    バケット名・キーとETagで引く。ETagはget_s3_object()の一覧で得られるので、
+    内容が変わっていないことをS3へのGETなしで確認できる。
+    合計サイズがmax_bytesを超えたら使われていない順に削除する。
+    ディスクの読み書きに失敗してもS3から取得すればよいので、ログに残して続ける。
+    """
+
+    def __init__(self, directory=None, max_bytes=0):
+        """コンストラクタ.
+
+        Arguments:
+            directory {str} -- 保存先ディレクトリ (Noneなら無効)
+            max_bytes {int} -- 合計サイズの上限 (0なら無効)
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._names = {}
+        self._size = 0
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+            self._load()
+
+    @property
+    def enabled(self):
+        """キャッシュが有効ならTrue."""
+        return self.directory is not None and self.max_bytes > 0
+
+    @property
+    def size(self):
+        """保持している合計サイズ."""
+        return self._size
+
+    def get(self, bucket, key, e_tag):
+        """キャッシュされた内容を取得する.
+
+        Arguments:
+            bucket {str} -- バケット名
+            key {str} -- キー
+            e_tag {str} -- S3オブジェクトのETag
+
+        Returns:
+            mmap -- 内容 (読み取り専用のメモリマップ)。無ければNone
+        """
+        if not self.enabled:
+            return None
+
+        name = self._get_name(bucket, key, e_tag)
+        if name not in self._entries:
+            return None
+
+        self._entries.move_to_end(name)
+        try:
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                if self._entries[name] == 0:
+                    return b''
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError as e:
+            logger.warning(f'cache read failed. {e}')
+            self._remove(name)
+            return None
+
+    def put(self, bucket, key, e_tag, content):
+        """内容をキャッシュする.
+
+        Arguments:
+            bucket {str} -- バケット名
+            key {str} -- キー
+            e_tag {str} -- S3オブジェクトのETag (Noneならキャッシュしない)
+            content {bytes} -- 内容
+        """
+        if not self.enabled or e_tag is None:
+            return
+
+        writer = self.open_writer(bucket, key)
+        writer.write(content)
+        writer.commit(e_tag)
+
+    def open_writer(self, bucket, key):
+        """少しずつ書き込んでからキャッシュに登録する書き込み口を開く.
+
+        Arguments:
+            bucket {str} -- バケット名
+            key {str} -- キー
+
+        Returns:
+            DiskCacheWriter -- 書き込み口
+        """
+        return DiskCacheWriter(self, bucket, key)
+
+    def _get_name(self, bucket, key, e_tag):
+        # 同じキーの古い版を見つけられるようにキー部分とETag部分に分ける
+        key_hash = hashlib.sha256(f'{bucket}/{key}'.encode()).hexdigest()
+        tag_hash = hashlib.sha256(e_tag.encode()).hexdigest()[:16]
+        return f'{key_hash}.{tag_hash}'
+
+    def _load(self):
+        # 前回の起動で残したファイルを古い順に登録し直す
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.tmp'):
+                os.remove(entry.path)
+            else:
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+
+        for (_, name, size) in sorted(files):
+            self._add(name, size)
+        self._evict()
+
+    def _commit(self, temp_path, bucket, key, e_tag, size):
+        if size > self.max_bytes:
+            os.remove(temp_path)
+            return
+
+        name = self._get_name(bucket, key, e_tag)
+        os.replace(temp_path, os.path.join(self.directory, name))
+        self._add(name, size)
+        self._evict()
+
+    def _add(self, name, size):
+        old = self._names.get(name.split('.')[0])
+        if old is not None and old != name:
+            # 内容が変わった古い版は使わないので削除する
+            self._remove(old)
+        if name in self._entries:
+            self._size -= self._entries[name]
+
+        self._entries[name] = size
+        self._entries.move_to_end(name)
+        self._names[name.split('.')[0]] = name
+        self._size += size
+
+    def _remove(self, name):
+        self._size -= self._entries.pop(name)
+        if self._names.get(name.split('.')[0]) == name:
+            del self._names[name.split('.')[0]]
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while self._size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+
+class DiskCacheWriter:
+    """DiskCacheに少しずつ書き込む書き込み口.
+
+    一時ファイルに書き込み、commit()でETagを付けて登録する。
+    キャッシュが無効な場合や書き込みに失敗した場合は何もしない。
+    """
+
+    def __init__(self, cache, bucket, key):
+        """コンストラクタ.
+
+        Arguments:
+            cache {DiskCache} -- 登録先キャッシュ
+            bucket {str} -- バケット名
+            key {str} -- キー
+        """
+        self._cache = cache
+        self._bucket = bucket
+        self._key = key
+        self._size = 0
+        self._file = None
+        if cache.enabled:
+            try:
+                self._file = tempfile.NamedTemporaryFile(
+                    dir=cache.directory, suffix='.tmp', delete=False)
+            except OSError as e:
+                logger.warning(f'cache write failed. {e}')
+
+    def write(self, chunk):
+        """内容の断片を書き込む.
+
+        Arguments:
+            chunk {bytes} -- 内容の断片
+        """
+        if self._file is None:
+            return
+
+        self._size += len(chunk)
+        if self._size > self._cache.max_bytes:
+            # 上限を超える大きさのものはキャッシュしない
+            self.discard()
+            return
+
+        try:
+            self._file.write(chunk)
+        except OSError as e:
+            logger.warning(f'cache write failed. {e}')
+            self.discard()
+
+    def commit(self, e_tag):
+        """書き込んだ内容をキャッシュに登録する.
+
+        Arguments:
+            e_tag {str} -- S3オブジェクトのETag
+        """
+        if self._file is None:
+            return
+
+        try:
+            self._file.close()
+            self._cache._commit(
+                self._file.name, self._bucket, self._key, e_tag, self._size)
+        except OSError as e:
+            logger.warning(f'cache write failed. {e}')
+            self.discard()
+        self._file = None
+
+    def discard(self):
+        """書き込んだ内容を破棄する."""
+        if self._file is None:
+            return
+
+        self._file.close()
+        try:
+            os.remove(self._file.name)
+        except FileNotFoundError:
+            pass
+        self._file = None
+
+
+disk_cache = DiskCache()
+
+
+def use_disk_cache(directory, max_bytes):
+    """取得済みコンテンツのディスクキャッシュを使う.
+
+    ウォームスタートでは同じキャッシュを使い続ける。
+
+    Arguments:
+        directory {str} -- 保存先ディレクトリ
+        max_bytes {int} -- 合計サイズの上限 (0なら使わない)
+    """
+    global disk_cache
+    if disk_cache.directory == directory and disk_cache.enabled:
+        disk_cache.max_bytes = max_bytes
+        disk_cache._evict()
+        return
+
+    disk_cache = DiskCache(directory, max_bytes)
+
+
+class UpstreamHealth:
+    """上流サイトの応答状況からアクセス速度を調整するクラス.
+
+    直近window件の応答時間と失敗を監視し、AIMD方式で追加の待ち時間と並列数を
+    調整する (順調なら少しずつ速め、遅延・失敗が出たら半分に落とす)。
+    失敗が続いた場合はサーキットを開いてアクセスを止め、cooldown秒後に
+    1件だけ試行して成功すれば閉じる。
+    """
+
+    # 順調な応答1件あたりに減らす待ち時間秒数 (加算的増加)
+    DELAY_STEP = 0.25
+    # 失敗率でサーキットを開くのに必要な最小件数
+    MIN_SAMPLES = 10
+
+    def __init__(
+            self, target_latency=2.0, window=50, max_delay=30.0,
+            max_concurrency=8, failure_threshold=5, error_rate_threshold=0.5,
+            cooldown=300.0, min_timeout=3.0, max_timeout=10.0):
+        """コンストラクタ.
+
+        Arguments:
+            target_latency {float} -- 順調とみなす応答時間秒数
+            window {int} -- 監視する直近の件数
+            max_delay {float} -- 追加の待ち時間の上限秒数
+            max_concurrency {int} -- 並列数の上限
+            failure_threshold {int} -- サーキットを開く連続失敗回数
+            error_rate_threshold {float} -- サーキットを開く失敗率
+            cooldown {float} -- サーキットを開いてから試行するまでの秒数
+            min_timeout {float} -- タイムアウト秒数の下限
+            max_timeout {float} -- タイムアウト秒数の上限
+        """
+        self.target_latency = target_latency
+        self.max_delay = max_delay
+        self.max_concurrency = max_concurrency
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.cooldown = cooldown
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.delay = 0.0
+        self._concurrency = 1.0
+        self._latencies = deque(maxlen=window)
+        self._results = deque(maxlen=window)
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def percentile(self, p):
+        """直近の応答時間のパーセンタイルを求める.
+
+        Arguments:
+            p {float} -- 0から1の割合
+
+        Returns:
+            float -- 応答時間秒数。記録が無い場合はNone
+        """
+        if not self._latencies:
+            return None
+
+        values = sorted(self._latencies)
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+    @property
+    def error_rate(self):
+        """直近の失敗率."""
+        if not self._results:
+            return 0.0
+
+        return self._results.count(False) / len(self._results)
+
+    @property
+    def concurrency(self):
+        """現在許可している並列数."""
+        return int(self._concurrency)
+
+    @property
+    def timeout(self):
+        """HTTPリクエストのタイムアウト秒数 (応答時間のp95の3倍)."""
+        if len(self._latencies) < self.MIN_SAMPLES:
+            return self.max_timeout
+
+        timeout = self.percentile(0.95) * 3
+        return min(self.max_timeout, max(self.min_timeout, timeout))
+
+    @property
+    def is_open(self):
+        """サーキットが開いていてアクセスできない状態ならTrue."""
+        if self._opened_at is None:
+            return False
+
+        elapsed = time.monotonic() - self._opened_at
+        return self._probing or elapsed < self.cooldown
+
+    def allow(self):
+        """アクセスしてよいかどうかを返す.
+
+        cooldown経過後の半開状態では1件だけ許可する。
+
+        Returns:
+            bool -- アクセスしてよければTrue
+        """
+        if self._opened_at is None:
+            return True
+
+        if self.is_open:
+            return False
+
+        self._probing = True
+        return True
+
+    @property
+    def probing(self):
+        """半開状態の試行を許可済みで、結果を待っているならTrue."""
+        return self._probing
+
+    def release_probe(self):
+        """結果を記録せずに終わった半開状態の試行を取り消す.
+
+        アクセス前の待ちやキャンセルで中断した場合に呼び、
+        次の試行を許可できる状態に戻す。
+        """
+        self._probing = False
+
+    def wait(self):
+        """調整された追加の待ち時間だけ待つ."""
+        if self.delay > 0:
+            time.sleep(self.delay)
+
+    async def wait_async(self):
+        """調整された追加の待ち時間だけ非同期に待つ."""
+        if self.delay > 0:
+            await asyncio.sleep(self.delay)
+
+    def record(self, latency, ok):
+        """アクセス結果を記録して速度を調整する.
+
+        Arguments:
+            latency {float} -- 応答時間秒数
+            ok {bool} -- 成功したかどうか
+        """
+        self._latencies.append(latency)
+        self._results.append(ok)
+
+        if ok and latency <= self.target_latency:
+            self.delay = max(0.0, self.delay - self.DELAY_STEP)
+            self._concurrency = min(
+                self.max_concurrency,
+                self._concurrency + 1 / self._concurrency)
+        else:
+            self.delay = min(self.max_delay, max(1.0, self.delay * 2))
+            self._concurrency = max(1.0, self._concurrency / 2)
+
+        if ok:
+            self._failures = 0
+            if self._opened_at is not None:
+                logger.info('circuit closed')
+                self._opened_at = None
+                self._probing = False
+            return
+
+        self._failures += 1
+        error_rate_exceeded = (
+            len(self._results) >= self.MIN_SAMPLES and
+            self.error_rate >= self.error_rate_threshold)
+        if (self._probing or self._failures >= self.failure_threshold or
+                error_rate_exceeded):
+            self._open()
+
+    def _open(self):
+        logger.warning(
+            'circuit opened: p50=%s p95=%s error_rate=%.2f',
+            self.percentile(0.5), self.percentile(0.95), self.error_rate)
+        self._opened_at = time.monotonic()
+        self._probing = False
+        self._failures = 0
+        self._results.clear()
+
+
+upstream_health = UpstreamHealth()
+
+
+class Profiler:
+    """起動1回分の処理時間とメモリ使用量を計測するクラス.
+
+    cProfileの計測結果はラベル毎に分けて持つ。フェッチ手順 (steps) と解析処理は
+    Fetcherのクラス名のラベルに、それ以外 (S3・SQS・HTTPのI/Oや待ち時間) は
+    'entry'に計上する。cProfileはスレッド毎に動くので、スレッド毎に計測して
+    結果を出力するときにまとめる。
+    tracemallocのスナップショットは指定した計測点でだけ取得する。
+    - 'start': 起動開始時
+    - 'message': 各メッセージの処理開始時
+    - 'end': 起動終了時
+    """
+
+    # メモリレポートに出力する割り当て元の件数
+    TOP_ALLOCATIONS = 30
+
+    def __init__(self, enabled=False, snapshot_points=()):
+        """コンストラクタ.
+
+        Arguments:
+            enabled {bool} -- 計測するかどうか
+            snapshot_points {iterable(str)} -- スナップショットを取得する計測点
+        """
+        self.enabled = enabled
+        self.snapshot_points = frozenset(snapshot_points)
+        self._profiles = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._first_snapshot = None
+        self._memory_report = []
+
+    @contextmanager
+    def run(self, bucket, prefix):
+        """起動全体を計測し、終了時に結果をS3に保存する.
+
+        保存に失敗しても起動自体は失敗させない。
+
+        Arguments:
+            bucket {str} -- 保存先バケット名
+            prefix {str} -- 保存先キーのプレフィックス
+        """
+        if not self.enabled:
+            yield
+            return
+
+        if self.snapshot_points:
+            tracemalloc.start()
+        self.snapshot('start')
+        try:
+            with self.section('entry'):
+                yield
+        finally:
+            self.snapshot('end')
+            tracemalloc.stop()
+            try:
+                self.upload(bucket, prefix)
+            except Exception as e:
+                logger.error(f'failed to upload profile: {e}')
+
+    @contextmanager
+    def section(self, label):
+        """処理時間をlabelに計上する.
+
+        入れ子にした場合、内側の区間の時間は外側のラベルには含めない。
+
+        Arguments:
+            label {str} -- ラベル
+        """
+        if not self.enabled:
+            yield
+            return
+
+        outer = getattr(self._local, 'profile', None)
+        key = (label, threading.get_ident())
+        with self._lock:
+            profile = self._profiles.setdefault(key, cProfile.Profile())
+        if outer is not None:
+            outer.disable()
+        self._local.profile = profile
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._local.profile = outer
+            if outer is not None:
+                outer.enable()
+
+    def call(self, label, func, *args):
+        """関数を呼び出し、その処理時間をlabelに計上する.
+
+        Arguments:
+            label {str} -- ラベル
+            func {callable} -- 関数
+            args {list} -- 関数の引数
+
+        Returns:
+            object -- 関数の戻り値
+        """
+        with self.section(label):
+            return func(*args)
+
+    def profile_steps(self, label, steps):
+        """フェッチ手順の処理時間をlabelに計上するようにする.
+
+        Arguments:
+            label {str} -- ラベル
+            steps {generator} -- Fetcher.steps()のジェネレーター
+
+        Returns:
+            generator -- stepsと同じI/O要求をyieldするジェネレーター
+        """
+        if not self.enabled:
+            return steps
+
+        return self._profile_steps(label, steps)
+
+    def _profile_steps(self, label, steps):
+        try:
+            with self.section(label):
+                request = next(steps)
+            while True:
+                if request[0] == 'parse':
+                    # executorのスレッドで実行される解析処理も計上する
+                    request = ('parse', self.call, label, *request[1:])
+                response = yield request
+                with self.section(label):
+                    request = steps.send(response)
+        except StopIteration as e:
+            return e.value
+
+    def snapshot(self, point):
+        """計測点でメモリ使用量のスナップショットを取得する.
+
+        最初のスナップショットからの増加分をレポートに追記する。
+
+        Arguments:
+            point {str} -- 計測点
+        """
+        if (not self.enabled or point not in self.snapshot_points or
+                not tracemalloc.is_tracing()):
+            return
+
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__)])
+        (current, peak) = tracemalloc.get_traced_memory()
+        lines = [
+            f'## {point} ({datetime.now(timezone.utc).isoformat()})',
+            f'current={current} peak={peak}']
+        if self._first_snapshot is None:
+            self._first_snapshot = snapshot
+            stats = snapshot.statistics('lineno')
+        else:
+            stats = snapshot.compare_to(self._first_snapshot, 'lineno')
+        lines.extend(str(x) for x in stats[:self.TOP_ALLOCATIONS])
+        self._memory_report.append('\n'.join(lines) + '\n')
+
+    def report(self):
+        """計測結果を出力する.
+
+        Returns:
+            dict -- ファイル名と内容。ラベル毎の'{label}.pstats' (pstatsで
+                読み込める形式) と、メモリレポート'memory.txt'
+        """
+        labels = {}
+        with self._lock:
+            for ((label, _), profile) in self._profiles.items():
+                labels.setdefault(label, []).append(profile)
+
+        result = {}
+        for (label, profiles) in labels.items():
+            stats = pstats.Stats(*profiles)
+            result[f'{label}.pstats'] = marshal.dumps(stats.stats)
+        if self._memory_report:
+            result['memory.txt'] = '\n'.join(
+                self._memory_report).encode('utf-8')
+        return result
+
+    def upload(self, bucket, prefix):
+        """計測結果をS3に保存する.
+
+        Arguments:
+            bucket {str} -- 保存先バケット名
+            prefix {str} -- 保存先キーのプレフィックス
+        """
+        s3 = boto3.client('s3')
+        for (name, body) in self.report().items():
+            s3.put_object(Bucket=bucket, Key=f'{prefix}{name}', Body=body)
+        logger.info(f'profile uploaded: s3://{bucket}/{prefix}')
+
+
+profiler = Profiler()
+
+
+class MessageJournal:
+    """メッセージ1件分のクロールジャーナルの記録.
+
+    以前の起動から再生した記録とこの起動で追記した記録をまとめて持つ。
+    タスクはメッセージ内の位置で識別する。
+    sinceは最初に記録された時刻で、まとめ直しても変わらない (再生期間の判定用)。
+    """
+
+    __slots__ = (
+        'message_id', 'results', 'sent', 'enqueued', 'acked', 'since',
+        '_journal')
+
+    # 失敗の種類と、再生するときに作り直す例外
+    ERRORS = {
+        x.category: x
+        for x in (TransientFetchError, PermanentFetchError, ParseError)}
+
+    def __init__(self, message_id, journal=None):
+        """コンストラクタ.
+
+        Arguments:
+            message_id {str} -- メッセージID
+            journal {CrawlJournal} -- 追記先 (Noneなら記録しない)
+        """
+        self.message_id = message_id
+        self.results = {}
+        self.sent = set()
+        self.enqueued = False
+        self.acked = False
+        self.since = None
+        self._journal = journal
+
+    @property
+    def completed(self):
+        """次のタスクの登録またはメッセージの削除まで終えているかどうか."""
+        return self.enqueued or self.acked
+
+    def apply(self, event, args):
+        """記録を反映する.
+
+        Arguments:
+            event {str} -- 記録の種類
+            args {list} -- 記録の内容
+        """
+        if event == 'stored':
+            (index, uris) = args
+            self.results[index] = ('stored', uris)
+        elif event == 'failed':
+            (index, category, message) = args
+            self.results[index] = ('failed', category, message)
+        elif event == 'sent':
+            self.sent.add(args[0])
+        elif event == 'enqueued':
+            self.enqueued = True
+        elif event == 'ack':
+            self.acked = True
+        elif event == 'since':
+            self.set_since(datetime.fromisoformat(args[0]))
+
+    def set_since(self, since):
+        """最初に記録された時刻を設定する (より古い時刻を優先する).
+
+        Arguments:
+            since {datetime} -- 記録された時刻
+        """
+        if self.since is None or since < self.since:
+            self.since = since
+
+    def dump(self):
+        """記録を再生できる行に書き直す.
+
+        Returns:
+            generator(list) -- ジャーナルの行 ([記録の種類, メッセージID, 内容])
+        """
+        if self.since is not None:
+            yield ['since', self.message_id, self.since.isoformat()]
+        for (index, result) in sorted(self.results.items()):
+            yield [result[0], self.message_id, index, *result[1:]]
+        for key in sorted(self.sent):
+            yield ['sent', self.message_id, key]
+        if self.enqueued:
+            yield ['enqueued', self.message_id]
+
+    def _append(self, event, *args):
+        self.apply(event, args)
+        if self._journal is not None:
+            self._journal.append(event, self.message_id, *args)
+
+    def start(self, index):
+        """タスクの開始を記録する.
+
+        Arguments:
+            index {int} -- タスクの位置
+        """
+        self._append('start', index)
+
+    def stored(self, index, uris):
+        """フェッチ結果 (S3への格納) を記録する.
+
+        Arguments:
+            index {int} -- タスクの位置
+            uris {list(str)} -- 次に処理するURIリスト
+        """
+        self._append('stored', index, uris)
+
+    def failed(self, index, error):
+        """フェッチ失敗を記録する.
+
+        サーキットが開いていてアクセスしなかった分は記録しない (再生時に試行する)。
+
+        Arguments:
+            index {int} -- タスクの位置
+            error {Exception} -- 発生した例外
+        """
+        if not isinstance(error, CircuitOpenError):
+            self._append('failed', index, classify_error(error), str(error))
+
+    def add_sent(self, key):
+        """次のタスクの登録単位の登録を記録する.
+
+        Arguments:
+            key {str} -- 登録単位のキー
+        """
+        self._append('sent', key)
+
+    def set_enqueued(self):
+        """次のタスクをすべて登録したことを記録する."""
+        self._append('enqueued')
+
+    def ack(self):
+        """メッセージの削除を記録する."""
+        self._append('ack')
+
+    def replay(self, index, task, outcomes):
+        """記録済みのフェッチ結果をoutcomesに反映する.
+
+        Arguments:
+            index {int} -- タスクの位置
+            task {CrawlTask} -- タスク
+            outcomes {TaskOutcomes} -- 反映先
+
+        Returns:
+            bool -- 記録済みだった場合はTrue
+        """
+        result = self.results.get(index)
+        if result is None:
+            return False
+
+        if result[0] == 'stored':
+            outcomes.add_result(task, result[1])
+        else:
+            error_type = self.ERRORS.get(result[1], TransientFetchError)
+            outcomes.add_error(task, error_type(result[2]))
+        return True
+
+
+class CrawlJournal:
+    """処理の経過を追記していくクロールジャーナル.
+
+    メッセージ毎に、タスクの開始 (start)、フェッチ結果のS3への格納 (stored)
+    または失敗 (failed)、次のタスクの登録単位毎の登録 (sent)、全登録の完了
+    (enqueued)、メッセージの削除 (ack) を1行1件のJSONでローカルファイルに
+    追記し、JOURNAL_FLUSH_SECONDS毎にS3へ書き出す。
+    書き出すたびにローカルファイルを切り替え、前回からの追記分だけを
+    別のオブジェクトとして書き出す。
+    起動時には直近のジャーナルを再生し、タイムアウトなどで再配信された
+    メッセージは、完了済みのタスクをフェッチし直さず、未登録の次のタスクだけを
+    登録する。メッセージは再配信でも変わらないSQSのメッセージIDで識別する。
+    再生したジャーナルは削除済みのメッセージを除いて1つにまとめ直し、
+    起動毎に読むオブジェクトが増え続けないようにする。
+    前回の起動がS3に書き出せずに終わった分は、ウォームスタートであれば
+    ローカルファイルから書き出してから再生する。
+    """
+
+    def __init__(self, bucket=None, prefix='', directory=JOURNAL_DIR):
+        """コンストラクタ.
+
+        Arguments:
+            bucket {str} -- 保存先バケット名 (Noneなら無効)
+            prefix {str} -- 保存先キーのプレフィックス
+            directory {str} -- ローカルファイルの保存先ディレクトリ
+        """
+        self.bucket = bucket
+        self.prefix = prefix
+        self.directory = os.path.join(directory, prefix)
+        self._records = {}
+        self._file = None
+        self._name = None
+        self._sequence = 0
+        self._pending = []
+        self._flushed = 0
+        self._upload_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        """記録するかどうか."""
+        return self.bucket is not None
+
+    def open(self):
+        """以前のジャーナルを再生してまとめ直し、この起動のジャーナルを開く."""
+        s3 = boto3.client('s3')
+        os.makedirs(self.directory, exist_ok=True)
+        for name in os.listdir(self.directory):
+            # 前回の起動が書き出せなかった分
+            path = os.path.join(self.directory, name)
+            with open(path, 'rb') as f:
+                s3.put_object(
+                    Bucket=self.bucket, Key=f'{self.prefix}{name}',
+                    Body=f.read())
+            os.remove(path)
+
+        limit = datetime.now(timezone.utc) - timedelta(
+            seconds=JOURNAL_REPLAY_SECONDS)
+        replayed = []
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for x in page.get('Contents', []):
+                if x['LastModified'] < limit:
+                    s3.delete_object(Bucket=self.bucket, Key=x['Key'])
+                    continue
+                response = s3.get_object(Bucket=self.bucket, Key=x['Key'])
+                self.replay(response['Body'].read(), x['LastModified'])
+                replayed.append(x['Key'])
+
+        # 削除済みのメッセージと再生期間を過ぎた記録は引き継がない
+        self._records = {
+            k: v for (k, v) in self._records.items()
+            if not v.acked and v.since >= limit}
+        self._name = uuid.uuid4().hex
+        self._open_file()
+        for record in self._records.values():
+            for line in record.dump():
+                self.append(*line)
+        if self.flush(force=True):
+            for key in replayed:
+                s3.delete_object(Bucket=self.bucket, Key=key)
+        logger.info(f'crawl journal: {len(self._records)} messages replayed')
+
+    def _open_file(self):
+        """追記先のローカルファイルを開く."""
+        self._sequence += 1
+        path = os.path.join(
+            self.directory, f'{self._name}-{self._sequence:05}.jsonl')
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def replay(self, content, since):
+        """ジャーナルの内容を再生する.
+
+        書きかけで終わった行は読み飛ばす。
+
+        Arguments:
+            content {bytes} -- ジャーナルの内容
+            since {datetime} -- ジャーナルが書き出された時刻
+        """
+        for line in content.splitlines():
+            try:
+                (event, message_id, *args) = json.loads(line)
+                record = self._get(message_id)
+                record.apply(event, args)
+                record.set_since(since)
+            except (ValueError, TypeError) as e:
+                logger.warning(f'invalid journal line: {e}')
+
+    def get_record(self, message_id):
+        """メッセージの記録を取得する.
+
+        Arguments:
+            message_id {str} -- メッセージID
+
+        Returns:
+            MessageJournal -- 記録。無効な場合は何も記録しない空の記録
+        """
+        if not self.enabled or message_id is None:
+            return MessageJournal(message_id)
+
+        return self._get(message_id)
+
+    def _get(self, message_id):
+        record = self._records.get(message_id)
+        if record is None:
+            record = MessageJournal(message_id, self)
+            self._records[message_id] = record
+        return record
+
+    def append(self, event, message_id, *args):
+        """記録を追記する.
+
+        Arguments:
+            event {str} -- 記録の種類
+            message_id {str} -- メッセージID
+            args {list} -- 記録の内容
+        """
+        if self._file is None:
+            return
+
+        try:
+            self._file.write(
+                json.dumps([event, message_id, *args], ensure_ascii=False) +
+                '\n')
+        except OSError as e:
+            logger.error(f'failed to write crawl journal: {e}')
+
+    def _take(self, force):
+        """追記分のローカルファイルを閉じ、次のファイルに切り替える.
+
+        Arguments:
+            force {bool} -- 前回から間隔が空いていなくても切り替えるかどうか
+
+        Returns:
+            bool -- 書き出す場合はTrue
+        """
+        if self._file is None or not force and (
+                time.monotonic() - self._flushed < JOURNAL_FLUSH_SECONDS):
+            return False
+
+        self._flushed = time.monotonic()
+        try:
+            if self._file.tell():
+                self._file.close()
+                self._pending.append(self._file.name)
+                self._open_file()
+        except OSError as e:
+            logger.error(f'failed to rotate crawl journal: {e}')
+        return True
+
+    def _upload(self):
+        """書き出していない追記分をS3に書き出す.
+
+        書き出せたローカルファイルは削除し、書き出せなかった分は次回に回す。
+
+        Returns:
+            bool -- すべて書き出せた場合はTrue
+        """
+        # 非同期エンジンではexecutorから並行に呼ばれるので同時に書き出さない
+        if not self._upload_lock.acquire(blocking=False):
+            return False
+
+        try:
+            s3 = boto3.client('s3')
+            while self._pending:
+                path = self._pending[0]
+                with open(path, 'rb') as f:
+                    s3.put_object(
+                        Bucket=self.bucket,
+                        Key=f'{self.prefix}{os.path.basename(path)}',
+                        Body=f.read())
+                os.remove(path)
+                self._pending.pop(0)
+            return True
+        except Exception as e:
+            logger.error(f'failed to upload crawl journal: {e}')
+            return False
+        finally:
+            self._upload_lock.release()
+
+    def flush(self, force=False):
+        """前回からJOURNAL_FLUSH_SECONDS経っていればS3に書き出す.
+
+        Arguments:
+            force {bool} -- 間隔が空いていなくても書き出すかどうか
+
+        Returns:
+            bool -- 書き出せた場合はTrue
+        """
+        return self._take(force) and self._upload()
+
+    async def flush_async(self):
+        """前回からJOURNAL_FLUSH_SECONDS経っていればS3に書き出す (非同期版).
+
+        S3への書き出しはexecutorで行う。
+        """
+        if self._take(False):
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self._upload)
+
+    def close(self):
+        """S3に書き出してジャーナルを閉じる.
+
+        書き出せなかった分のローカルファイルは次の起動で書き出す。
+        """
+        if self._file is None:
+            return
+
+        self.flush(force=True)
+        empty = not self._file.tell()
+        self._file.close()
+        if empty:
+            # 切り替え後の空のファイルは残さない
+            os.remove(self._file.name)
+        self._file = None
+
+
+crawl_journal = CrawlJournal()
+
+
+def use_crawl_journal(bucket_name, queue_name):
+    """起動1回分のクロールジャーナルを用意する.
+
+    ジャーナルを開けなければ記録せずに続ける。
+
+    Arguments:
+        bucket_name {str} -- 保存先バケット名 (Noneなら記録しない)
+        queue_name {str} -- 受信するキュー名
+
+    Returns:
+        CrawlJournal -- クロールジャーナル
+    """
+    global crawl_journal
+    crawl_journal = CrawlJournal()
+    if bucket_name is None:
+        return crawl_journal
+
+    journal = CrawlJournal(bucket_name, f'journal/{queue_name}/')
+    try:
+        journal.open()
+    except Exception as e:
+        logger.error(f'failed to open crawl journal: {e}')
+        return crawl_journal
+
+    crawl_journal = journal
+    return journal
+
+
+def use_profiler(enabled, snapshot_points=()):
+    """起動1回分のプロファイラーを用意する.
+
+    ウォームスタートでも前回の計測結果は引き継がない。
+
+    Arguments:
+        enabled {bool} -- 計測するかどうか
+        snapshot_points {iterable(str)} -- スナップショットを取得する計測点
+
+    Returns:
+        Profiler -- プロファイラー
+    """
+    global profiler
+    profiler = Profiler(enabled, snapshot_points)
+    return profiler
+
+
+def is_queue_idle(queue_name):
+    """キューに処理中・処理待ちのメッセージが無いかどうかを返す.
+
+    Arguments:
+        queue_name {str} -- キュー名
+
+    Returns:
+        bool -- メッセージが無ければTrue
+    """
+    sqs = boto3.resource('sqs')
+    queue = sqs.get_queue_by_name(QueueName=queue_name)
+    names = [
+        'ApproximateNumberOfMessages',
+        'ApproximateNumberOfMessagesNotVisible',
+        'ApproximateNumberOfMessagesDelayed']
+    return all(int(queue.attributes.get(x, 0)) == 0 for x in names)
+
+
+def get_calendar_uris(nowtime, days_back, days_forward):
+    """取得範囲に含まれる月のカレンダーURIを取得する.
+
+    Arguments:
+        nowtime {datetime} -- 開始時刻
+        days_back {int} -- 過去方向の日数
+        days_forward {int} -- 未来方向の日数
+
+    Returns:
+        list(str) -- カレンダーURIのリスト (古い月から順)
+    """
+    first = (nowtime - timedelta(days=days_back)).date().replace(day=1)
+    last = (nowtime + timedelta(days=days_forward)).date()
+    urlbase = 'https://www.jbis.or.jp/race/calendar/'
+
+    uris = []
+    month = first
+    while month <= last:
+        uris.append(urlbase + f'?year={month.year:04}&month={month.month:02}')
+        month += relativedelta(months=1)
+
+    return uris
+
+
+def add_calendar_message(queue_names, nowtime, days_back=7, days_forward=7):
+    """カレンダー取得メッセージを登録する.
+
+    月毎のカレンダーを複数のキューに振り分けて登録し、
+    別々の起動で並列にクロールできるようにする。
+
+    Arguments:
+        queue_names {list(str)} -- 登録先キュー名のリスト
+        nowtime {datetime} -- 開始時刻
+        days_back {int} -- 過去方向の日数
+        days_forward {int} -- 未来方向の日数
+    """
+    uris = get_calendar_uris(nowtime, days_back, days_forward)
+
+    sqs = boto3.resource('sqs')
+    for (i, queue_name) in enumerate(queue_names):
+        shard = uris[i::len(queue_names)]
+        if shard:
+            queue = sqs.get_queue_by_name(QueueName=queue_name)
+            send_tasks(queue, (CrawlTask.from_uri(x) for x in shard))
+
+
+def fetch(uri, referer, bucket, nowtime):
+    """フェッチを行う.
+
+    Arguments:
+        uri {str} -- フェッチ先URI
+        referer {str} -- 参照元URI
+        bucket {str} -- バケット名
+        nowtime {datetime} -- 現時刻
+
+    Returns:
+        list(str) -- 次に処理するURIリスト
+    """
+    logger.info(f'fetching: {uri}')
+    fetcher = get_fetcher(uri, referer)
+    uris = fetcher.fetch(bucket, nowtime)
+    logger.info(f'fetching: next_uris: {uris}')
+    return uris
 
 
-def fetch(uri, referer, bucket, nowtime):
-    """フェッチを行う.
+async def fetch_async(uri, referer, bucket, nowtime, aio):
+    """非同期I/Oでフェッチを行う.
 
     Arguments:
         uri {str} -- フェッチ先URI
         referer {str} -- 参照元URI
         bucket {str} -- バケット名
         nowtime {datetime} -- 現時刻
+        aio {AsyncIo} -- 非同期I/O
 
     Returns:
         list(str) -- 次に処理するURIリスト
     """
     logger.info(f'fetching: {uri}')
     fetcher = get_fetcher(uri, referer)
-    uris = fetcher.fetch(bucket, nowtime)
+    uris = await fetcher.fetch_async(bucket, nowtime, aio)
     logger.info(f'fetching: next_uris: {uris}')
     return uris
 
 
 class Fetcher(metaclass=ABCMeta):
-    """フェッチ用抽象クラス."""
+    """フェッチ用抽象クラス.
+
+    フェッチ手順はI/O要求をyieldするジェネレーター (steps) として記述し、
+    同期I/O (fetch) と非同期I/O (fetch_async) のどちらでも実行できるようにする。
+    I/O要求は (操作名, 引数...) のタプルで、操作名は以下のいずれか。
+    - 'get_s3_object': (bucket, key) -> S3オブジェクトの情報またはNone
+    - 'read_s3_object': (summary,) -> bytes
+    - 'fetch_to_s3': (uri, bucket, key) -> bytes
+    - 'parse': (func, args...) -> func(*args)の結果 (CPU処理)
+    """
 
     @abstractmethod
+    def steps(self, bucket: str, nowtime: datetime):
+        """フェッチ手順.
+
+        Arguments:
+            bucket {str} -- 格納先バケット名
+            nowtime {datetime} -- 現時刻
+
+        Returns:
+            generator -- I/O要求をyieldし、次に処理するURIリストを返すジェネレーター
+        """
+        raise NotImplementedError()
+
     def fetch(self, bucket: str, nowtime: datetime):
         """フェッチ処理.
 
@@ -131,7 +2872,47 @@ class Fetcher(metaclass=ABCMeta):
         Returns:
             list(str) -- 次に処理するURIリスト
         """
-        raise NotImplementedError()
+        return run_steps(profiler.profile_steps(
+            type(self).__name__, self.steps(bucket, nowtime)))
+
+    async def fetch_async(self, bucket: str, nowtime: datetime, aio):
+        """非同期I/Oでのフェッチ処理.
+
+        Arguments:
+            bucket {str} -- 格納先バケット名
+            nowtime {datetime} -- 現時刻
+            aio {AsyncIo} -- 非同期I/O
+
+        Returns:
+            list(str) -- 次に処理するURIリスト
+        """
+        return await aio.run_steps(profiler.profile_steps(
+            type(self).__name__, self.steps(bucket, nowtime)))
+
+
+def run_steps(steps):
+    """フェッチ手順を同期I/Oで実行する.
+
+    Arguments:
+        steps {generator} -- Fetcher.steps()のジェネレーター
+
+    Returns:
+        list(str) -- 次に処理するURIリスト
+    """
+    operations = {
+        'get_s3_object': get_s3_object,
+        'read_s3_object': read_s3_object,
+        'fetch_to_s3': fetch_to_s3,
+        'parse': lambda func, *args: func(*args),
+    }
+
+    try:
+        request = next(steps)
+        while True:
+            (name, *args) = request
+            request = steps.send(operations[name](*args))
+    except StopIteration as e:
+        return e.value
 
 
 def get_horse_record_uri(uri: str) -> str:
@@ -200,6 +2981,28 @@ def get_s3_object(bucket, key):
     return result
 
 
+def read_s3_object(summary):
+    """S3オブジェクトの内容を取得する.
+
+    ETagが一致するものがディスクキャッシュにあればS3から取得しない。
+
+    Arguments:
+        summary {S3.ObjectSummary} -- オブジェクトの情報
+
+    Returns:
+        bytes -- オブジェクトの内容 (キャッシュからはmmap)
+    """
+    content = disk_cache.get(summary.bucket_name, summary.key, summary.e_tag)
+    if content is not None:
+        return content
+
+    response = summary.get()
+    content = response['Body'].read()
+    disk_cache.put(
+        summary.bucket_name, summary.key, response.get('ETag'), content)
+    return content
+
+
 def fetch_to_s3(uri, bucket, key):
     """URI指定されたコンテンツをs3に取得する.
 
@@ -208,45 +3011,748 @@ def fetch_to_s3(uri, bucket, key):
         bucket {str} -- 保存バケット名
         key {str} -- 保存キー名
 
+    本文は読み込みながらS3への保存とHTMLの解析を同時に行い、
+    ページ全体を1つのbytesとして保持しない。
+
     Returns:
-        bytes -- 取得したコンテンツ
+        Element -- 解析したHTML文書
+
+    Raises:
+        TransientFetchError: 再試行で回復しうる失敗 (check_status()参照)
+        PermanentFetchError: 再試行しても回復しない失敗 (check_status()参照)
     """
-    time.sleep(1)
-    response = requests.get(uri, timeout=10)
-    if response.status_code != 200:
-        logger.error(f'http status code={response.status_code} : {uri}')
-        return None
+    if not upstream_health.allow():
+        raise CircuitOpenError(f'circuit open : {uri}')
+
+    probing = upstream_health.probing
+    recorded = False
+    try:
+        rate_limiter.wait(urlparse(uri).netloc)
+        upstream_health.wait()
+        start = time.monotonic()
+        try:
+            response = requests.get(
+                uri, timeout=upstream_health.timeout, stream=True)
+            with response:
+                status = response.status_code
+                document = None
+                if status == 200:
+                    document = stream_to_s3(
+                        response.iter_content(STREAM_CHUNK_SIZE), bucket, key)
+        except requests.RequestException:
+            recorded = True
+            upstream_health.record(time.monotonic() - start, False)
+            raise
+
+        recorded = True
+        upstream_health.record(
+            time.monotonic() - start, status < 500 and status != 429)
+    finally:
+        # 結果を記録せずに中断した試行で半開状態が残らないようにする
+        if probing and not recorded:
+            upstream_health.release_probe()
+
+    check_status(status, uri)
+    return document
+
+
+def stream_to_s3(chunks, bucket, key):
+    """本文を読みながらS3への保存とHTMLの解析を同時に行う.
 
-    content = response.content
-    s3 = boto3.resource('s3')
-    s3.Bucket(bucket).put_object(Key=key, Body=content)
-    return content
+    Arguments:
+        chunks {iterable(bytes)} -- 本文の断片
+        bucket {str} -- 保存バケット名
+        key {str} -- 保存キー名
+
+    Returns:
+        Element -- 解析したHTML文書
+    """
+    parser = etree.HTMLParser()
+    upload = S3UploadStream(boto3.client('s3'), bucket, key)
+    cache = disk_cache.open_writer(bucket, key)
+    try:
+        for chunk in chunks:
+            upload.write(chunk)
+            cache.write(chunk)
+            parser.feed(chunk)
+        cache.commit(upload.close())
+    except BaseException:
+        cache.discard()
+        upload.abort()
+        raise
+
+    return close_html_parser(parser)
+
+
+def parse_html(content):
+    """HTMLを解析する.
 
+    Arguments:
+        content {bytes} -- コンテンツ (解析済みの文書ならそのまま返す)
+
+    Returns:
+        Element -- 解析したHTML文書
+    """
+    if etree.iselement(content):
+        return content
 
-def is_fetch_target_race_result(uri, now):
-    """レース結果のuriがフェッチ対象ならTrueを返す.
+    parser = etree.HTMLParser()
+    if isinstance(content, bytes):
+        parser.feed(content)
+    else:
+        # mmapは全体をbytesにコピーせずに少しずつ与える
+        for i in range(0, len(content), STREAM_CHUNK_SIZE):
+            parser.feed(content[i:i + STREAM_CHUNK_SIZE])
+    return close_html_parser(parser)
+
+
+def close_html_parser(parser):
+    """逐次解析を終えて文書を取得する.
 
     Arguments:
-        uri {str} -- 判定対象のURI
-        now {str} -- 処理開始時の時刻.
+        parser {HTMLParser} -- 本文を与え終えたパーサー
 
     Returns:
-        bool -- レース結果のURIがフェッチ対象かどうか
+        Element -- 解析したHTML文書 (本文が空なら空のhtml要素)
     """
-    result = False
+    try:
+        root = parser.close()
+    except etree.XMLSyntaxError:
+        root = None
 
-    path = urlparse(uri).path
-    m = re.fullmatch(r'/race/result/(\d{4})(\d{2})(\d{2})/\d{3}/\d{2}/', path)
+    return etree.Element('html') if root is None else root
 
-    if m:
-        uridate = datetime(
-            int(m.group(1)), int(m.group(2)), int(m.group(3)),
-            tzinfo=timezone.utc)
-        delta = relativedelta(year=2)
 
-        result = ((now - delta) <= uridate)
+def get_string(element):
+    """要素が含む唯一の文字列を取得する.
 
-    return result
+    子要素を1つだけ含む場合はその子要素の文字列を返す。
+
+    Arguments:
+        element {Element} -- 要素
+
+    Returns:
+        str -- 文字列。文字列が1つに定まらなければNone
+    """
+    children = list(element)
+    if not children:
+        return element.text
+    if len(children) == 1 and not element.text and not children[0].tail:
+        return get_string(children[0])
+    return None
+
+
+class S3UploadStream:
+    """S3に分割してアップロードする書き込みストリーム.
+
+    本文はメモリ上に溜めずに一時ファイルへ書き、ファイルから送る
+    (ページ全体のbytesを作らない)。
+    MIN_PART_SIZE分たまるたびにマルチパートアップロードのパートとして送る。
+    全体がMIN_PART_SIZEに満たなければput_objectでまとめて保存する。
+    """
+
+    def __init__(self, s3, bucket, key):
+        """コンストラクタ.
+
+        Arguments:
+            s3 {S3.Client} -- S3クライアント
+            bucket {str} -- 保存バケット名
+            key {str} -- 保存キー名
+        """
+        self._s3 = s3
+        self._bucket = bucket
+        self._key = key
+        self._buffer = tempfile.TemporaryFile()
+        self._size = 0
+        self._upload_id = None
+        self._parts = []
+
+    def write(self, chunk):
+        """本文の断片を書き込む.
+
+        Arguments:
+            chunk {bytes} -- 本文の断片
+        """
+        self._buffer.write(chunk)
+        self._size += len(chunk)
+        if self._size >= MIN_PART_SIZE:
+            self._upload_part()
+
+    def close(self):
+        """残りを送ってアップロードを完了する.
+
+        Returns:
+            str -- 保存したオブジェクトのETag
+        """
+        try:
+            if self._upload_id is None:
+                response = self._s3.put_object(
+                    Bucket=self._bucket, Key=self._key, Body=self._rewind())
+                return response['ETag']
+
+            if self._size:
+                self._upload_part()
+            response = self._s3.complete_multipart_upload(
+                Bucket=self._bucket, Key=self._key, UploadId=self._upload_id,
+                MultipartUpload={'Parts': self._parts})
+            return response['ETag']
+        finally:
+            self._buffer.close()
+
+    def abort(self):
+        """開始済みのマルチパートアップロードを中止する."""
+        self._buffer.close()
+        if self._upload_id is not None:
+            self._s3.abort_multipart_upload(
+                Bucket=self._bucket, Key=self._key, UploadId=self._upload_id)
+            self._upload_id = None
+
+    def _rewind(self):
+        # 書き込んだ分を先頭から読めるようにしてアップロードの本文にする
+        self._buffer.seek(0)
+        return self._buffer
+
+    def _clear(self):
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._size = 0
+
+    def _upload_part(self):
+        if self._upload_id is None:
+            response = self._s3.create_multipart_upload(
+                Bucket=self._bucket, Key=self._key)
+            self._upload_id = response['UploadId']
+
+        number = len(self._parts) + 1
+        response = self._s3.upload_part(
+            Bucket=self._bucket, Key=self._key, UploadId=self._upload_id,
+            PartNumber=number, Body=self._rewind())
+        self._parts.append({'ETag': response['ETag'], 'PartNumber': number})
+        self._clear()
+
+
+class AsyncS3UploadStream(S3UploadStream):
+    """aiobotocoreのクライアントでS3に分割してアップロードする書き込みストリーム."""
+
+    async def write(self, chunk):
+        """本文の断片を書き込む.
+
+        Arguments:
+            chunk {bytes} -- 本文の断片
+        """
+        self._buffer.write(chunk)
+        self._size += len(chunk)
+        if self._size >= MIN_PART_SIZE:
+            await self._upload_part()
+
+    async def close(self):
+        """残りを送ってアップロードを完了する.
+
+        Returns:
+            str -- 保存したオブジェクトのETag
+        """
+        try:
+            if self._upload_id is None:
+                response = await self._s3.put_object(
+                    Bucket=self._bucket, Key=self._key, Body=self._rewind())
+                return response['ETag']
+
+            if self._size:
+                await self._upload_part()
+            response = await self._s3.complete_multipart_upload(
+                Bucket=self._bucket, Key=self._key, UploadId=self._upload_id,
+                MultipartUpload={'Parts': self._parts})
+            return response['ETag']
+        finally:
+            self._buffer.close()
+
+    async def abort(self):
+        """開始済みのマルチパートアップロードを中止する."""
+        self._buffer.close()
+        if self._upload_id is not None:
+            await self._s3.abort_multipart_upload(
+                Bucket=self._bucket, Key=self._key, UploadId=self._upload_id)
+            self._upload_id = None
+
+    async def _upload_part(self):
+        if self._upload_id is None:
+            response = await self._s3.create_multipart_upload(
+                Bucket=self._bucket, Key=self._key)
+            self._upload_id = response['UploadId']
+
+        number = len(self._parts) + 1
+        response = await self._s3.upload_part(
+            Bucket=self._bucket, Key=self._key, UploadId=self._upload_id,
+            PartNumber=number, Body=self._rewind())
+        self._parts.append({'ETag': response['ETag'], 'PartNumber': number})
+        self._clear()
+
+
+def check_status(status, uri):
+    """HTTPステータスが成功でなければ失敗の種類に応じた例外を送出する.
+
+    Arguments:
+        status {int} -- HTTPステータスコード
+        uri {str} -- 取得先URI
+
+    Raises:
+        TransientFetchError: 5xx・408・429など再試行で回復しうるステータス
+        PermanentFetchError: それ以外の4xxなど再試行しても回復しないステータス
+    """
+    if status == 200:
+        return
+
+    message = f'http status code={status} : {uri}'
+    if status >= 500 or status in (408, 429):
+        raise TransientFetchError(message)
+    raise PermanentFetchError(message)
+
+
+S3ObjectInfo = namedtuple(
+    'S3ObjectInfo', ['bucket_name', 'key', 'last_modified', 'e_tag'])
+
+
+class AsyncIo:
+    """非同期エンジン用のI/Oをまとめたクラス.
+
+    S3とSQSはaiobotocore、HTTPはaiohttpで扱い、解析処理はexecutorで実行する。
+    """
+
+    def __init__(self, s3, sqs, http, executor=None):
+        """コンストラクタ.
+
+        Arguments:
+            s3 {S3.Client} -- aiobotocoreのS3クライアント
+            sqs {SQS.Client} -- aiobotocoreのSQSクライアント
+            http {aiohttp.ClientSession} -- HTTPセッション
+            executor {Executor} -- 解析処理の実行先 (省略時は既定のexecutor)
+        """
+        self._s3 = s3
+        self._sqs = sqs
+        self._http = http
+        self._executor = executor
+        self._queue_urls = {}
+        self._fetching = 0
+        self._waiting = 0
+        self._fetch_slots = asyncio.Condition()
+
+    @property
+    def backlog_seconds(self):
+        """アクセス待ちのフェッチをすべて終えるまでのおおよその秒数."""
+        interval = getattr(rate_limiter, 'interval', 0)
+        return self._waiting * (interval + upstream_health.delay)
+
+    async def run_steps(self, steps):
+        """フェッチ手順を非同期I/Oで実行する.
+
+        Arguments:
+            steps {generator} -- Fetcher.steps()のジェネレーター
+
+        Returns:
+            list(str) -- 次に処理するURIリスト
+        """
+        try:
+            request = next(steps)
+            while True:
+                (name, *args) = request
+                request = steps.send(await getattr(self, name)(*args))
+        except StopIteration as e:
+            return e.value
+
+    async def get_s3_object(self, bucket, key):
+        """指定のS3オブジェクトの情報を取得する.
+
+        Arguments:
+            bucket {str} -- バケット名
+            key {str} -- キー
+
+        Returns:
+            S3ObjectInfo -- オブジェクトの情報。指定オブジェクトが無い場合はNone
+        """
+        response = await self._s3.list_objects_v2(Bucket=bucket, Prefix=key)
+        for x in response.get('Contents', []):
+            if x['Key'] == key:
+                return S3ObjectInfo(bucket, key, x['LastModified'], x['ETag'])
+
+        return None
+
+    async def read_s3_object(self, summary):
+        """S3オブジェクトの内容を取得する.
+
+        Arguments:
+            summary {S3ObjectInfo} -- オブジェクトの情報
+
+        Returns:
+            bytes -- オブジェクトの内容 (キャッシュからはmmap)
+        """
+        content = disk_cache.get(
+            summary.bucket_name, summary.key, summary.e_tag)
+        if content is not None:
+            return content
+
+        response = await self._s3.get_object(
+            Bucket=summary.bucket_name, Key=summary.key)
+        async with response['Body'] as stream:
+            content = await stream.read()
+        disk_cache.put(
+            summary.bucket_name, summary.key, response.get('ETag'), content)
+        return content
+
+    @asynccontextmanager
+    async def _fetch_slot(self):
+        # 上流サイトの状態に応じて同時にアクセスする数を絞る
+        async with self._fetch_slots:
+            await self._fetch_slots.wait_for(
+                lambda: self._fetching < upstream_health.concurrency)
+            self._fetching += 1
+
+        try:
+            yield
+        finally:
+            async with self._fetch_slots:
+                self._fetching -= 1
+                self._fetch_slots.notify_all()
+
+    async def fetch_to_s3(self, uri, bucket, key):
+        """URI指定されたコンテンツをs3に取得する.
+
+        Arguments:
+            uri {str} -- 取得先URI
+            bucket {str} -- 保存バケット名
+            key {str} -- 保存キー名
+
+        Returns:
+            bytes -- 取得したコンテンツ
+        """
+        if upstream_health.is_open:
+            raise CircuitOpenError(f'circuit open : {uri}')
+
+        self._waiting += 1
+        waiting = True
+        try:
+            async with self._fetch_slot():
+                await rate_limiter.wait_async(urlparse(uri).netloc)
+                await upstream_health.wait_async()
+                self._waiting -= 1
+                waiting = False
+                # 待っている間にサーキットが開いていたらアクセスしない
+                if not upstream_health.allow():
+                    raise CircuitOpenError(f'circuit open : {uri}')
+
+                (status, document) = await self._get(uri, bucket, key)
+        finally:
+            if waiting:
+                self._waiting -= 1
+
+        check_status(status, uri)
+        return document
+
+    async def _get(self, uri, bucket, key):
+        """HTTPアクセスして結果を上流サイトの状態に記録する.
+
+        upstream_health.allow()で許可を得てから呼ぶ。
+        成功した場合は本文を読みながらS3への保存とHTMLの解析を同時に行う。
+
+        Arguments:
+            uri {str} -- 取得先URI
+            bucket {str} -- 保存バケット名
+            key {str} -- 保存キー名
+
+        Returns:
+            tuple(int, Element) -- ステータスコードと解析したHTML文書
+        """
+        probing = upstream_health.probing
+        timeout = aiohttp.ClientTimeout(total=upstream_health.timeout)
+        start = time.monotonic()
+        try:
+            async with self._http.get(uri, timeout=timeout) as res:
+                status = res.status
+                document = None
+                if status == 200:
+                    document = await self._stream_to_s3(
+                        res.content.iter_chunked(STREAM_CHUNK_SIZE),
+                        bucket, key)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            upstream_health.record(time.monotonic() - start, False)
+            raise
+        except BaseException:
+            # キャンセルなどで結果が分からない試行は半開状態を取り消す
+            if probing:
+                upstream_health.release_probe()
+            raise
+
+        upstream_health.record(
+            time.monotonic() - start, status < 500 and status != 429)
+        return (status, document)
+
+    async def _stream_to_s3(self, chunks, bucket, key):
+        """本文を読みながらS3への保存とHTMLの解析を同時に行う.
+
+        Arguments:
+            chunks {AsyncIterable(bytes)} -- 本文の断片
+            bucket {str} -- 保存バケット名
+            key {str} -- 保存キー名
+
+        Returns:
+            Element -- 解析したHTML文書
+        """
+        parser = etree.HTMLParser()
+        upload = AsyncS3UploadStream(self._s3, bucket, key)
+        cache = disk_cache.open_writer(bucket, key)
+        try:
+            async for chunk in chunks:
+                await upload.write(chunk)
+                cache.write(chunk)
+                parser.feed(chunk)
+            cache.commit(await upload.close())
+        except BaseException:
+            cache.discard()
+            await upload.abort()
+            raise
+
+        return close_html_parser(parser)
+
+    async def parse(self, func, *args):
+        """解析処理をexecutorで実行する.
+
+        Arguments:
+            func {callable} -- 解析処理
+            args {list} -- 解析処理の引数
+
+        Returns:
+            object -- 解析処理の結果
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def get_queue_url(self, queue_name):
+        """キューのURLを取得する.
+
+        Arguments:
+            queue_name {str} -- キュー名
+
+        Returns:
+            str -- キューのURL
+        """
+        if queue_name not in self._queue_urls:
+            response = await self._sqs.get_queue_url(QueueName=queue_name)
+            self._queue_urls[queue_name] = response['QueueUrl']
+
+        return self._queue_urls[queue_name]
+
+    async def receive_messages(self, queue_name):
+        """メッセージを受信する.
+
+        可視性タイムアウトは最初の延長までもつようにVISIBILITY_TIMEOUT_SECONDSにする。
+
+        Arguments:
+            queue_name {str} -- キュー名
+
+        Returns:
+            list(dict) -- 受信したメッセージ
+        """
+        response = await self._sqs.receive_message(
+            QueueUrl=await self.get_queue_url(queue_name),
+            MaxNumberOfMessages=10, WaitTimeSeconds=1,
+            VisibilityTimeout=VISIBILITY_TIMEOUT_SECONDS)
+        return response.get('Messages', [])
+
+    async def change_message_visibility(
+            self, queue_name, receipt_handle, timeout):
+        """メッセージの可視性タイムアウトを変更する.
+
+        Arguments:
+            queue_name {str} -- キュー名
+            receipt_handle {str} -- 受信ハンドル
+            timeout {int} -- 可視性タイムアウト秒数
+        """
+        await self._sqs.change_message_visibility(
+            QueueUrl=await self.get_queue_url(queue_name),
+            ReceiptHandle=receipt_handle, VisibilityTimeout=timeout)
+
+    async def delete_message(self, queue_name, receipt_handle):
+        """メッセージを削除する.
+
+        Arguments:
+            queue_name {str} -- キュー名
+            receipt_handle {str} -- 受信ハンドル
+        """
+        await self._sqs.delete_message(
+            QueueUrl=await self.get_queue_url(queue_name),
+            ReceiptHandle=receipt_handle)
+
+    async def send_tasks(self, queue_name, tasks, delay_seconds=0):
+        """タスクをバッチ形式のメッセージとしてキューに登録する.
+
+        Arguments:
+            queue_name {str} -- キュー名
+            tasks {iterable(CrawlTask)} -- タスク
+            delay_seconds {int} -- 配信遅延秒数
+        """
+        queue_url = await self.get_queue_url(queue_name)
+        for entries in make_send_entries(tasks, delay_seconds):
+            await self._sqs.send_message_batch(
+                QueueUrl=queue_url, Entries=entries)
+
+    async def send(self, frontier, tasks, delay_seconds=0):
+        """タスクをシャード毎に振り分けてキューに登録する.
+
+        Arguments:
+            frontier {Frontier} -- 登録先キュー群
+            tasks {iterable(CrawlTask)} -- タスク
+            delay_seconds {int} -- 配信遅延秒数
+        """
+        for (shard, group) in frontier.group_by_shard(tasks).items():
+            await self.send_tasks(
+                frontier.get_queue_name(shard), group, delay_seconds)
+
+    async def send_dead_letters(self, frontier, tasks):
+        """処理できなかったタスクをデッドレターキューに登録する.
+
+        デッドレターキューが未設定の場合はログに残して破棄する。
+
+        Arguments:
+            frontier {Frontier} -- 登録先キュー群
+            tasks {list(CrawlTask)} -- エラー内容 error を付けたタスク
+        """
+        if not tasks:
+            return
+
+        if frontier.dead_letter_queue_name is None:
+            for task in tasks:
+                logger.error(f'dropped: {task}')
+            return
+
+        await self.send_tasks(frontier.dead_letter_queue_name, tasks)
+
+    async def send_invalid_message(self, frontier, body, error):
+        """解析できなかったメッセージをデッドレターキューに登録する.
+
+        デッドレターキューが未設定の場合はログに残して破棄する。
+
+        Arguments:
+            frontier {Frontier} -- 登録先キュー群
+            body {str} -- メッセージ本文
+            error {Exception} -- 解析時に発生した例外
+        """
+        if frontier.dead_letter_queue_name is None:
+            logger.error(f'dropped: {body}')
+            return
+
+        await self._sqs.send_message(
+            QueueUrl=await self.get_queue_url(
+                frontier.dead_letter_queue_name),
+            MessageBody=make_invalid_message_body(body, error))
+
+
+# 再取得しないことを表す再取得間隔
+SKIP = 'skip'
+# 1日1回の再取得間隔 (起動間隔1時間のずれを見込んで23時間にする)
+DAILY = timedelta(hours=23)
+# 1時間毎の再取得間隔 (同じく起動時刻のずれを見込む)
+HOURLY = timedelta(minutes=50)
+
+# ページ種類毎の鮮度ポリシー
+# (期限, 再取得間隔) の規則を並べ、現時刻が「対象日+期限」より前になる
+# 最初の規則の再取得間隔を使う (期限Noneの規則は常に一致する)。
+# 再取得間隔は以下のいずれか。
+# - timedelta: 格納してからこの時間が経ったら取得し直す
+# - None: 未格納なら取得し、格納済みなら取得し直さない
+# - SKIP: 取得しない
+FRESHNESS_RULES = {
+    # 開催日が追加されていくので毎日
+    'calendar': [(None, DAILY)],
+    # 前日までは毎日、開催日は毎時、その後1か月は毎日、過去の月は取得し直さない
+    'race_list': [
+        (relativedelta(), DAILY),
+        (relativedelta(days=1), HOURLY),
+        (relativedelta(months=1), DAILY),
+        (None, None)],
+    # 前日までは毎日、開催日は毎時、その後は結果のページがあるので取得し直さない
+    'race_entry': [
+        (relativedelta(), DAILY),
+        (relativedelta(days=1), HOURLY),
+        (None, None)],
+    # 確定した結果は取得し直さない。2年より前のレースは取得しない
+    'race_result': [(relativedelta(years=2), None), (None, SKIP)],
+    # 出走の度に更新されるので毎日
+    'horse_record': [(None, DAILY)],
+}
+
+
+class FreshnessPolicy:
+    """ページ種類と対象日からページを取得し直すかどうかを判定するクラス.
+
+    規則の形式はFRESHNESS_RULESを参照。
+    """
+
+    def __init__(self, rules, default=DAILY):
+        """コンストラクタ.
+
+        Arguments:
+            rules {dict} -- ページ種類毎の規則
+            default {timedelta} -- 規則の無いページの再取得間隔
+        """
+        self.rules = rules
+        self.default = default
+
+    def get_interval(self, uri, nowtime):
+        """ページの再取得間隔を取得する.
+
+        Arguments:
+            uri {str} -- URI
+            nowtime {datetime} -- 現時刻 (タイムゾーン無しはUTCとみなす)
+
+        Returns:
+            timedelta -- 再取得間隔 (NoneまたはSKIPもある)
+        """
+        page = PageRef.from_uri(uri)
+        if page is None or page.page_type not in self.rules:
+            return self.default
+
+        if nowtime.tzinfo is None:
+            nowtime = nowtime.replace(tzinfo=timezone.utc)
+        date = page.date
+        for (until, interval) in self.rules[page.page_type]:
+            if until is None or (date is not None and nowtime < date + until):
+                return interval
+
+        return self.default
+
+    def is_fetch_target(self, uri, nowtime):
+        """ページが取得対象ならTrueを返す.
+
+        Arguments:
+            uri {str} -- URI
+            nowtime {datetime} -- 現時刻
+
+        Returns:
+            bool -- 取得対象かどうか
+        """
+        return self.get_interval(uri, nowtime) is not SKIP
+
+    def is_stale(self, uri, stored_time, nowtime):
+        """ページを取得 (し直す) 必要があればTrueを返す.
+
+        Arguments:
+            uri {str} -- URI
+            stored_time {datetime} -- 格納時刻 (未格納ならNone)
+            nowtime {datetime} -- 現時刻
+
+        Returns:
+            bool -- 取得する必要があるかどうか
+        """
+        interval = self.get_interval(uri, nowtime)
+        if interval is SKIP:
+            return False
+        if stored_time is None:
+            return True
+        if interval is None:
+            return False
+        return nowtime - stored_time > interval
+
+
+freshness_policy = FreshnessPolicy(FRESHNESS_RULES)
 
 
 class JbisCalendarFetcher(Fetcher):
@@ -260,8 +3766,8 @@ class JbisCalendarFetcher(Fetcher):
         """
         self._uri = uri
 
-    def fetch(self, bucket, nowtime):
-        """フェッチ処理.
+    def steps(self, bucket, nowtime):
+        """フェッチ手順.
 
         Arguments:
             bucket {str} -- 格納先バケット名
@@ -272,17 +3778,12 @@ class JbisCalendarFetcher(Fetcher):
         """
         uris = []
         key = self.get_s3_key()
-        summary = get_s3_object(bucket, key)
-        if summary is None:
-            # S3未格納だった場合は古い日付を設定してフェッチを発火させる
-            s3_time = datetime(2000, 1, 1, tzinfo=timezone.utc)
-        else:
-            s3_time = summary.last_modified
+        summary = yield ('get_s3_object', bucket, key)
+        s3_time = summary.last_modified if summary is not None else None
 
-        # 23時間経過を閾値にする
-        if nowtime - s3_time > timedelta(seconds=23 * 60 * 60):
-            content = fetch_to_s3(self._uri, bucket, key)
-            uris = self.get_next_uris(content)
+        if freshness_policy.is_stale(self._uri, s3_time, nowtime):
+            content = yield ('fetch_to_s3', self._uri, bucket, key)
+            uris = yield ('parse', self.get_next_uris, content)
 
         return uris
 
@@ -297,7 +3798,7 @@ class JbisCalendarFetcher(Fetcher):
         """コンテンツ内から次のURIリストを取得する.
 
         Arguments:
-            content {bytes} -- コンテンツ
+            content {bytes} -- コンテンツ (解析済みの文書も可)
 
         Returns:
             list(str) -- URIリスト
@@ -305,9 +3806,10 @@ class JbisCalendarFetcher(Fetcher):
         if content is None:
             return None
 
-        soup = BeautifulSoup(content, 'lxml')
-        anchors = soup.select('ul.list-icon-01 a')
-        relatives = (x['href'] for x in anchors)
+        document = parse_html(content)
+        relatives = document.xpath(
+            '//ul[contains(concat(" ", normalize-space(@class), " "),'
+            ' " list-icon-01 ")]//a/@href')
         uris = [urljoin(self._uri, x) for x in relatives]
         return uris
 
@@ -323,8 +3825,8 @@ class JbisRaceListFetcher(Fetcher):
         """
         self._uri = uri
 
-    def fetch(self, bucket, nowtime):
-        """フェッチ処理.
+    def steps(self, bucket, nowtime):
+        """フェッチ手順.
 
         Arguments:
             bucket {str} -- 格納先バケット名
@@ -335,35 +3837,54 @@ class JbisRaceListFetcher(Fetcher):
         """
         uris = []
         key = self.get_s3_key()
-        summary = get_s3_object(bucket, key)
+        summary = yield ('get_s3_object', bucket, key)
 
         if summary is None:
-            # S3未格納だった場合は古い日付を設定してフェッチを発火させる
-            s3_time = datetime(2000, 1, 1, tzinfo=timezone.utc)
+            s3_time = None
         else:
-            content = summary.get()['Body'].read()
-            soup = BeautifulSoup(content, 'lxml')
-            h = list(soup.select('table.tbl-data-04 th'))
-
-            if h:
-                if h[3].string == '芝ダ' or h[2].string == '芝ダ':
-                    # 取得済みで出馬表が入っている
-                    s3_time = summary.last_modified
-                else:
-                    # 取得済みで結果が入っている
-                    uris = self.get_next_uris(content)
-                    s3_time = nowtime
-            else:
-                # 取得済みだったけどよくわからないなら取得し直す
-                s3_time = datetime(2000, 1, 1, tzinfo=timezone.utc)
+            content = yield ('read_s3_object', summary)
+            (uris, s3_time) = yield (
+                'parse', self.check_stored, content, summary.last_modified,
+                nowtime)
 
-        # 23時間経過を閾値にする (URIが入っている場合はそのまま返す)
-        if (uris == []) and (nowtime - s3_time > timedelta(seconds=23 * 3600)):
-            content = fetch_to_s3(self._uri, bucket, key)
-            uris = self.get_next_uris(content)
+        # 結果が入っている場合はそのまま返す
+        if uris == [] and freshness_policy.is_stale(
+                self._uri, s3_time, nowtime):
+            content = yield ('fetch_to_s3', self._uri, bucket, key)
+            uris = yield ('parse', self.get_next_uris, content)
 
         return uris
 
+    def check_stored(self, content, last_modified, nowtime):
+        """取得済みのコンテンツを確認する.
+
+        Arguments:
+            content {bytes} -- 取得済みのコンテンツ
+            last_modified {datetime} -- 取得済みコンテンツの格納時刻
+            nowtime {datetime} -- 現時刻
+
+        Returns:
+            tuple(list(str), datetime) -- 次に処理するURIリストと、
+                鮮度判定に使う時刻 (取得し直す場合はNone)
+        """
+        uris = []
+        document = parse_html(content)
+        h = [get_string(x) for x in document.xpath(f'{DATA_TABLE}//th')]
+
+        if h:
+            if h[3] == '芝ダ' or h[2] == '芝ダ':
+                # 取得済みで出馬表が入っている
+                s3_time = last_modified
+            else:
+                # 取得済みで結果が入っている
+                uris = self.get_next_uris(document)
+                s3_time = nowtime
+        else:
+            # 取得済みだったけどよくわからないなら取得し直す
+            s3_time = None
+
+        return (uris, s3_time)
+
     def get_s3_key(self):
         """URIからS3のキーを取得する."""
         parsed = urlparse(self._uri)
@@ -374,7 +3895,7 @@ class JbisRaceListFetcher(Fetcher):
         """コンテンツ内から次のURIリストを取得する.
 
         Arguments:
-            content {bytes} -- コンテンツ
+            content {bytes} -- コンテンツ (解析済みの文書も可)
 
         Returns:
             list(str) -- URIリスト
@@ -384,15 +3905,18 @@ class JbisRaceListFetcher(Fetcher):
 
         uris = []
 
-        soup = BeautifulSoup(content, 'lxml')
-        lines = soup.select('table.tbl-data-04 tbody tr')
-        headers = list(soup.select('table.tbl-data-04 th'))
+        document = parse_html(content)
+        lines = document.xpath(f'{DATA_TABLE}//tbody//tr')
+        headers = [
+            get_string(x) for x in document.xpath(f'{DATA_TABLE}//th')]
 
-        if headers and headers[2].string != '芝ダ':
+        if headers and headers[2] != '芝ダ':
             # ↑重賞のみがリストに乗っているときは除外している↑
-            link_index = 1 if headers[3].string == '芝ダ' else 0
-            anchors = (list(x.select('td'))[link_index] for x in lines)
-            relatives = ((x.a['href'] if x.a else None) for x in anchors)
+            link_index = 1 if headers[3] == '芝ダ' else 0
+            anchors = (x.xpath('.//td')[link_index].find('.//a')
+                       for x in lines)
+            relatives = (
+                (x.get('href') if x is not None else None) for x in anchors)
             uris = [urljoin(self._uri, x) for x in relatives if x]
 
         return uris
@@ -409,24 +3933,25 @@ class JbisRaceResultFetcher(Fetcher):
         """
         self._uri = uri
 
-    def fetch(self, bucket, nowtime):
-        """フェッチ処理.
+    def steps(self, bucket, nowtime):
+        """フェッチ手順.
 
         Arguments:
             bucket {str} -- 格納先バケット名
             nowtime {datetime} -- 現時刻
         """
         uris = []
-        if not is_fetch_target_race_result(self._uri, nowtime):
+        if not freshness_policy.is_fetch_target(self._uri, nowtime):
             return uris
 
         key = self.get_s3_key()
-        summary = get_s3_object(bucket, key)
+        summary = yield ('get_s3_object', bucket, key)
+        s3_time = summary.last_modified if summary is not None else None
 
-        if summary is None:
-            # S3未格納だった場合は取得する。S3格納済みならそれ以上処理しない
-            content = fetch_to_s3(self._uri, bucket, key)
-            uris = self.get_next_uris(content)
+        # 確定した結果は格納済みなら取得し直さない (FRESHNESS_RULES)
+        if freshness_policy.is_stale(self._uri, s3_time, nowtime):
+            content = yield ('fetch_to_s3', self._uri, bucket, key)
+            uris = yield ('parse', self.get_next_uris, content)
 
         return uris
 
@@ -440,7 +3965,7 @@ class JbisRaceResultFetcher(Fetcher):
         """コンテンツ内から次のURIリストを取得する.
 
         Arguments:
-            content {bytes} -- コンテンツ
+            content {bytes} -- コンテンツ (解析済みの文書も可)
 
         Returns:
             list(str) -- URIリスト
@@ -448,9 +3973,9 @@ class JbisRaceResultFetcher(Fetcher):
         if content is None:
             return None
 
-        soup = BeautifulSoup(content, 'lxml')
-        anchors = soup.select('table.tbl-data-04 tr td:nth-child(4)>a')
-        relatives = (get_horse_record_uri(x['href']) for x in anchors)
+        document = parse_html(content)
+        hrefs = document.xpath(f'{DATA_TABLE}//tr/*[4][self::td]/a/@href')
+        relatives = (get_horse_record_uri(x) for x in hrefs)
         uris = [urljoin(self._uri, x) for x in relatives]
         return uris
 
@@ -466,8 +3991,8 @@ class JbisRaceEntryFetcher(Fetcher):
         """
         self._uri = uri
 
-    def fetch(self, bucket, nowtime):
-        """フェッチ処理.
+    def steps(self, bucket, nowtime):
+        """フェッチ手順.
 
         Arguments:
             bucket {str} -- 格納先バケット名
@@ -475,18 +4000,12 @@ class JbisRaceEntryFetcher(Fetcher):
         """
         uris = []
         key = self.get_s3_key()
-        summary = get_s3_object(bucket, key)
-
-        if summary is None:
-            # S3未格納だった場合は古い日付を設定してフェッチを発火させる
-            s3_time = datetime(2000, 1, 1, tzinfo=timezone.utc)
-        else:
-            s3_time = summary.last_modified
+        summary = yield ('get_s3_object', bucket, key)
+        s3_time = summary.last_modified if summary is not None else None
 
-        # 23時間経過を閾値にする
-        if nowtime - s3_time > timedelta(seconds=23 * 60 * 60):
-            content = fetch_to_s3(self._uri, bucket, key)
-            uris = self.get_next_uris(content)
+        if freshness_policy.is_stale(self._uri, s3_time, nowtime):
+            content = yield ('fetch_to_s3', self._uri, bucket, key)
+            uris = yield ('parse', self.get_next_uris, content)
 
         return uris
 
@@ -500,7 +4019,7 @@ class JbisRaceEntryFetcher(Fetcher):
         """コンテンツ内から次のURIリストを取得する.
 
         Arguments:
-            content {bytes} -- コンテンツ
+            content {bytes} -- コンテンツ (解析済みの文書も可)
 
         Returns:
             list(str) -- URIリスト
@@ -508,9 +4027,9 @@ class JbisRaceEntryFetcher(Fetcher):
         if content is None:
             return None
 
-        soup = BeautifulSoup(content, 'lxml')
-        anchors = soup.select('table.tbl-data-04 tr td:nth-child(3)>a')
-        relatives = (get_horse_record_uri(x['href']) for x in anchors)
+        document = parse_html(content)
+        hrefs = document.xpath(f'{DATA_TABLE}//tr/*[3][self::td]/a/@href')
+        relatives = (get_horse_record_uri(x) for x in hrefs)
         uris = [urljoin(self._uri, x) for x in relatives]
         return uris
 
@@ -527,8 +4046,8 @@ class JbisHorseRecordFetcher(Fetcher):
         self._uri = uri
         self._referer = referer
 
-    def fetch(self, bucket, nowtime):
-        """フェッチ処理.
+    def steps(self, bucket, nowtime):
+        """フェッチ手順.
 
         Arguments:
             bucket {str} -- 格納先バケット名
@@ -536,41 +4055,54 @@ class JbisHorseRecordFetcher(Fetcher):
         """
         uris = []
         key = self.get_s3_key()
-        summary = get_s3_object(bucket, key)
+        summary = yield ('get_s3_object', bucket, key)
 
         if summary is None:
-            # S3未格納だった場合は古い日付を設定してフェッチを発火させる
-            s3_time = datetime(2000, 1, 1, tzinfo=timezone.utc)
+            s3_time = None
         else:
-            body = summary.get()['Body'].read()
-            soup = BeautifulSoup(body, 'lxml')
-            dateelms = list(soup.select('table.tbl-data-04 tbody th.sort-02'))
-            dates = {x.string for x in dateelms}
-            path = urlparse(self._referer).path
-            m = re.fullmatch(r'/race/result/(\d{8})/\d{3}/\d{2}/', path)
+            body = yield ('read_s3_object', summary)
+            s3_time = yield (
+                'parse', self.get_stored_time, body, summary.last_modified,
+                nowtime)
 
-            if m:
-                s = m.group(1)
-                referer_date = f'{s[:4]}/{s[4:6]}/{s[6:]}'
+        if freshness_policy.is_stale(self._uri, s3_time, nowtime):
+            content = yield ('fetch_to_s3', self._uri, bucket, key)
+            uris = yield ('parse', self.get_next_uris, content)
 
-                if referer_date in dates:
-                    # refererのレースがすでに含まれていたら、取得不要
-                    s3_time = nowtime
-                else:
-                    # refererのレースが含まれていない場合はs3保存時刻を使う
-                    s3_time = summary.last_modified
+        filtered = [
+            x for x in uris if freshness_policy.is_fetch_target(x, nowtime)]
+        return filtered
 
-            else:
-                # refererが結果でなかった場合はs3保存時刻を使う
-                s3_time = summary.last_modified
+    def get_stored_time(self, body, last_modified, nowtime):
+        """取得済みのコンテンツから鮮度判定に使う時刻を求める.
 
-        # 23時間経過を閾値にする
-        if nowtime - s3_time > timedelta(seconds=23 * 60 * 60):
-            content = fetch_to_s3(self._uri, bucket, key)
-            uris = self.get_next_uris(content)
+        Arguments:
+            body {bytes} -- 取得済みのコンテンツ
+            last_modified {datetime} -- 取得済みコンテンツの格納時刻
+            nowtime {datetime} -- 現時刻
 
-        filtered = [x for x in uris if is_fetch_target_race_result(x, nowtime)]
-        return filtered
+        Returns:
+            datetime -- 鮮度判定に使う時刻
+        """
+        document = parse_html(body)
+        dateelms = document.xpath(
+            f'{DATA_TABLE}//tbody//th[contains('
+            'concat(" ", normalize-space(@class), " "), " sort-02 ")]')
+        dates = {get_string(x) for x in dateelms}
+        path = urlparse(self._referer).path
+        m = re.fullmatch(r'/race/result/(\d{8})/\d{3}/\d{2}/', path)
+
+        if m:
+            s = m.group(1)
+            referer_date = f'{s[:4]}/{s[4:6]}/{s[6:]}'
+
+            if referer_date in dates:
+                # refererのレースがすでに含まれていたら、取得不要
+                return nowtime
+
+        # refererのレースが含まれていない、またはrefererが結果でなかった場合は
+        # s3保存時刻を使う
+        return last_modified
 
     def get_s3_key(self):
         """URIからS3のキーを取得する."""
@@ -582,7 +4114,7 @@ class JbisHorseRecordFetcher(Fetcher):
         """コンテンツ内から次のURIリストを取得する.
 
         Arguments:
-            content {bytes} -- コンテンツ
+            content {bytes} -- コンテンツ (解析済みの文書も可)
 
         Returns:
             list(str) -- URIリスト
@@ -604,12 +4136,13 @@ class DefaultFetcher(Fetcher):
         """
         self._uri = uri
 
-    def fetch(self, bucket, nowtime):
-        """フェッチ処理.
+    def steps(self, bucket, nowtime):
+        """フェッチ手順.
 
         Arguments:
             bucket {str} -- 格納先バケット名
             nowtime {datetime} -- 現時刻
         """
         logger.warning('unknown uri type: %s', self._uri)
+        yield from ()
         return None
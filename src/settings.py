@@ -8,3 +8,22 @@ load_dotenv(join(dirname(__file__), '.env'))
 
 QUEUE_NAME = os.environ.get('QUEUE_NAME')
 BUCKET_NAME = os.environ.get('BUCKET_NAME')
+SEED_QUEUE_NAMES = [
+    x for x in os.environ.get('SEED_QUEUE_NAMES', '').split(',') if x]
+CALENDAR_DAYS_BACK = int(os.environ.get('CALENDAR_DAYS_BACK', '7'))
+CALENDAR_DAYS_FORWARD = int(os.environ.get('CALENDAR_DAYS_FORWARD', '7'))
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', '1'))
+PARTITION = os.environ.get('PARTITION', 'uri')
+DEAD_LETTER_QUEUE_NAME = os.environ.get('DEAD_LETTER_QUEUE_NAME') or None
+ENGINE = os.environ.get('ENGINE', 'sync')
+DISK_CACHE_DIR = os.environ.get('DISK_CACHE_DIR', '/tmp/keiba-fetcher')
+DISK_CACHE_BYTES = int(
+    os.environ.get('DISK_CACHE_BYTES', str(256 * 1024 * 1024)))
+CRAWL_JOURNAL = os.environ.get('CRAWL_JOURNAL', 'true').lower() == 'true'
+USE_EVENT_SOURCE = (
+    os.environ.get('USE_EVENT_SOURCE', 'false').lower() == 'true')
+PROFILE = os.environ.get('PROFILE', 'false').lower() == 'true'
+PROFILE_PREFIX = os.environ.get('PROFILE_PREFIX', 'profile/')
+PROFILE_SNAPSHOTS = [
+    x for x in os.environ.get('PROFILE_SNAPSHOTS', 'start,end').split(',')
+    if x]
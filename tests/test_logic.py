@@ -1,11 +1,46 @@
 """logicのテスト."""
 
-from datetime import datetime, timezone
+import asyncio
+import json
+import marshal
+import pstats
+import threading
+import time
+from datetime import datetime, timedelta, timezone
 from unittest import mock
 
+import botocore.session
+import botocore.validate
+import pytest
+
 import src.logic as logic
 
 
+@pytest.fixture(autouse=True)
+def reset_upstream():
+    """テスト毎にアクセス制御の状態を初期化する."""
+    with mock.patch('src.logic.upstream_health', logic.UpstreamHealth()):
+        with mock.patch(
+                'src.logic.rate_limiter', logic.IntervalRateLimiter(0)):
+            yield
+
+
+def as_dicts(tasks):
+    """タスクを比較しやすい辞書形式のリストにする."""
+    return [x.to_dict() for x in tasks]
+
+
+def read_bodies(bodies, responses):
+    """アップロードの本文を呼び出し時に読んで記録するside_effectを作る."""
+    responses = iter(responses)
+
+    def call(**kwargs):
+        bodies.append(kwargs['Body'].read())
+        return next(responses)
+
+    return call
+
+
 def test_entry():
     """entry()のテスト."""
     with mock.patch('src.logic.main_loop') as n:
@@ -22,6 +57,510 @@ def test_entry():
             datetime(2019, 12, 15, tzinfo=timezone.utc))
 
 
+def test_main_loop_seed_at_startup():
+    """main_loop()のテスト."""
+    nowtime = datetime.now(timezone.utc)
+
+    with mock.patch('boto3.resource') as m:
+        queue = m.return_value.get_queue_by_name.return_value
+        queue.receive_messages.return_value = []
+        with mock.patch('src.logic.is_queue_idle', return_value=True):
+            with mock.patch('src.logic.add_calendar_message') as n:
+                logic.main_loop(
+                    'QUEUE', 'BUCKET', nowtime, days_back=3, days_forward=40)
+                n.assert_called_once_with(['QUEUE'], nowtime, 3, 40)
+                queue.receive_messages.assert_called_once()
+
+
+def test_main_loop_circuit_open():
+    """main_loop()のテスト."""
+    nowtime = datetime.now(timezone.utc)
+    messages = [mock.MagicMock(body=f'{i}') for i in range(3)]
+
+    def process_message(
+            frontier, body, bucket, nowtime, deadline, message_id):
+        for _ in range(logic.upstream_health.failure_threshold):
+            logic.upstream_health.record(10.0, False)
+        return True
+
+    with mock.patch('boto3.resource') as m:
+        queue = m.return_value.get_queue_by_name.return_value
+        queue.receive_messages.return_value = messages
+        with mock.patch('src.logic.process_message') as n:
+            n.side_effect = process_message
+            logic.main_loop('QUEUE', 'BUCKET', nowtime, seed=False)
+            n.assert_called_once()
+            queue.receive_messages.assert_called_once()
+            messages[0].delete.assert_called_once()
+            for x in messages[1:]:
+                x.change_visibility.assert_called_once_with(
+                    VisibilityTimeout=0)
+
+
+def test_main_loop_extend_visibility():
+    """main_loop()のテスト."""
+    nowtime = datetime.now(timezone.utc)
+    messages = [mock.MagicMock(body=f'{i}') for i in range(3)]
+    messages[2].change_visibility.side_effect = Exception('expired')
+    deadlines = []
+
+    def process_message(
+            frontier, body, bucket, nowtime, deadline, message_id):
+        deadlines.append(deadline)
+        return True
+
+    with mock.patch('boto3.resource') as m:
+        queue = m.return_value.get_queue_by_name.return_value
+        queue.receive_messages.side_effect = [messages, []]
+        with mock.patch('src.logic.process_message') as n:
+            n.side_effect = process_message
+            logic.main_loop('QUEUE', 'BUCKET', nowtime, seed=False)
+            assert [x.args[1] for x in n.call_args_list] == ['0', '1']
+            assert queue.receive_messages.call_args_list[0] == mock.call(
+                MaxNumberOfMessages=10, WaitTimeSeconds=1,
+                VisibilityTimeout=logic.VISIBILITY_TIMEOUT_SECONDS)
+            messages[1].change_visibility.assert_called_once_with(
+                VisibilityTimeout=logic.VISIBILITY_TIMEOUT_SECONDS)
+            messages[2].delete.assert_not_called()
+    limit = datetime.now(timezone.utc) + timedelta(
+        seconds=logic.MESSAGE_SECONDS)
+    assert all(x <= limit for x in deadlines)
+
+
+def test_get_calendar_uris():
+    """get_calendar_uris()のテスト."""
+    nowtime = datetime(2019, 12, 15, tzinfo=timezone.utc)
+    uris = logic.get_calendar_uris(nowtime, 20, 50)
+    urlbase = 'https://www.jbis.or.jp/race/calendar/'
+    assert uris == [
+        urlbase + '?year=2019&month=11',
+        urlbase + '?year=2019&month=12',
+        urlbase + '?year=2020&month=01',
+        urlbase + '?year=2020&month=02']
+
+
+def test_add_calendar_message_shards():
+    """add_calendar_message()のテスト."""
+    nowtime = datetime(2019, 12, 15, tzinfo=timezone.utc)
+
+    with mock.patch('boto3.resource') as m:
+        with mock.patch('src.logic.send_tasks') as n:
+            logic.add_calendar_message(['Q1', 'Q2'], nowtime, 20, 50)
+            assert m.return_value.get_queue_by_name.call_args_list == [
+                mock.call(QueueName='Q1'), mock.call(QueueName='Q2')]
+            targets = [[x.target[-18:] for x in c[0][1]]
+                       for c in n.call_args_list]
+            assert targets == [
+                ['year=2019&month=11', 'year=2020&month=01'],
+                ['year=2019&month=12', 'year=2020&month=02']]
+
+
+def test_entry_async():
+    """entry()のテスト."""
+    nowtime = datetime(2019, 12, 15, tzinfo=timezone.utc)
+
+    async def async_main_loop(*args, **kwargs):
+        calls.append((args, kwargs))
+
+    calls = []
+    with mock.patch('src.logic.async_main_loop', async_main_loop):
+        with mock.patch('src.logic.main_loop') as m:
+            logic.entry('QUEUE', 'BUCKET', nowtime, engine='async', shard=1)
+            m.assert_not_called()
+            assert calls == [(('QUEUE', 'BUCKET', nowtime), {'shard': 1})]
+
+
+def test_process_message_async():
+    """process_message_async()のテスト."""
+    body = json.dumps({
+        'fetcher': 'DefaultFetcher',
+        'targets': [
+            {'target': 'http://a', 'referer': None},
+            {'target': 'http://b', 'referer': None}]})
+
+    async def fetch_async(uri, referer, bucket, nowtime, aio):
+        if uri == 'http://b':
+            raise logic.PermanentFetchError('404')
+        return ['http://c']
+
+    class FakeIo:
+        def __init__(self):
+            self.sent = []
+            self.dead = []
+
+        async def send(self, frontier, tasks, delay_seconds=0):
+            self.sent.append((tasks, delay_seconds))
+
+        async def send_dead_letters(self, frontier, tasks):
+            self.dead.extend(tasks)
+
+    aio = FakeIo()
+    with mock.patch('src.logic.fetch_async', fetch_async):
+        result = asyncio.run(logic.process_message_async(
+            mock.MagicMock(), body, 'bucket', None, aio))
+        assert result
+        assert [(as_dicts(x), y) for (x, y) in aio.sent] == [
+            ([{'target': 'http://c', 'referer': 'http://a'}], 0)]
+        assert [x.target for x in aio.dead] == ['http://b']
+
+
+class FakeContext:
+    """非同期コンテキストマネージャーのフェイク."""
+
+    def __init__(self, value):
+        """コンストラクタ."""
+        self.value = value
+
+    async def __aenter__(self):
+        """開始."""
+        return self.value
+
+    async def __aexit__(self, *args):
+        """終了."""
+        return False
+
+
+class FakeSqs:
+    """aiobotocoreのSQSクライアントのフェイク."""
+
+    def __init__(self, batches=None):
+        """コンストラクタ."""
+        self.batches = batches
+        self.received = 0
+        self.deleted = []
+        self.visibility = []
+        self.sent = []
+
+    async def get_queue_url(self, QueueName):
+        """キューURLを返す."""
+        return {'QueueUrl': f'url/{QueueName}'}
+
+    async def receive_message(self, **kwargs):
+        """受信のたびに新しいメッセージ10件を返す (batches指定時はその順)."""
+        self.received += 1
+        if self.batches is not None:
+            return {'Messages': self.batches.pop(0) if self.batches else []}
+
+        return {'Messages': [
+            {'Body': '{}', 'ReceiptHandle': f'{self.received}-{i}'}
+            for i in range(10)]}
+
+    async def delete_message(self, QueueUrl, ReceiptHandle):
+        """削除を記録する."""
+        self.deleted.append(ReceiptHandle)
+
+    async def change_message_visibility(
+            self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+        """可視性タイムアウトの変更を記録する."""
+        self.visibility.append((ReceiptHandle, VisibilityTimeout))
+
+    async def send_message_batch(self, QueueUrl, Entries):
+        """送信を記録する."""
+        self.sent.append((QueueUrl, Entries))
+
+    async def send_message(self, QueueUrl, MessageBody):
+        """単一メッセージの送信を記録する."""
+        self.sent.append((QueueUrl, [{'MessageBody': MessageBody}]))
+
+
+class FakeS3:
+    """aiobotocoreのS3クライアントのフェイク."""
+
+    def __init__(self, objects=None):
+        """コンストラクタ."""
+        self.objects = objects or {}
+        self.gets = 0
+
+    async def list_objects_v2(self, Bucket, Prefix):
+        """キー一覧を返す."""
+        return {'Contents': [
+            {'Key': k, 'LastModified': 1, 'ETag': '"e"'}
+            for k in self.objects if k.startswith(Prefix)]}
+
+    async def get_object(self, Bucket, Key):
+        """オブジェクトを返す."""
+        body = mock.MagicMock()
+        body.read = mock.MagicMock(side_effect=self._read(Key))
+        self.gets += 1
+        return {'Body': FakeContext(body), 'ETag': '"e"'}
+
+    def _read(self, key):
+        async def read():
+            return self.objects[key]
+        return lambda: read()
+
+    async def put_object(self, Bucket, Key, Body):
+        """オブジェクトを格納する."""
+        self.objects[Key] = Body.read()
+        return {'ETag': '"e"'}
+
+
+class FakeHttp:
+    """aiohttp.ClientSessionのフェイク."""
+
+    def __init__(self, status=200, content=b''):
+        """コンストラクタ."""
+        self.status = status
+        self.content = content
+        self.requested = []
+
+    def get(self, uri, timeout):
+        """応答を返す."""
+        self.requested.append(uri)
+        response = mock.MagicMock(status=self.status)
+        response.content.iter_chunked = self.iter_chunked
+        return FakeContext(response)
+
+    async def iter_chunked(self, size):
+        """本文を指定サイズずつ返す."""
+        for i in range(0, len(self.content), size):
+            yield self.content[i:i + size]
+
+
+def run_async_main_loop(sqs, process_message_async, **kwargs):
+    """フェイクのクライアントでasync_main_loop()を実行する."""
+    session = mock.MagicMock()
+    session.create_client.side_effect = (
+        lambda name: FakeContext(FakeS3() if name == 's3' else sqs))
+    nowtime = datetime.now(timezone.utc)
+
+    with mock.patch('src.logic.get_session', return_value=session):
+        with mock.patch(
+                'aiohttp.ClientSession',
+                return_value=FakeContext(FakeHttp())):
+            with mock.patch(
+                    'src.logic.process_message_async',
+                    process_message_async):
+                asyncio.run(logic.async_main_loop(
+                    'QUEUE', 'BUCKET', nowtime, seed=False, **kwargs))
+
+
+def test_async_main_loop_in_flight_cap():
+    """async_main_loop()のテスト."""
+    sqs = FakeSqs()
+
+    async def process_message_async(
+            frontier, body, bucket, nowtime, aio, deadline, message_id):
+        await asyncio.Event().wait()
+
+    with mock.patch('src.logic.RUN_SECONDS', 0.3):
+        with mock.patch('src.logic.DRAIN_SECONDS', 0.1):
+            run_async_main_loop(sqs, process_message_async, max_in_flight=20)
+
+    assert sqs.received == 2
+    assert sqs.deleted == []
+    assert sorted(sqs.visibility) == sorted(
+        (f'{i}-{j}', 0) for i in (1, 2) for j in range(10))
+
+
+def test_async_main_loop_intake_backlog():
+    """async_main_loop()のテスト."""
+    sqs = FakeSqs()
+
+    async def process_message_async(
+            frontier, body, bucket, nowtime, aio, deadline, message_id):
+        await asyncio.Event().wait()
+
+    with mock.patch('src.logic.RUN_SECONDS', 0.3):
+        with mock.patch('src.logic.DRAIN_SECONDS', 0.1):
+            with mock.patch('src.logic.INTAKE_SECONDS', -1):
+                run_async_main_loop(sqs, process_message_async)
+
+    assert sqs.received == 1
+
+
+def test_async_main_loop_heartbeat():
+    """async_main_loop()のテスト."""
+    sqs = FakeSqs([[{'Body': '{}', 'ReceiptHandle': 'h'}]])
+
+    async def process_message_async(
+            frontier, body, bucket, nowtime, aio, deadline, message_id):
+        await asyncio.sleep(0.25)
+        return True
+
+    with mock.patch('src.logic.VISIBILITY_TIMEOUT_SECONDS', 0.2):
+        run_async_main_loop(sqs, process_message_async)
+
+    assert sqs.visibility[0] == ('h', 0.2)
+    assert sqs.deleted == ['h']
+
+
+def test_async_main_loop_circuit_open():
+    """async_main_loop()のテスト."""
+    sqs = FakeSqs()
+
+    async def process_message_async(
+            frontier, body, bucket, nowtime, aio, deadline, message_id):
+        for _ in range(logic.upstream_health.failure_threshold):
+            logic.upstream_health.record(10.0, False)
+        return True
+
+    run_async_main_loop(sqs, process_message_async)
+
+    assert sqs.received == 1
+    assert len(sqs.deleted) == 10
+
+
+def test_async_main_loop_drain():
+    """async_main_loop()のテスト."""
+    sqs = FakeSqs([
+        [{'Body': '{}', 'ReceiptHandle': 'a'}],
+        [{'Body': '{}', 'ReceiptHandle': 'b'}]])
+
+    async def process_message_async(
+            frontier, body, bucket, nowtime, aio, deadline, message_id):
+        await asyncio.sleep(0.05)
+        return True
+
+    run_async_main_loop(sqs, process_message_async)
+
+    assert sorted(sqs.deleted) == ['a', 'b']
+    assert sqs.visibility == []
+
+
+def test_async_io_receive_messages():
+    """AsyncIo.receive_messages()のテスト."""
+    sqs = mock.MagicMock()
+    sqs.get_queue_url = mock.AsyncMock(return_value={'QueueUrl': 'url'})
+    sqs.receive_message = mock.AsyncMock(return_value={})
+    aio = logic.AsyncIo(FakeS3(), sqs, FakeHttp())
+
+    assert asyncio.run(aio.receive_messages('QUEUE')) == []
+    sqs.receive_message.assert_called_once_with(
+        QueueUrl='url', MaxNumberOfMessages=10, WaitTimeSeconds=1,
+        VisibilityTimeout=logic.VISIBILITY_TIMEOUT_SECONDS)
+
+
+def test_async_io_fetch_to_s3():
+    """AsyncIo.fetch_to_s3()のテスト."""
+    s3 = FakeS3()
+    http = FakeHttp(content=b'<p>1</p>')
+
+    async def run():
+        aio = logic.AsyncIo(s3, FakeSqs(), http)
+        return await aio.fetch_to_s3('http://host/path', 'bucket', 'key')
+
+    document = asyncio.run(run())
+    assert document.xpath('//p/text()') == ['1']
+    assert http.requested == ['http://host/path']
+    assert s3.objects == {'key': b'<p>1</p>'}
+
+
+def test_async_io_fetch_to_s3_error():
+    """AsyncIo.fetch_to_s3()のテスト."""
+    s3 = FakeS3()
+
+    async def run():
+        aio = logic.AsyncIo(s3, FakeSqs(), FakeHttp(status=503))
+        await aio.fetch_to_s3('http://host/path', 'bucket', 'key')
+
+    with pytest.raises(logic.TransientFetchError):
+        asyncio.run(run())
+    assert s3.objects == {}
+
+
+def test_async_io_fetch_to_s3_circuit_opened_while_waiting():
+    """AsyncIo.fetch_to_s3()のテスト."""
+    http = FakeHttp()
+
+    async def wait_async(host):
+        for _ in range(logic.upstream_health.failure_threshold):
+            logic.upstream_health.record(10.0, False)
+
+    async def run():
+        aio = logic.AsyncIo(FakeS3(), FakeSqs(), http)
+        try:
+            await aio.fetch_to_s3('http://host/path', 'bucket', 'key')
+        finally:
+            assert aio.backlog_seconds == 0
+
+    async def no_wait():
+        pass
+
+    with mock.patch.object(logic.rate_limiter, 'wait_async', wait_async):
+        with mock.patch.object(logic.upstream_health, 'wait_async', no_wait):
+            with pytest.raises(logic.CircuitOpenError):
+                asyncio.run(run())
+    assert http.requested == []
+
+
+def test_async_io_fetch_slot():
+    """AsyncIo._fetch_slot()のテスト."""
+    active = []
+    peak = []
+
+    async def fetch(aio):
+        async with aio._fetch_slot():
+            active.append(1)
+            peak.append(len(active))
+            await asyncio.sleep(0.01)
+            active.pop()
+
+    async def run():
+        aio = logic.AsyncIo(FakeS3(), FakeSqs(), FakeHttp())
+        await asyncio.gather(*(fetch(aio) for _ in range(5)))
+
+    asyncio.run(run())
+    assert max(peak) == 1
+
+
+def test_async_io_s3_object():
+    """AsyncIo.get_s3_object()とread_s3_object()のテスト."""
+    s3 = FakeS3({'key': b'1', 'key2': b'2'})
+
+    async def run():
+        aio = logic.AsyncIo(s3, FakeSqs(), FakeHttp())
+        summary = await aio.get_s3_object('bucket', 'key')
+        missing = await aio.get_s3_object('bucket', 'none')
+        return (summary, missing, await aio.read_s3_object(summary))
+
+    (summary, missing, content) = asyncio.run(run())
+    assert summary.key == 'key'
+    assert missing is None
+    assert content == b'1'
+
+
+def test_async_io_s3_object_disk_cache(tmp_path):
+    """AsyncIo.read_s3_object()のテスト."""
+    s3 = FakeS3()
+
+    async def run():
+        aio = logic.AsyncIo(s3, FakeSqs(), FakeHttp(content=b'<p>1</p>'))
+        await aio.fetch_to_s3('http://host/path', 'bucket', 'key')
+        summary = await aio.get_s3_object('bucket', 'key')
+        return bytes(await aio.read_s3_object(summary))
+
+    with mock.patch('src.logic.disk_cache', logic.DiskCache(tmp_path, 100)):
+        assert asyncio.run(run()) == b'<p>1</p>'
+    assert s3.gets == 0
+
+
+def test_async_io_send():
+    """AsyncIo.send()とsend_dead_letters()のテスト."""
+    sqs = FakeSqs()
+    tasks = [logic.CrawlTask.from_uri(f'http://host/{i}') for i in range(4)]
+
+    async def run():
+        aio = logic.AsyncIo(FakeS3(), sqs, FakeHttp())
+        await aio.send(logic.Frontier('QUEUE'), tasks, delay_seconds=5)
+        await aio.send_dead_letters(
+            logic.Frontier('QUEUE', dead_letter_queue_name='DLQ'), tasks)
+        await aio.send_invalid_message(
+            logic.Frontier('QUEUE', dead_letter_queue_name='DLQ'), '{',
+            ValueError('x'))
+        await aio.send_invalid_message(
+            logic.Frontier('QUEUE'), '{', ValueError('x'))
+
+    asyncio.run(run())
+    assert [x[0] for x in sqs.sent] == ['url/QUEUE', 'url/DLQ', 'url/DLQ']
+    assert sqs.sent[0][1][0]['DelaySeconds'] == 5
+    body = json.loads(sqs.sent[0][1][0]['MessageBody'])
+    assert body == {
+        'page': None, 'tasks': [[f'http://host/{i}', None] for i in range(4)]}
+    body = json.loads(sqs.sent[2][1][0]['MessageBody'])
+    assert body == {'invalid': '{', 'error': 'invalid: x'}
+
+
 def test_fetch():
     """fetch()のテスト."""
     nowtime = datetime(2019, 12, 1, 12, 0, 0)
@@ -33,6 +572,781 @@ def test_fetch():
         m.return_value.fetch.assert_called_once_with('bucket', nowtime)
 
 
+def test_parse_message_body_single():
+    """parse_message_body()のテスト."""
+    body = json.dumps({'target': 'http://a', 'referer': None})
+    tasks = logic.parse_message_body(body)
+    assert as_dicts(tasks) == [{'target': 'http://a', 'referer': None}]
+
+
+def test_parse_message_body_batch():
+    """parse_message_body()のテスト."""
+    body = json.dumps({
+        'fetcher': 'DefaultFetcher',
+        'targets': [
+            {'target': 'http://a', 'referer': 'http://r'},
+            {'target': 'http://b', 'referer': 'http://r'}]})
+    tasks = logic.parse_message_body(body)
+    assert as_dicts(tasks) == [
+        {'target': 'http://a', 'referer': 'http://r'},
+        {'target': 'http://b', 'referer': 'http://r'}]
+
+
+def test_parse_message_body_legacy():
+    """parse_message_body()のテスト."""
+    body = json.dumps({
+        'fetcher': 'JbisHorseRecordFetcher',
+        'targets': [
+            {'target': 'https://www.jbis.or.jp/horse/0000000001/',
+             'referer': 'http://r', 'attempt': 2}]})
+    (task,) = logic.parse_message_body(body)
+    assert task.page == logic.PageRef('horse', ('0000000001',))
+    assert task.referer == 'http://r'
+    assert task.attempt == 2
+
+
+def test_page_ref():
+    """PageRefのテスト."""
+    uri = 'https://www.jbis.or.jp/race/result/20200322/231/11/'
+    page = logic.PageRef.from_uri(uri)
+    assert page == ('race_result', ('20200322', '231', '11'))
+    assert page.uri == uri
+    assert page.key == 'race_result:20200322/231/11'
+    assert logic.PageRef.from_key(page.key) == page
+    assert logic.PageRef.from_uri(uri + '?x=1') is None
+    assert logic.to_page('http://host/') == 'http://host/'
+    with pytest.raises(ValueError):
+        logic.PageRef.from_ids('unknown', '1')
+
+
+def test_crawl_task_encode():
+    """CrawlTask.encode()とdecode()のテスト."""
+    task = logic.CrawlTask(
+        logic.PageRef('race_entry', ('2020', '0322', '231')),
+        logic.PageRef('race_list', ('20200322', '231')), 3, 'transient: x')
+    item = task.encode()
+    assert item == ['2020/0322/231', 'race_list:20200322/231', 3,
+                    'transient: x']
+    assert logic.CrawlTask.decode('race_entry', item) == task
+    assert task.target == 'https://www.jbis.or.jp/race/2020/0322/231.html'
+
+    task = logic.CrawlTask.from_uri('http://host/', 'http://r')
+    assert task.encode() == ['http://host/', 'http://r']
+    assert logic.CrawlTask.decode(None, task.encode()) == task
+    assert not hasattr(task, '__dict__')
+
+
+def test_task_outcomes_seen():
+    """TaskOutcomes.add_result()のテスト."""
+    seen = set()
+    task = logic.CrawlTask.from_uri('http://a')
+    outcomes = logic.TaskOutcomes(seen)
+    outcomes.add_result(task, ['http://b', 'http://c', 'http://b'])
+    logic.TaskOutcomes(seen).add_result(task, ['http://b'])
+    assert [x.target for x in outcomes.next_tasks] == [
+        'http://b', 'http://c']
+    assert seen == {'http://b', 'http://c'}
+
+
+def test_task_outcomes_seen_horse_record():
+    """TaskOutcomes.add_result()のテスト."""
+    seen = set()
+    horse = 'https://www.jbis.or.jp/horse/0001234567/record/all/'
+    races = [
+        logic.CrawlTask.from_uri(
+            f'https://www.jbis.or.jp/race/result/{x}/105/01/')
+        for x in ('20200301', '20200315')]
+    outcomes = logic.TaskOutcomes(seen)
+    for race in races + races:
+        outcomes.add_result(race, [horse])
+    assert [x.referer_uri for x in outcomes.next_tasks] == [
+        x.target for x in races]
+
+
+def test_process_message_redelivered():
+    """process_message()のテスト."""
+    frontier = mock.MagicMock()
+    frontier.seen = set()
+    frontier.send.side_effect = Exception('send failed')
+    body = json.dumps({
+        'fetcher': 'DefaultFetcher',
+        'targets': [{'target': 'http://a', 'referer': None}]})
+
+    with mock.patch('src.logic.fetch', return_value=['http://b']):
+        assert not logic.process_message(frontier, body, 'bucket', None)
+        assert frontier.seen == set()
+
+        # 再配信されたメッセージは次のタスクを登録し直す
+        frontier.send.side_effect = None
+        assert logic.process_message(frontier, body, 'bucket', None)
+        assert as_dicts(frontier.send.call_args_list[-1][0][0]) == [
+            {'target': 'http://b', 'referer': 'http://a'}]
+        assert frontier.seen == {'http://b'}
+
+
+def test_make_batch_bodies_group():
+    """make_batch_bodies()のテスト."""
+    referer = 'https://www.jbis.or.jp/race/calendar/?year=2020&month=3'
+    tasks = [
+        logic.CrawlTask.from_uri(
+            'https://www.jbis.or.jp/horse/0000000001/', referer),
+        logic.CrawlTask.from_uri(
+            'https://www.jbis.or.jp/race/calendar/20200322/231/', referer),
+        logic.CrawlTask.from_uri(
+            'https://www.jbis.or.jp/horse/0000000002/', referer)]
+    bodies = [json.loads(x) for x in logic.make_batch_bodies(tasks)]
+    assert bodies == [
+        {'page': 'horse', 'tasks': [
+            ['0000000001', 'calendar:2020/3'],
+            ['0000000002', 'calendar:2020/3']]},
+        {'page': 'race_list', 'tasks': [['20200322/231', 'calendar:2020/3']]}]
+    assert [logic.parse_message_body(x) for x in logic.make_batch_bodies(
+        tasks)] == [[tasks[0], tasks[2]], [tasks[1]]]
+
+
+def test_make_batch_bodies_split():
+    """make_batch_bodies()のテスト."""
+    tasks = [
+        logic.CrawlTask.from_uri(f'http://host/{i}', 'http://' + 'x' * 20000)
+        for i in range(logic.MAX_TASKS_PER_MESSAGE)]
+    bodies = list(logic.make_batch_bodies(tasks))
+    assert len(bodies) == 2
+    assert all(len(x) <= 256 * 1024 for x in bodies)
+    assert [y for x in bodies for y in logic.parse_message_body(x)] == tasks
+
+
+def test_make_batch_bodies_max_count():
+    """make_batch_bodies()のテスト."""
+    tasks = [logic.CrawlTask.from_uri(f'http://host/{i}', 'http://r')
+             for i in range(logic.MAX_TASKS_PER_MESSAGE * 2 + 1)]
+    bodies = [json.loads(x) for x in logic.make_batch_bodies(tasks)]
+    assert [len(x['tasks']) for x in bodies] == [
+        logic.MAX_TASKS_PER_MESSAGE, logic.MAX_TASKS_PER_MESSAGE, 1]
+
+
+def test_process_message_failures():
+    """process_message()のテスト."""
+    frontier = mock.MagicMock()
+    body = json.dumps({
+        'fetcher': 'DefaultFetcher',
+        'targets': [
+            {'target': 'http://a', 'referer': None},
+            {'target': 'http://b', 'referer': None},
+            {'target': 'http://c', 'referer': None, 'attempt': 2},
+            {'target': 'http://d', 'referer': None},
+            {'target': 'http://e', 'referer': None,
+             'attempt': logic.MAX_ATTEMPTS - 1}]})
+
+    def fetch(uri, referer, bucket, nowtime):
+        if uri == 'http://a':
+            return ['http://x']
+        if uri == 'http://d':
+            raise logic.PermanentFetchError('404')
+        raise logic.TransientFetchError('503')
+
+    with mock.patch('src.logic.fetch', side_effect=fetch):
+        assert logic.process_message(frontier, body, 'bucket', None)
+        assert [(as_dicts(c[0][0]), c[1]) for c in
+                frontier.send.call_args_list] == [
+            ([{'target': 'http://x', 'referer': 'http://a'}],
+             {'delay_seconds': 0}),
+            ([{'target': 'http://b', 'referer': None, 'attempt': 1}],
+             {'delay_seconds': 30}),
+            ([{'target': 'http://c', 'referer': None, 'attempt': 3}],
+             {'delay_seconds': 120})]
+        dead = frontier.send_dead_letters.call_args[0][0]
+        assert [(x.target, x.error) for x in dead] == [
+            ('http://d', 'permanent: 404'),
+            ('http://e', 'transient: 503')]
+
+
+def test_process_message_not_fetchable():
+    """process_message()のテスト."""
+    frontier = mock.MagicMock()
+    body = json.dumps({'target': 'http://a', 'referer': None})
+
+    with mock.patch('src.logic.fetch', return_value=None):
+        assert logic.process_message(frontier, body, 'bucket', None)
+        frontier.send.assert_called_once_with([], delay_seconds=0)
+        dead = frontier.send_dead_letters.call_args[0][0]
+        assert dead[0].error.startswith('permanent')
+
+
+def test_process_message_circuit_open():
+    """process_message()のテスト."""
+    frontier = mock.MagicMock()
+    body = json.dumps({'target': 'http://a', 'referer': None, 'attempt': 2})
+
+    with mock.patch('src.logic.fetch') as m:
+        m.side_effect = logic.CircuitOpenError('circuit open')
+        assert logic.process_message(frontier, body, 'bucket', None)
+        (args, kwargs) = frontier.send.call_args_list[1]
+        assert as_dicts(args[0]) == [
+            {'target': 'http://a', 'referer': None, 'attempt': 2}]
+        assert kwargs == {'delay_seconds': 60}
+
+
+def test_process_message_deadline():
+    """process_message()のテスト."""
+    frontier = mock.MagicMock()
+    body = json.dumps({
+        'fetcher': 'DefaultFetcher',
+        'targets': [
+            {'target': 'http://a', 'referer': None},
+            {'target': 'http://b', 'referer': None, 'attempt': 2}]})
+    deadline = datetime.now(timezone.utc) - timedelta(seconds=1)
+
+    with mock.patch('src.logic.fetch') as m:
+        assert logic.process_message(frontier, body, 'bucket', None, deadline)
+        m.assert_not_called()
+        frontier.send.assert_called_once_with(mock.ANY, delay_seconds=0)
+        assert as_dicts(frontier.send.call_args[0][0]) == [
+            {'target': 'http://a', 'referer': None},
+            {'target': 'http://b', 'referer': None, 'attempt': 2}]
+
+
+def test_process_message_async_deadline():
+    """process_message_async()のテスト."""
+    body = json.dumps({
+        'fetcher': 'DefaultFetcher',
+        'targets': [
+            {'target': 'http://a', 'referer': None},
+            {'target': 'http://b', 'referer': None}]})
+
+    async def fetch_async(uri, referer, bucket, nowtime, aio):
+        if uri == 'http://b':
+            await asyncio.sleep(10)
+        return ['http://c']
+
+    aio = mock.MagicMock()
+    aio.send = mock.AsyncMock()
+    aio.send_dead_letters = mock.AsyncMock()
+    deadline = datetime.now(timezone.utc) + timedelta(seconds=0.1)
+    with mock.patch('src.logic.fetch_async', fetch_async):
+        frontier = mock.MagicMock()
+        assert asyncio.run(logic.process_message_async(
+            frontier, body, 'bucket', None, aio, deadline))
+        aio.send.assert_awaited_once_with(frontier, mock.ANY, delay_seconds=0)
+        assert as_dicts(aio.send.call_args[0][1]) == [
+            {'target': 'http://c', 'referer': 'http://a'},
+            {'target': 'http://b', 'referer': None}]
+
+
+def test_process_message_invalid():
+    """process_message()のテスト."""
+    frontier = mock.MagicMock()
+
+    assert logic.process_message(frontier, '{"target"', 'bucket', None)
+    (body, error) = frontier.send_invalid_message.call_args[0]
+    assert body == '{"target"'
+    assert isinstance(error, ValueError)
+
+    frontier.send_invalid_message.side_effect = Exception('unavailable')
+    assert not logic.process_message(frontier, '{"target"', 'bucket', None)
+
+
+def test_process_message_send_failed():
+    """process_message()のテスト."""
+    frontier = mock.MagicMock()
+    body = json.dumps({
+        'fetcher': 'DefaultFetcher',
+        'targets': [
+            {'target': 'http://a', 'referer': None},
+            {'target': 'http://b', 'referer': None}]})
+
+    def fetch(uri, referer, bucket, nowtime):
+        if uri == 'http://b':
+            raise logic.PermanentFetchError('404')
+        return ['http://x']
+
+    with mock.patch('src.logic.fetch', side_effect=fetch):
+        # 何も登録できなければメッセージを残す
+        frontier.send.side_effect = Exception('unavailable')
+        assert not logic.process_message(frontier, body, 'bucket', None)
+        assert frontier.send.call_count == logic.SEND_ATTEMPTS
+        frontier.send_dead_letters.assert_not_called()
+
+        # 一部でも登録できたら残りは登録し直し、再配信はさせない
+        frontier.reset_mock()
+        frontier.send.side_effect = None
+        frontier.send_dead_letters.side_effect = [Exception('busy'), None]
+        assert logic.process_message(frontier, body, 'bucket', None)
+        assert frontier.send.call_count == 1
+        assert frontier.send_dead_letters.call_count == 2
+
+        frontier.reset_mock()
+        frontier.send_dead_letters.side_effect = Exception('unavailable')
+        assert logic.process_message(frontier, body, 'bucket', None)
+        assert frontier.send.call_count == 1
+
+
+def open_crawl_journal(tmp_path, objects, leftover=None):
+    """モックのS3でクロールジャーナルを開く."""
+    directory = tmp_path / 'journal' / 'QUEUE'
+    if leftover is not None:
+        directory.mkdir(parents=True)
+        (directory / 'old.jsonl').write_bytes(leftover)
+
+    journal = logic.CrawlJournal('bucket', 'journal/QUEUE/', tmp_path)
+    now = datetime.now(timezone.utc)
+    with mock.patch('boto3.client') as m:
+        s3 = m.return_value
+        s3.get_paginator.return_value.paginate.return_value = [
+            {'Contents': [
+                {'Key': k, 'LastModified': now - timedelta(seconds=age)}
+                for (k, (age, _)) in objects.items()]}]
+        s3.get_object.side_effect = lambda Bucket, Key: {
+            'Body': mock.MagicMock(read=lambda: objects[Key][1])}
+        journal.open()
+    return (journal, s3, directory)
+
+
+def test_crawl_journal_open(tmp_path):
+    """CrawlJournal.open()のテスト."""
+    objects = {
+        'journal/QUEUE/a.jsonl': (60, (
+            b'["start", "m1", 0]\n["stored", "m1", 0, ["http://x"]]\n'
+            b'["sent", "m1", "next"]\n["enqueued", "m1"]\n'
+            b'["failed", "m2", 1, "permanent", "404"]\n["ack", "m2"')),
+        'journal/QUEUE/b.jsonl': (
+            logic.JOURNAL_REPLAY_SECONDS + 1, b'["ack", "m3"]\n')}
+    (journal, s3, directory) = open_crawl_journal(
+        tmp_path, objects, b'["ack", "m0"]\n')
+
+    puts = {
+        x.kwargs['Key']: x.kwargs['Body']
+        for x in s3.put_object.call_args_list}
+    assert puts.pop('journal/QUEUE/old.jsonl') == b'["ack", "m0"]\n'
+    # 再生した記録は削除済みのメッセージを除いて1つにまとめ直す
+    ((key, body),) = puts.items()
+    assert key == f'journal/QUEUE/{journal._name}-00001.jsonl'
+    lines = [json.loads(x) for x in body.splitlines()]
+    assert [x for x in lines if x[0] != 'since'] == [
+        ['stored', 'm1', 0, ['http://x']], ['sent', 'm1', 'next'],
+        ['enqueued', 'm1'], ['failed', 'm2', 1, 'permanent', '404']]
+    assert sorted(
+        x.kwargs['Key'] for x in s3.delete_object.call_args_list) == [
+            'journal/QUEUE/a.jsonl', 'journal/QUEUE/b.jsonl']
+    assert journal.get_record('m1').completed
+    assert journal.get_record('m1').results == {0: ('stored', ['http://x'])}
+    assert journal.get_record('m2').results == {
+        1: ('failed', 'permanent', '404')}
+    assert not journal.get_record('m2').completed
+    assert not journal.get_record('m3').completed
+    assert [x.name for x in directory.iterdir()] == [
+        f'{journal._name}-00002.jsonl']
+
+    # 書き出すたびに追記分だけを別のオブジェクトにする
+    with mock.patch('boto3.client') as m:
+        journal.get_record('m2').ack()
+        assert journal.flush(force=True)
+        journal.get_record('m1').ack()
+        journal.close()
+        puts = [
+            (x.kwargs['Key'], x.kwargs['Body'])
+            for x in m.return_value.put_object.call_args_list]
+    assert puts == [
+        (f'journal/QUEUE/{journal._name}-00002.jsonl', b'["ack", "m2"]\n'),
+        (f'journal/QUEUE/{journal._name}-00003.jsonl', b'["ack", "m1"]\n')]
+    assert list(directory.iterdir()) == []
+
+
+def test_crawl_journal_open_expired(tmp_path):
+    """CrawlJournal.open()のテスト."""
+    since = datetime.now(timezone.utc) - timedelta(
+        seconds=logic.JOURNAL_REPLAY_SECONDS + 1)
+    objects = {'journal/QUEUE/a.jsonl': (60, (
+        f'["since", "m1", "{since.isoformat()}"]\n'
+        '["stored", "m1", 0, []]\n["stored", "m2", 0, []]\n').encode())}
+    (journal, s3, _) = open_crawl_journal(tmp_path, objects)
+
+    # まとめ直した記録も最初の記録から再生期間を過ぎたら引き継がない
+    assert journal.get_record('m1').results == {}
+    assert journal.get_record('m2').results == {0: ('stored', [])}
+
+
+def test_process_message_journal(tmp_path):
+    """process_message()のテスト."""
+    objects = {'journal/QUEUE/a.jsonl': (60, (
+        b'["start", "m1", 0]\n["stored", "m1", 0, ["http://x"]]\n'
+        b'["start", "m1", 1]\n'))}
+    (journal, _, _) = open_crawl_journal(tmp_path, objects)
+    frontier = mock.MagicMock()
+    frontier.seen = set()
+    body = json.dumps({
+        'fetcher': 'DefaultFetcher',
+        'targets': [
+            {'target': 'http://a', 'referer': None},
+            {'target': 'http://b', 'referer': None}]})
+
+    with mock.patch('src.logic.crawl_journal', journal):
+        with mock.patch('src.logic.fetch', return_value=['http://y']) as m:
+            assert logic.process_message(
+                frontier, body, 'bucket', None, message_id='m1')
+            m.assert_called_once_with('http://b', None, 'bucket', None)
+            assert as_dicts(frontier.send.call_args[0][0]) == [
+                {'target': 'http://x', 'referer': 'http://a'},
+                {'target': 'http://y', 'referer': 'http://b'}]
+
+            # 登録まで終えたメッセージは処理しない
+            frontier.reset_mock()
+            m.reset_mock()
+            assert logic.process_message(
+                frontier, body, 'bucket', None, message_id='m1')
+            m.assert_not_called()
+            frontier.send.assert_not_called()
+
+    journal._file.flush()
+    with open(journal._file.name, 'rb') as f:
+        lines = [json.loads(x) for x in f.read().splitlines()]
+    assert lines == [
+        ['start', 'm1', 1], ['stored', 'm1', 1, ['http://y']],
+        ['sent', 'm1', 'next'], ['sent', 'm1', 'dead'], ['enqueued', 'm1']]
+
+
+def test_process_message_journal_partially_sent(tmp_path):
+    """process_message()のテスト."""
+    objects = {'journal/QUEUE/a.jsonl': (60, (
+        b'["stored", "m1", 0, ["http://x"]]\n'
+        b'["failed", "m1", 1, "transient", "503"]\n'
+        b'["sent", "m1", "next"]\n'))}
+    (journal, _, _) = open_crawl_journal(tmp_path, objects)
+    frontier = mock.MagicMock()
+    body = json.dumps({
+        'fetcher': 'DefaultFetcher',
+        'targets': [
+            {'target': 'http://a', 'referer': None},
+            {'target': 'http://b', 'referer': None}]})
+
+    with mock.patch('src.logic.crawl_journal', journal):
+        with mock.patch('src.logic.fetch') as m:
+            assert logic.process_message(
+                frontier, body, 'bucket', None, message_id='m1')
+            m.assert_not_called()
+            (args, kwargs) = frontier.send.call_args
+            assert as_dicts(args[0]) == [
+                {'target': 'http://b', 'referer': None, 'attempt': 1}]
+            assert kwargs == {'delay_seconds': 30}
+
+
+def test_make_invalid_message_body():
+    """make_invalid_message_body()のテスト."""
+    body = logic.make_invalid_message_body('\x00' * 300000, ValueError('x'))
+    assert len(body.encode()) <= logic.MAX_MESSAGE_SIZE
+    assert json.loads(body)['error'] == 'invalid: x'
+
+
+def test_classify_error():
+    """classify_error()のテスト."""
+    assert logic.classify_error(logic.ParseError()) == 'parse'
+    assert logic.classify_error(IndexError()) == 'parse'
+    assert logic.classify_error(
+        logic.requests.ConnectionError()) == 'transient'
+
+
+def test_get_retry_delay():
+    """get_retry_delay()のテスト."""
+    assert logic.get_retry_delay(1) == 30
+    assert logic.get_retry_delay(4) == 240
+    assert logic.get_retry_delay(10) == 900
+
+
+def test_process_records():
+    """process_records()のテスト."""
+    records = [
+        {'messageId': '1', 'body': 'a'},
+        {'messageId': '2', 'body': 'b'}]
+
+    with mock.patch('src.logic.use_shared_rate_limit'):
+        with mock.patch('src.logic.process_message') as m:
+            m.side_effect = [True, False]
+            result = logic.process_records(records, 'QUEUE', 'BUCKET', None)
+            assert result == {'batchItemFailures': [{'itemIdentifier': '2'}]}
+
+
+def test_get_shard_queue_name():
+    """get_shard_queue_name()のテスト."""
+    assert logic.get_shard_queue_name('QUEUE', 0, 1) == 'QUEUE'
+    assert logic.get_shard_queue_name('QUEUE', 2, 4) == 'QUEUE-2'
+
+
+def test_frontier_send():
+    """Frontier.send()のテスト."""
+    tasks = [logic.CrawlTask.from_uri(f'http://host/{i}') for i in range(20)]
+
+    with mock.patch('boto3.resource'):
+        with mock.patch('src.logic.send_tasks') as m:
+            frontier = logic.Frontier('QUEUE', 4)
+            frontier.send(tasks, delay_seconds=5)
+            sent = [y for x in m.call_args_list for y in x[0][1]]
+            assert sorted(sent, key=lambda x: x.target) == sorted(
+                tasks, key=lambda x: x.target)
+            for c in m.call_args_list:
+                shards = {logic.get_shard(x.target, 4) for x in c[0][1]}
+                assert len(shards) == 1
+                assert c[0][2] == 5
+
+
+def test_work_shard_leased():
+    """work_shard()のテスト."""
+    nowtime = datetime(2019, 12, 15, tzinfo=timezone.utc)
+
+    with mock.patch('src.logic.S3LeaseStore') as m:
+        m.return_value.acquire.return_value = False
+        with mock.patch('src.logic.main_loop') as n:
+            logic.work_shard('QUEUE', 'BUCKET', nowtime, 1, shard_count=2)
+            n.assert_not_called()
+            m.return_value.release.assert_not_called()
+
+
+def test_work_shard():
+    """work_shard()のテスト."""
+    nowtime = datetime(2019, 12, 15, tzinfo=timezone.utc)
+
+    with mock.patch('src.logic.S3LeaseStore') as m:
+        m.return_value.acquire.return_value = True
+        with mock.patch('src.logic.main_loop') as n:
+            logic.work_shard('QUEUE', 'BUCKET', nowtime, 1, shard_count=2)
+            n.assert_called_once_with(
+                'QUEUE', 'BUCKET', nowtime, shard=1, seed=False,
+                shared_rate_limit=True, shard_count=2)
+            m.return_value.release.assert_called_once_with(
+                'QUEUE/1', m.return_value.acquire.call_args[0][1])
+
+
+def test_s3_lease_store_acquire_expired():
+    """S3LeaseStore.acquire()のテスト."""
+    conflict = logic.ClientError(
+        {'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+
+    with mock.patch('boto3.resource') as m:
+        obj = m.return_value.Object.return_value
+        obj.put.side_effect = [conflict, None]
+        body = mock.MagicMock()
+        body.read.return_value = json.dumps({'owner': 'x', 'expires': 0})
+        obj.get.return_value = {'Body': body, 'ETag': '"etag"'}
+
+        store = logic.S3LeaseStore('bucket')
+        assert store.acquire('shard', 'y', 60)
+        assert obj.put.call_args[1]['IfMatch'] == '"etag"'
+
+
+def test_s3_lease_store_acquire_held():
+    """S3LeaseStore.acquire()のテスト."""
+    conflict = logic.ClientError(
+        {'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+
+    with mock.patch('boto3.resource') as m:
+        obj = m.return_value.Object.return_value
+        obj.put.side_effect = [conflict]
+        body = mock.MagicMock()
+        body.read.return_value = json.dumps(
+            {'owner': 'x', 'expires': 2 ** 40})
+        obj.get.return_value = {'Body': body, 'ETag': '"etag"'}
+
+        store = logic.S3LeaseStore('bucket')
+        assert not store.acquire('shard', 'y', 60)
+
+
+def test_s3_lease_store_put_parameters():
+    """S3LeaseStoreの条件付き書き込みがPutObjectの仕様に合うことのテスト."""
+    conflict = logic.ClientError(
+        {'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+    session = botocore.session.get_session()
+    shape = session.get_service_model('s3').operation_model(
+        'PutObject').input_shape
+
+    with mock.patch('boto3.resource') as m:
+        obj = m.return_value.Object.return_value
+        obj.put.side_effect = [conflict, None, None]
+        body = mock.MagicMock()
+        body.read.return_value = json.dumps({'owner': 'x', 'expires': 0})
+        obj.get.return_value = {'Body': body, 'ETag': '"etag"'}
+
+        store = logic.S3LeaseStore('bucket')
+        store.acquire('shard', 'y', 60)
+        store.take_ticket('host', 1)
+
+    assert len(obj.put.call_args_list) == 3
+    for c in obj.put.call_args_list:
+        params = {'Bucket': 'bucket', 'Key': 'key', **c[1]}
+        botocore.validate.validate_parameters(params, shape)
+
+
+def test_interval_rate_limiter_wait_async():
+    """IntervalRateLimiter.wait_async()のテスト."""
+    limiter = logic.IntervalRateLimiter(0.05)
+    finished = []
+
+    async def wait(i):
+        await limiter.wait_async('host')
+        finished.append((i, time.monotonic()))
+
+    async def wait_all():
+        await asyncio.gather(*(wait(i) for i in range(3)))
+
+    asyncio.run(wait_all())
+    assert [x[0] for x in finished] == [0, 1, 2]
+    assert finished[2][1] - finished[0][1] >= 0.1
+
+
+def test_ticket_rate_limiter_wait():
+    """TicketRateLimiter.wait()のテスト."""
+    store = mock.MagicMock()
+    store.take_ticket.side_effect = [False, True, True]
+
+    with mock.patch('time.time', return_value=100.5):
+        with mock.patch('time.sleep') as m:
+            limiter = logic.TicketRateLimiter(store, 1)
+            limiter.wait('host')
+            assert store.take_ticket.call_args_list == [
+                mock.call('host', 101), mock.call('host', 102)]
+            m.assert_called_once_with(1.5)
+
+    with mock.patch('time.time', return_value=102.5):
+        with mock.patch('time.sleep'):
+            limiter.wait('host')
+            store.take_ticket.assert_called_with('host', 103)
+            store.return_ticket.assert_called_once_with('host', 102)
+
+
+def test_ticket_rate_limiter_future_slots():
+    """TicketRateLimiter.wait_async()のテスト."""
+    store = mock.MagicMock()
+    tickets = {101}
+    lock = threading.Lock()
+
+    def take_ticket(host, slot):
+        with lock:
+            if slot in tickets:
+                return False
+            tickets.add(slot)
+            return True
+
+    store.take_ticket.side_effect = take_ticket
+
+    async def run():
+        with mock.patch('asyncio.sleep'):
+            await asyncio.gather(
+                *(limiter.wait_async('host') for _ in range(3)))
+
+    limiter = logic.TicketRateLimiter(store, 1)
+    with mock.patch('time.time', return_value=100.5):
+        asyncio.run(run())
+    # まだ使っていない先の枠は削除しない
+    store.return_ticket.assert_not_called()
+    assert sorted(limiter._taken['host']) == [102, 103, 104]
+
+    with mock.patch('time.time', return_value=103.5):
+        with mock.patch('time.sleep'):
+            limiter.wait('host')
+    assert sorted(x[0][1] for x in store.return_ticket.call_args_list) == [
+        102, 103]
+
+
+def test_upstream_health_aimd():
+    """UpstreamHealthのテスト."""
+    health = logic.UpstreamHealth(target_latency=1.0)
+    for _ in range(10):
+        health.record(0.1, True)
+    assert health.delay == 0
+    assert health.concurrency == 4
+
+    health.record(5.0, True)
+    assert health.delay == 1.0
+    assert health.concurrency == 2
+    health.record(5.0, True)
+    assert health.delay == 2.0
+
+    health.record(0.1, True)
+    assert health.delay == 1.75
+    assert not health.is_open
+
+
+def test_upstream_health_circuit():
+    """UpstreamHealthのテスト."""
+    health = logic.UpstreamHealth(failure_threshold=3, cooldown=60)
+
+    with mock.patch('time.monotonic', return_value=1000):
+        for _ in range(3):
+            assert health.allow()
+            health.record(10.0, False)
+        assert health.is_open
+        assert not health.allow()
+
+    with mock.patch('time.monotonic', return_value=1061):
+        assert not health.is_open
+        assert health.allow()
+        assert health.is_open
+        assert not health.allow()
+        health.record(0.5, True)
+        assert not health.is_open
+        assert health.allow()
+
+
+def test_fetch_to_s3_release_probe():
+    """fetch_to_s3()のテスト."""
+    health = logic.UpstreamHealth(cooldown=0)
+    health._open()
+    limiter = mock.MagicMock()
+    limiter.wait.side_effect = Exception('unavailable')
+
+    with mock.patch('src.logic.upstream_health', health):
+        with mock.patch('src.logic.rate_limiter', limiter):
+            with pytest.raises(Exception):
+                logic.fetch_to_s3('http://host/path', 'bucket', 'key')
+    assert not health.probing
+    assert health.allow()
+
+
+def test_async_io_fetch_to_s3_release_probe():
+    """AsyncIo.fetch_to_s3()のテスト."""
+    health = logic.UpstreamHealth(cooldown=0)
+    health._open()
+
+    class SlowHttp(FakeHttp):
+        async def iter_chunked(self, size):
+            await asyncio.sleep(10)
+            yield b''
+
+    async def run():
+        aio = logic.AsyncIo(FakeS3(), FakeSqs(), SlowHttp())
+        task = asyncio.ensure_future(
+            aio.fetch_to_s3('http://host/path', 'bucket', 'key'))
+        await asyncio.sleep(0.1)
+        assert health.probing
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    with mock.patch('src.logic.upstream_health', health):
+        asyncio.run(run())
+    assert not health.probing
+    assert health.allow()
+
+
+def test_upstream_health_timeout():
+    """UpstreamHealthのテスト."""
+    health = logic.UpstreamHealth()
+    assert health.timeout == 10
+    for _ in range(20):
+        health.record(0.5, True)
+    assert health.timeout == 3
+    for _ in range(20):
+        health.record(2.0, True)
+    assert health.timeout == 6
+
+
+def test_fetch_to_s3_circuit_open():
+    """fetch_to_s3()のテスト."""
+    with mock.patch('src.logic.upstream_health') as health:
+        health.allow.return_value = False
+        with mock.patch('requests.get') as get:
+            with pytest.raises(logic.CircuitOpenError):
+                logic.fetch_to_s3('http://host/path', 'bucket', 'key')
+            get.assert_not_called()
+
+
 def test_get_s3_object():
     """get_s3_object()のテスト."""
     with mock.patch('boto3.resource') as m:
@@ -60,17 +1374,21 @@ def test_fetch_to_s3():
     key = 'key'
 
     with mock.patch('requests.get') as get:
-        with mock.patch('boto3.resource') as resource:
+        with mock.patch('boto3.client') as client:
             get.return_value.status_code = 200
-            get.return_value.content = b'1'
+            get.return_value.iter_content.return_value = [b'<p>1', b'</p>']
+            bodies = []
+            client.return_value.put_object.side_effect = read_bodies(
+                bodies, [{'ETag': '"e"'}])
 
-            content = logic.fetch_to_s3(uri, bucket, key)
-            assert content == b'1'
-            get.assert_called_once_with(uri, timeout=10)
-            resource.assert_called_once_with('s3')
-            resource.return_value.Bucket.assert_called_once_with(bucket)
-            resource.return_value.Bucket.return_value.put_object.\
-                assert_called_once_with(Key=key, Body=b'1')
+            document = logic.fetch_to_s3(uri, bucket, key)
+            assert document.xpath('//p/text()') == ['1']
+            get.assert_called_once_with(uri, timeout=10, stream=True)
+            client.assert_called_once_with('s3')
+            kwargs = client.return_value.put_object.call_args.kwargs
+            assert (kwargs['Bucket'], kwargs['Key']) == (bucket, key)
+            assert bodies == [b'<p>1</p>']
+            assert kwargs['Body'].closed
 
 
 def test_fetch_to_s3_error():
@@ -80,14 +1398,231 @@ def test_fetch_to_s3_error():
     key = 'key'
 
     with mock.patch('requests.get') as get:
-        with mock.patch('boto3.resource') as resource:
+        with mock.patch('boto3.client') as client:
             get.return_value.status_code = 500
-            get.return_value.content = b'1'
 
-            content = logic.fetch_to_s3(uri, bucket, key)
-            assert content is None
-            get.assert_called_once_with(uri, timeout=10)
-            resource.assert_not_called()
+            with pytest.raises(logic.TransientFetchError):
+                logic.fetch_to_s3(uri, bucket, key)
+            get.assert_called_once_with(uri, timeout=10, stream=True)
+            client.assert_not_called()
+
+
+def test_fetch_to_s3_not_found():
+    """fetch_to_s3()のテスト."""
+    with mock.patch('requests.get') as get:
+        with mock.patch('boto3.client') as client:
+            get.return_value.status_code = 404
+
+            with pytest.raises(logic.PermanentFetchError):
+                logic.fetch_to_s3('http://host/path', 'bucket', 'key')
+            client.assert_not_called()
+
+
+def test_s3_upload_stream_multipart():
+    """S3UploadStreamのテスト."""
+    s3 = mock.MagicMock()
+    s3.create_multipart_upload.return_value = {'UploadId': 'u'}
+    bodies = []
+    s3.upload_part.side_effect = read_bodies(
+        bodies, [{'ETag': 'e1'}, {'ETag': 'e2'}])
+
+    with mock.patch('src.logic.MIN_PART_SIZE', 4):
+        upload = logic.S3UploadStream(s3, 'bucket', 'key')
+        for chunk in (b'ab', b'cd', b'e'):
+            upload.write(chunk)
+        upload.close()
+
+    assert bodies == [b'abcd', b'e']
+    s3.complete_multipart_upload.assert_called_once_with(
+        Bucket='bucket', Key='key', UploadId='u',
+        MultipartUpload={'Parts': [
+            {'ETag': 'e1', 'PartNumber': 1},
+            {'ETag': 'e2', 'PartNumber': 2}]})
+    s3.put_object.assert_not_called()
+
+
+def test_stream_to_s3_abort():
+    """stream_to_s3()のテスト."""
+    def chunks():
+        yield b'abcd'
+        raise logic.requests.ConnectionError()
+
+    with mock.patch('boto3.client') as client:
+        s3 = client.return_value
+        s3.create_multipart_upload.return_value = {'UploadId': 'u'}
+        with mock.patch('src.logic.MIN_PART_SIZE', 4):
+            with pytest.raises(logic.requests.ConnectionError):
+                logic.stream_to_s3(chunks(), 'bucket', 'key')
+        s3.abort_multipart_upload.assert_called_once_with(
+            Bucket='bucket', Key='key', UploadId='u')
+        s3.complete_multipart_upload.assert_not_called()
+
+
+def test_disk_cache(tmp_path):
+    """DiskCacheのテスト."""
+    cache = logic.DiskCache(str(tmp_path), 10)
+    cache.put('bucket', 'a', '"1"', b'aaaa')
+    cache.put('bucket', 'b', '"1"', b'bbbb')
+    assert bytes(cache.get('bucket', 'a', '"1"')) == b'aaaa'
+    assert cache.get('bucket', 'a', '"2"') is None
+
+    # 使われていないものから削除する
+    cache.put('bucket', 'c', '"1"', b'cccc')
+    assert cache.get('bucket', 'b', '"1"') is None
+    assert cache.size == 8
+
+    # 同じキーの古い版は置き換える
+    cache.put('bucket', 'a', '"2"', b'AA')
+    assert cache.get('bucket', 'a', '"1"') is None
+    assert cache.size == 6
+
+    # 上限を超えるものはキャッシュしない
+    cache.put('bucket', 'd', '"1"', b'd' * 11)
+    assert cache.get('bucket', 'd', '"1"') is None
+
+    # 起動し直しても残ったファイルを使う
+    reloaded = logic.DiskCache(str(tmp_path), 10)
+    assert bytes(reloaded.get('bucket', 'c', '"1"')) == b'cccc'
+    assert reloaded.size == 6
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_read_s3_object_disk_cache(tmp_path):
+    """read_s3_object()のテスト."""
+    summary = mock.MagicMock(bucket_name='bucket', key='key', e_tag='"1"')
+    summary.get.return_value = {
+        'Body': mock.MagicMock(read=mock.MagicMock(return_value=b'<p>1</p>')),
+        'ETag': '"1"'}
+
+    with mock.patch('src.logic.disk_cache', logic.DiskCache(tmp_path, 100)):
+        assert logic.read_s3_object(summary) == b'<p>1</p>'
+        content = logic.read_s3_object(summary)
+        assert summary.get.call_count == 1
+        assert logic.parse_html(content).xpath('//p/text()') == ['1']
+
+
+def test_stream_to_s3_disk_cache(tmp_path):
+    """stream_to_s3()のテスト."""
+    cache = logic.DiskCache(tmp_path, 100)
+    with mock.patch('src.logic.disk_cache', cache):
+        with mock.patch('boto3.client') as client:
+            client.return_value.put_object.return_value = {'ETag': '"1"'}
+            logic.stream_to_s3([b'<p>', b'1</p>'], 'bucket', 'key')
+    assert bytes(cache.get('bucket', 'key', '"1"')) == b'<p>1</p>'
+
+
+def test_profiler_disabled():
+    """Profilerのテスト."""
+    profiler = logic.Profiler()
+    steps = iter([])
+    assert profiler.profile_steps('X', steps) is steps
+    with mock.patch('boto3.client') as m:
+        with profiler.run('bucket', 'profile/'):
+            profiler.snapshot('start')
+        m.assert_not_called()
+
+
+def test_profiler_sections():
+    """Profiler.section()とprofile_steps()のテスト."""
+    def double(x):
+        return x * 2
+
+    def steps():
+        result = yield ('parse', double, 1)
+        return [result]
+
+    def names(name):
+        stats = pstats.Stats()
+        stats.stats = marshal.loads(report[name])
+        return {x[2] for x in stats.stats}
+
+    profiler = logic.Profiler(True, ['start', 'message'])
+    with mock.patch('boto3.client') as m:
+        with profiler.run('bucket', 'profile/1/'):
+            profiler.snapshot('message')
+            with mock.patch('src.logic.profiler', profiler):
+                assert logic.run_steps(
+                    profiler.profile_steps('JbisFetcher', steps())) == [2]
+        report = profiler.report()
+        assert sorted(report) == [
+            'JbisFetcher.pstats', 'entry.pstats', 'memory.txt']
+        keys = {x.kwargs['Key'] for x in m.return_value.put_object.mock_calls}
+        assert keys == {f'profile/1/{x}' for x in report}
+
+    assert 'double' in names('JbisFetcher.pstats')
+    assert 'double' not in names('entry.pstats')
+    memory = report['memory.txt'].decode('utf-8')
+    assert '## start' in memory
+    assert '## message' in memory
+    assert '## end' not in memory
+
+
+def test_profiler_upload_failed():
+    """Profiler.run()のテスト."""
+    profiler = logic.Profiler(True)
+    with mock.patch('boto3.client') as m:
+        m.return_value.put_object.side_effect = Exception('denied')
+        with profiler.run('bucket', 'profile/'):
+            pass
+
+
+def test_parse_html_empty():
+    """parse_html()のテスト."""
+    assert logic.parse_html(b'').xpath('//a') == []
+
+
+def test_page_ref_date():
+    """PageRef.dateのテスト."""
+    jst = logic.JST
+    assert logic.PageRef('calendar', ('2020', '3')).date == datetime(
+        2020, 3, 1, tzinfo=jst)
+    assert logic.PageRef('race_entry', ('20200322', '231', '11')).date == (
+        datetime(2020, 3, 22, tzinfo=jst))
+    assert logic.PageRef('horse', ('0000000001',)).date is None
+
+
+def test_freshness_policy_race_list():
+    """FreshnessPolicy.get_interval()のテスト."""
+    policy = logic.freshness_policy
+    uri = 'https://www.jbis.or.jp/race/calendar/20200322/231/'
+
+    def interval(*args):
+        return policy.get_interval(
+            uri, datetime(*args, tzinfo=timezone.utc))
+
+    # 前日まで (JSTで判定する)
+    assert interval(2020, 3, 21, 14, 59) == logic.DAILY
+    # 開催日
+    assert interval(2020, 3, 21, 15, 0) == logic.HOURLY
+    assert interval(2020, 3, 22, 14, 59) == logic.HOURLY
+    # 開催後1か月
+    assert interval(2020, 4, 21) == logic.DAILY
+    # 過去の月
+    assert interval(2020, 4, 22) is None
+
+
+def test_freshness_policy_race_result():
+    """FreshnessPolicy.is_fetch_target()とis_stale()のテスト."""
+    policy = logic.freshness_policy
+    nowtime = datetime(2020, 3, 22, tzinfo=timezone.utc)
+    recent = 'https://www.jbis.or.jp/race/result/20180323/231/11/'
+    old = 'https://www.jbis.or.jp/race/result/20180321/231/11/'
+
+    assert policy.is_fetch_target(recent, nowtime)
+    assert not policy.is_fetch_target(old, nowtime)
+    assert policy.is_stale(recent, None, nowtime)
+    assert not policy.is_stale(recent, datetime(2018, 3, 24), nowtime)
+    assert not policy.is_stale(old, None, nowtime)
+
+
+def test_freshness_policy_unknown():
+    """FreshnessPolicy.is_stale()のテスト."""
+    policy = logic.FreshnessPolicy({}, default=timedelta(hours=1))
+    nowtime = datetime(2020, 3, 22, 12, 0, 0)
+
+    assert policy.is_stale('http://host/', datetime(2020, 3, 22, 10), nowtime)
+    assert not policy.is_stale(
+        'http://host/', datetime(2020, 3, 22, 11, 30), nowtime)
 
 
 def test_get_fetcher_jbis_calendar():
@@ -177,6 +1712,38 @@ def test_get_jbis_calendar_fetcher_fetch_noobject():
                 'https://www.jbis.or.jp/b']
 
 
+def test_get_jbis_calendar_fetcher_fetch_async():
+    """JbisCalendarFetcher.fetch_async()のテスト."""
+    uri = 'https://www.jbis.or.jp/race/calendar/?year=2019&month=02'
+    content = (
+        b'<html><body><ul class="list-icon-01"><a href="/a" /></ul>' +
+        b'<ul class="list-icon-01"><a href="/b" /></ul></body></html>')
+    calls = []
+
+    class FakeIo(logic.AsyncIo):
+        def __init__(self):
+            pass
+
+        async def get_s3_object(self, bucket, key):
+            calls.append(('get_s3_object', bucket, key))
+            return None
+
+        async def fetch_to_s3(self, uri, bucket, key):
+            calls.append(('fetch_to_s3', uri, bucket, key))
+            return content
+
+        async def parse(self, func, *args):
+            return func(*args)
+
+    fetcher = logic.JbisCalendarFetcher(uri)
+    nowtime = datetime(2019, 12, 1, 13, 0, 0, tzinfo=timezone.utc)
+    uris = asyncio.run(fetcher.fetch_async('bucket', nowtime, FakeIo()))
+    assert calls == [
+        ('get_s3_object', 'bucket', 'jbis/race/calendar/2019/02'),
+        ('fetch_to_s3', uri, 'bucket', 'jbis/race/calendar/2019/02')]
+    assert uris == ['https://www.jbis.or.jp/a', 'https://www.jbis.or.jp/b']
+
+
 def test_get_jbis_calendar_fetcher_get_s3_key():
     """JbisCalendarFetcher.get_s3_key()のテスト."""
     fetcher = logic.JbisCalendarFetcher(
@@ -305,3 +1872,12 @@ def test_default_fetcher_fetch():
         logic.DefaultFetcher('abc').fetch(
             'bucket', datetime(2019, 12, 1, 12, 0, 0))
         m.warning.assert_called_once()
+
+
+def test_get_string():
+    """get_string()のテスト."""
+    document = logic.parse_html(
+        b'<table><tr><th><span>a</span></th><th>b<i>c</i></th><th></th>'
+        b'</tr></table>')
+    assert [logic.get_string(x) for x in document.xpath('//th')] == [
+        'a', None, None]
@@ -0,0 +1,110 @@
+"""プロファイルモードで保存した計測結果をFetcherのクラス毎に集計する.
+
+使い方:
+    python tools/aggregate_profiles.py BUCKET [--prefix profile/2020]
+        [--top 20] [--sort cumulative] [--output-dir DIR]
+
+S3のprefix以下にある起動毎の'{ラベル}.pstats'をラベル (Fetcherのクラス名、
+Fetcher以外の処理は'entry') 毎にまとめ、ラベル毎の合計時間と上位の関数を出力する。
+--output-dirを指定すると、まとめた結果をラベル毎のpstatsファイルとして保存する
+(snakevizやflameprofでフレームグラフとして見られる)。
+"""
+import argparse
+import os
+import posixpath
+import pstats
+import sys
+import tempfile
+
+import boto3
+
+
+def list_profile_keys(s3, bucket, prefix):
+    """保存済みの計測結果のキーを取得する.
+
+    Arguments:
+        s3 {S3.Client} -- S3クライアント
+        bucket {str} -- バケット名
+        prefix {str} -- キーのプレフィックス
+
+    Returns:
+        generator(str) -- '.pstats'で終わるキー
+    """
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for x in page.get('Contents', []):
+            if x['Key'].endswith('.pstats'):
+                yield x['Key']
+
+
+def download_profiles(s3, bucket, keys, directory):
+    """計測結果をダウンロードしてラベル毎に分ける.
+
+    Arguments:
+        s3 {S3.Client} -- S3クライアント
+        bucket {str} -- バケット名
+        keys {iterable(str)} -- キー
+        directory {str} -- ダウンロード先ディレクトリ
+
+    Returns:
+        dict -- ラベルとダウンロードしたファイルパスのリスト
+    """
+    labels = {}
+    for (i, key) in enumerate(keys):
+        label = posixpath.basename(key)[:-len('.pstats')]
+        path = os.path.join(directory, f'{i}.pstats')
+        s3.download_file(bucket, key, path)
+        labels.setdefault(label, []).append(path)
+    return labels
+
+
+def aggregate(labels):
+    """ラベル毎に計測結果をまとめる.
+
+    Arguments:
+        labels {dict} -- ラベルとファイルパスのリスト
+
+    Returns:
+        dict -- ラベルとpstats.Stats。合計時間の長い順
+    """
+    result = {k: pstats.Stats(*v) for (k, v) in labels.items()}
+    return dict(sorted(
+        result.items(), key=lambda x: x[1].total_tt, reverse=True))
+
+
+def main(argv=None):
+    """エントリーポイント.
+
+    Arguments:
+        argv {list(str)} -- コマンドライン引数
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('bucket', help='計測結果を保存したバケット名')
+    parser.add_argument('--prefix', default='profile/', help='キーのプレフィックス')
+    parser.add_argument('--top', type=int, default=20, help='出力する関数の数')
+    parser.add_argument('--sort', default='cumulative', help='並べ替えの基準')
+    parser.add_argument('--output-dir', help='まとめた結果の保存先ディレクトリ')
+    args = parser.parse_args(argv)
+
+    s3 = boto3.client('s3')
+    with tempfile.TemporaryDirectory() as directory:
+        labels = download_profiles(
+            s3, args.bucket, list_profile_keys(s3, args.bucket, args.prefix),
+            directory)
+        results = aggregate(labels)
+
+    print('label\truns\ttotal_seconds')
+    for (label, stats) in results.items():
+        print(f'{label}\t{len(labels[label])}\t{stats.total_tt:.3f}')
+
+    for (label, stats) in results.items():
+        print(f'\n# {label}')
+        stats.stream = sys.stdout
+        stats.sort_stats(args.sort).print_stats(args.top)
+        if args.output_dir:
+            os.makedirs(args.output_dir, exist_ok=True)
+            stats.dump_stats(os.path.join(args.output_dir, f'{label}.pstats'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,552 @@
+"""負荷試験用のJBISの代役HTTPサーバー.
+
+使い方:
+    python tools/jbis_standin.py [--port 8080] [--today 2020-03-19]
+        [--latency lognormal:-2.3,0.5] [--error-rate 0.01]
+        [--rate-limit 20] [--recorded DIR]
+
+JBISと同じパスで、合成したページ (または記録したページ) を返す。
+- カレンダー: /race/calendar/?year=YYYY&month=MM (土日を開催日にする)
+- レース一覧: /race/calendar/YYYYMMDD/CCC/
+    --today より前は結果の形式、以降は出馬表の形式。出馬表の一部
+    (--stakes-ratio) は重賞のみの形式 (3列目が'芝ダ') にする。
+- レース結果: /race/result/YYYYMMDD/CCC/RR/
+- 出走表: /race/YYYYMMDD/CCC/RR.html
+- 競走成績: /horse/NNNNNNNNNN/record/all/ (--record-rows 行)
+--recorded を指定すると、フェッチ済みのS3のキーと同じ相対パス
+(例: jbis/race/calendar/20200319/220) にファイルがあればそれを返す。
+応答時間の分布、エラーの注入、アクセス数の制限 (429) を設定できる。
+集計は /_stats でJSONとして返す。
+"""
+import argparse
+import calendar
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# 開催場コード
+COURSES = ['101', '105', '106', '108', '109', '220', '231', '232']
+
+PAGE_PATTERNS = [
+    ('race_list', re.compile(r'/race/calendar/(\d{8})/(\d{3})/')),
+    ('race_result', re.compile(r'/race/result/(\d{8})/(\d{3})/(\d{2})/')),
+    ('race_entry', re.compile(r'/race/(\d{8})/(\d{3})/(\d{2})\.html')),
+    ('horse_record', re.compile(r'/horse/(\d{10})/record/all/')),
+]
+
+PAGE_HEAD = (
+    '<html><head><meta http-equiv="Content-Type" '
+    'content="text/html; charset=Shift_JIS"><title>{}</title></head><body>')
+PAGE_TAIL = '</body></html>'
+
+
+def parse_latency(spec):
+    """応答時間の分布の指定から乱数生成関数を作る.
+
+    Arguments:
+        spec {str} -- 'fixed:秒'、'uniform:最小,最大'、'exp:平均'、
+            'lognormal:mu,sigma' のいずれか
+
+    Returns:
+        callable -- random.Randomを受け取って秒数を返す関数
+    """
+    (kind, _, args) = spec.partition(':')
+    values = [float(x) for x in args.split(',') if x]
+    if kind == 'fixed':
+        return lambda r: values[0]
+    if kind == 'uniform':
+        return lambda r: r.uniform(values[0], values[1])
+    if kind == 'exp':
+        return lambda r: r.expovariate(1 / values[0])
+    if kind == 'lognormal':
+        return lambda r: r.lognormvariate(values[0], values[1])
+    raise ValueError(f'unknown latency distribution: {spec}')
+
+
+def stable_int(*values):
+    """値の組から決まった整数を求める (起動毎に変わらない).
+
+    Arguments:
+        values {list} -- 値
+
+    Returns:
+        int -- 整数
+    """
+    digest = hashlib.sha256(
+        '/'.join(str(x) for x in values).encode()).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+class JbisSite:
+    """合成したJBISのページを生成するクラス."""
+
+    def __init__(
+            self, today, courses=3, races=12, runners=14, horses=5000,
+            record_rows=30, stakes_ratio=0.1):
+        """コンストラクタ.
+
+        Arguments:
+            today {date} -- 今日 (これより前のレースは結果が出ている)
+            courses {int} -- 1開催日あたりの開催場数
+            races {int} -- 1開催場あたりのレース数
+            runners {int} -- 1レースあたりの出走頭数
+            horses {int} -- 競走馬の数 (出走馬はこの中から選ぶ)
+            record_rows {int} -- 競走成績の行数
+            stakes_ratio {float} -- 重賞のみの出馬表にする割合
+        """
+        self.today = today
+        self.courses = courses
+        self.races = races
+        self.runners = runners
+        self.horses = horses
+        self.record_rows = record_rows
+        self.stakes_ratio = stakes_ratio
+
+    def render(self, path, query):
+        """ページを生成する.
+
+        Arguments:
+            path {str} -- パス
+            query {dict} -- クエリパラメーター (parse_qsの形式)
+
+        Returns:
+            tuple(str, str) -- ページ種類とHTML。該当するページが無ければNone
+        """
+        if path == '/race/calendar/':
+            try:
+                year = int(query['year'][0])
+                month = int(query['month'][0])
+            except (KeyError, ValueError):
+                return None
+            return ('calendar', self.calendar(year, month))
+
+        for (page_type, pattern) in PAGE_PATTERNS:
+            m = pattern.fullmatch(path)
+            if m:
+                try:
+                    return (page_type, getattr(self, page_type)(*m.groups()))
+                except ValueError:
+                    return None
+
+        return None
+
+    def race_days(self, year, month):
+        """月の開催日を取得する.
+
+        Arguments:
+            year {int} -- 年
+            month {int} -- 月
+
+        Returns:
+            list(date) -- 開催日 (土日)
+        """
+        days = calendar.monthrange(year, month)[1]
+        return [
+            date(year, month, d) for d in range(1, days + 1)
+            if date(year, month, d).weekday() >= 5]
+
+    def race_courses(self, day):
+        """開催日の開催場を取得する.
+
+        Arguments:
+            day {date} -- 開催日
+
+        Returns:
+            list(str) -- 開催場コード
+        """
+        start = stable_int(day) % len(COURSES)
+        return [COURSES[(start + i) % len(COURSES)]
+                for i in range(self.courses)]
+
+    def horse_ids(self, day, course, race):
+        """レースの出走馬のIDを取得する.
+
+        Arguments:
+            day {str} -- 開催日 (YYYYMMDD)
+            course {str} -- 開催場コード
+            race {int} -- レース番号
+
+        Returns:
+            list(str) -- 競走馬ID
+        """
+        return [
+            f'{stable_int(day, course, race, i) % self.horses + 1:010}'
+            for i in range(self.runners)]
+
+    def calendar(self, year, month):
+        """カレンダーのページ."""
+        items = ''.join(
+            f'<li><a href="/race/calendar/{d:%Y%m%d}/{c}/">'
+            f'{d.day}日 {c}</a></li>'
+            for d in self.race_days(year, month)
+            for c in self.race_courses(d))
+        return (
+            PAGE_HEAD.format(f'{year}年{month}月') +
+            f'<ul class="list-icon-01">{items}</ul>' + PAGE_TAIL)
+
+    def race_list(self, day, course):
+        """レース一覧のページ.
+
+        結果の形式、出馬表の形式 (4列目が'芝ダ')、重賞のみの出馬表の形式
+        (3列目が'芝ダ') のいずれか。
+        """
+        race_day = datetime.strptime(day, '%Y%m%d').date()
+        if race_day < self.today:
+            headers = ['R', 'レース名', '距離', '馬場', '頭数', '勝馬']
+            rows = [
+                f'<tr><th>{r}</th><td><a href="/race/result/{day}/{course}/'
+                f'{r:02}/">レース{r}</a></td><td>芝1600m</td><td>良</td>'
+                f'<td>{self.runners}</td><td>馬</td></tr>'
+                for r in range(1, self.races + 1)]
+        elif stable_int(day, course) % 1000 < self.stakes_ratio * 1000:
+            headers = ['R', 'レース名', '芝ダ', '距離', '頭数', '格']
+            rows = [
+                f'<tr><th>-</th><td>重賞{r}</td><td>芝</td><td>2000m</td>'
+                f'<td>{self.runners}</td><td>G3</td></tr>'
+                for r in range(1, 3)]
+        else:
+            headers = ['R', '発走時刻', 'レース名', '芝ダ', '距離', '頭数']
+            rows = [
+                f'<tr><th>{r}</th><td>{9 + r}:00</td><td><a href="/race/'
+                f'{day}/{course}/{r:02}.html">レース{r}</a></td><td>ダ</td>'
+                f'<td>1200m</td><td>{self.runners}</td></tr>'
+                for r in range(1, self.races + 1)]
+        return self.table(f'{day} {course}', headers, rows)
+
+    def race_result(self, day, course, race):
+        """レース結果のページ."""
+        headers = ['着', '枠', '馬番', '馬名', '性齢', 'タイム']
+        rows = [
+            f'<tr><td>{i + 1}</td><td>{i // 2 + 1}</td><td>{i + 1}</td>'
+            f'<td><a href="/horse/{x}/">馬{x}</a></td><td>牡3</td>'
+            f'<td>1:35.{i:01}</td></tr>'
+            for (i, x) in enumerate(self.horse_ids(day, course, int(race)))]
+        return self.table(f'{day} {course} {race}R', headers, rows)
+
+    def race_entry(self, day, course, race):
+        """出走表のページ."""
+        headers = ['枠', '馬番', '馬名', '性齢', '斤量', '騎手']
+        rows = [
+            f'<tr><td>{i // 2 + 1}</td><td>{i + 1}</td>'
+            f'<td><a href="/horse/{x}/">馬{x}</a></td><td>牡3</td>'
+            f'<td>56.0</td><td>騎手</td></tr>'
+            for (i, x) in enumerate(self.horse_ids(day, course, int(race)))]
+        return self.table(f'{day} {course} {race}R', headers, rows)
+
+    def horse_record(self, horse_id):
+        """競走成績のページ (--record-rows 行)."""
+        headers = ['年月日', '開催', 'レース名', '着順', '騎手', 'タイム']
+        start = self.today - timedelta(days=stable_int(horse_id) % 30)
+        rows = [
+            f'<tr><th class="sort-02">'
+            f'{start - timedelta(days=14 * i):%Y/%m/%d}</th>'
+            f'<td>{COURSES[i % len(COURSES)]}</td><td>レース</td>'
+            f'<td>{i % 18 + 1}</td><td>騎手</td><td>1:35.0</td></tr>'
+            for i in range(self.record_rows)]
+        return self.table(f'馬{horse_id}', headers, rows)
+
+    def table(self, title, headers, rows):
+        """データ表のページ."""
+        head = ''.join(f'<th>{x}</th>' for x in headers)
+        return (
+            PAGE_HEAD.format(title) +
+            f'<table class="tbl-data-04"><thead><tr>{head}</tr></thead>'
+            f'<tbody>{"".join(rows)}</tbody></table>' + PAGE_TAIL)
+
+
+class TokenBucket:
+    """秒間のアクセス数を制限するトークンバケット."""
+
+    def __init__(self, rate, burst=None):
+        """コンストラクタ.
+
+        Arguments:
+            rate {float} -- 秒間のアクセス数 (0なら制限しない)
+            burst {int} -- 連続で受け付けるアクセス数 (省略時はrate)
+        """
+        self.rate = rate
+        self.burst = burst or max(1, math.ceil(rate))
+        self._tokens = self.burst
+        self._time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """アクセスを受け付けるならTrueを返す."""
+        if not self.rate:
+            return True
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._time) * self.rate)
+            self._time = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class StandinServer(ThreadingHTTPServer):
+    """JBISの代役HTTPサーバー."""
+
+    daemon_threads = True
+
+    def __init__(
+            self, address, site, latency='fixed:0', error_rate=0,
+            error_status=503, rate_limit=0, recorded=None, seed=None):
+        """コンストラクタ.
+
+        Arguments:
+            address {tuple} -- 待ち受けるアドレスとポート
+            site {JbisSite} -- ページの生成元
+            latency {str} -- 応答時間の分布 (parse_latency()参照)
+            error_rate {float} -- エラーを返す割合
+            error_status {int} -- 注入するエラーのステータスコード
+            rate_limit {float} -- 秒間のアクセス数の上限 (超えたら429)
+            recorded {str} -- 記録したページのディレクトリ
+            seed {int} -- 乱数の種
+        """
+        super().__init__(address, StandinHandler)
+        self.site = site
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.bucket = TokenBucket(rate_limit)
+        self.recorded = recorded
+        self.random = random.Random(seed)
+        self.stats = Counter()
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    @property
+    def base_uri(self):
+        """サーバーのURI."""
+        (host, port) = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def count(self, page_type, status, seconds=None):
+        """アクセスを集計する.
+
+        Arguments:
+            page_type {str} -- ページ種類
+            status {int} -- ステータスコード
+            seconds {float} -- 応答までの秒数
+        """
+        with self._lock:
+            self.stats[f'{page_type}/{status}'] += 1
+            if seconds is not None:
+                self.latencies.append(seconds)
+
+    def sample(self):
+        """応答時間とエラーの有無を決める.
+
+        Returns:
+            tuple(float, bool) -- 応答までの秒数とエラーにするかどうか
+        """
+        with self._lock:
+            return (
+                max(0, self.latency(self.random)),
+                self.random.random() < self.error_rate)
+
+    def get_stats(self):
+        """集計を取得する.
+
+        Returns:
+            dict -- ページ種類/ステータス毎のアクセス数と応答時間の分位点
+        """
+        with self._lock:
+            latencies = sorted(self.latencies)
+            stats = dict(self.stats)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+        return {
+            'requests': stats,
+            'latency': {
+                'p50': percentile(0.5), 'p90': percentile(0.9),
+                'p99': percentile(0.99)}}
+
+    def handle_error(self, request, client_address):
+        """クライアントが接続を切った場合はトレースバックを出力しない."""
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def load_recorded(self, path, query):
+        """記録したページを読み込む.
+
+        Arguments:
+            path {str} -- パス
+            query {dict} -- クエリパラメーター
+
+        Returns:
+            bytes -- ページの内容。記録が無ければNone
+        """
+        if self.recorded is None:
+            return None
+
+        if path == '/race/calendar/' and 'year' in query and 'month' in query:
+            name = f'jbis{path}{query["year"][0]}/{query["month"][0]}'
+        else:
+            name = f'jbis{path}'.rstrip('/')
+        directory = os.path.abspath(self.recorded)
+        file_path = os.path.abspath(os.path.join(directory, name))
+        if not file_path.startswith(directory + os.sep):
+            return None
+        try:
+            with open(file_path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """JBISの代役のリクエストハンドラー."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """GETリクエストを処理する."""
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        if parsed.path == '/_stats':
+            self.send_body(200, json.dumps(self.server.get_stats()).encode())
+            return
+
+        start = time.monotonic()
+        if not self.server.bucket.take():
+            self.server.count('throttled', 429)
+            self.send_body(429, b'Too Many Requests', {'Retry-After': '1'})
+            return
+
+        (latency, error) = self.server.sample()
+        time.sleep(latency)
+        content = self.server.load_recorded(parsed.path, query)
+        if content is not None:
+            page_type = 'recorded'
+        else:
+            page = self.server.site.render(parsed.path, query)
+            (page_type, html) = page if page is not None else ('unknown', '')
+            content = html.encode('shift_jis') if page is not None else None
+
+        if error:
+            status = self.server.error_status
+            content = b'Service Unavailable'
+        elif content is None:
+            status = 404
+            content = b'Not Found'
+        else:
+            status = 200
+        self.server.count(page_type, status, time.monotonic() - start)
+        self.send_body(status, content)
+
+    def send_body(self, status, content, headers=None):
+        """応答を返す.
+
+        Arguments:
+            status {int} -- ステータスコード
+            content {bytes} -- 本文
+            headers {dict} -- 追加のヘッダー
+        """
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=Shift_JIS')
+        self.send_header('Content-Length', str(len(content)))
+        for (name, value) in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        """アクセスログは出力しない (集計は/_statsで見る)."""
+
+
+def add_arguments(parser):
+    """代役サーバーの設定をコマンドライン引数に追加する.
+
+    Arguments:
+        parser {ArgumentParser} -- 追加先
+    """
+    parser.add_argument(
+        '--today', type=date.fromisoformat,
+        help='この日より前のレースは結果を返す (省略時は今日)')
+    parser.add_argument('--courses', type=int, default=3, help='1日の開催場数')
+    parser.add_argument('--races', type=int, default=12, help='1開催場のレース数')
+    parser.add_argument('--runners', type=int, default=14, help='出走頭数')
+    parser.add_argument('--horses', type=int, default=5000, help='競走馬の数')
+    parser.add_argument(
+        '--record-rows', type=int, default=30, help='競走成績の行数')
+    parser.add_argument(
+        '--stakes-ratio', type=float, default=0.1,
+        help='重賞のみの出馬表にする割合')
+    parser.add_argument(
+        '--latency', default='fixed:0',
+        help='応答時間の分布 (fixed:秒, uniform:最小,最大, exp:平均, '
+        'lognormal:mu,sigma)')
+    parser.add_argument(
+        '--error-rate', type=float, default=0, help='エラーを返す割合')
+    parser.add_argument(
+        '--error-status', type=int, default=503, help='注入するエラーのステータス')
+    parser.add_argument(
+        '--rate-limit', type=float, default=0,
+        help='秒間のアクセス数の上限 (超えたら429)')
+    parser.add_argument('--recorded', help='記録したページのディレクトリ')
+    parser.add_argument('--seed', type=int, help='乱数の種')
+
+
+def make_server(args, host='127.0.0.1', port=0):
+    """コマンドライン引数から代役サーバーを作る.
+
+    Arguments:
+        args {Namespace} -- add_arguments()で追加した引数
+        host {str} -- 待ち受けるアドレス
+        port {int} -- 待ち受けるポート (0なら空いているポート)
+
+    Returns:
+        StandinServer -- 代役サーバー
+    """
+    site = JbisSite(
+        args.today or date.today(), courses=args.courses, races=args.races,
+        runners=args.runners, horses=args.horses,
+        record_rows=args.record_rows, stakes_ratio=args.stakes_ratio)
+    return StandinServer(
+        (host, port), site, latency=args.latency, error_rate=args.error_rate,
+        error_status=args.error_status, rate_limit=args.rate_limit,
+        recorded=args.recorded, seed=args.seed)
+
+
+def main(argv=None):
+    """エントリーポイント.
+
+    Arguments:
+        argv {list(str)} -- コマンドライン引数
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1', help='待ち受けるアドレス')
+    parser.add_argument('--port', type=int, default=8080, help='待ち受けるポート')
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    server = make_server(args, args.host, args.port)
+    print(f'serving on {server.base_uri}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
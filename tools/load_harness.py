@@ -0,0 +1,717 @@
+"""JBISの代役とS3・SQSの代役に対してmain_loopを動かす負荷試験ハーネス.
+
+使い方:
+    python tools/load_harness.py [--engine async] [--duration 60]
+        [--interval 0] [--max-in-flight 100] [--batch-size 20]
+        [--s3-latency 0.02] [--sqs-latency 0.02] [--rounds 2]
+        [jbis_standin.pyの引数 (--latency, --error-rate, --rate-limit など)]
+
+同じプロセスでjbis_standin.pyのサーバーを起動し、JBISへのアクセスをそこへ
+振り向ける。S3とSQSはメモリ上の代役に置き換える (boto3とaiobotocoreで
+使っている操作だけを持つ)。起動毎に処理したページ数・毎秒のページ数・
+S3/SQSの呼び出し回数・代役サーバーの応答の集計を出力し、並列数・アクセス間隔・
+バッチサイズを変えたときの頭打ちを確かめられるようにする。
+--rounds を2以上にすると同じ時刻の起動を繰り返し、保存済みページの再取得判定の
+負荷も測れる。
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import datetime, timezone
+from unittest import mock
+
+import aiohttp
+import boto3
+import requests
+from botocore.exceptions import ClientError
+
+import jbis_standin
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import logic  # noqa: E402
+
+JBIS_ORIGIN = 'https://www.jbis.or.jp'
+
+
+class LocalS3:
+    """S3の代役 (メモリ上に保存する).
+
+    クライアントの操作とリソースのBucket().objects.filter()を持つ。
+    呼び出し毎にlatency秒待つ。
+    """
+
+    def __init__(self, latency=0):
+        """コンストラクタ.
+
+        Arguments:
+            latency {float} -- 1回の呼び出しにかかる秒数
+        """
+        self.latency = latency
+        self.objects = {}
+        self.calls = Counter()
+        self._uploads = {}
+        self._lock = threading.Lock()
+
+    def _call(self, name):
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _store(self, bucket, key, body, e_tag):
+        with self._lock:
+            self.objects[(bucket, key)] = (
+                body, e_tag, datetime.now(timezone.utc))
+        return {'ETag': e_tag}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        """オブジェクトを保存する."""
+        self._call('put_object')
+        body = Body.read() if hasattr(Body, 'read') else bytes(Body)
+        return self._store(
+            Bucket, Key, body, f'"{hashlib.md5(body).hexdigest()}"')
+
+    def get_object(self, Bucket, Key, **kwargs):
+        """オブジェクトを取得する."""
+        self._call('get_object')
+        with self._lock:
+            if (Bucket, Key) not in self.objects:
+                raise ClientError(
+                    {'Error': {'Code': 'NoSuchKey', 'Message': Key}},
+                    'GetObject')
+            (body, e_tag, last_modified) = self.objects[(Bucket, Key)]
+        return {
+            'Body': io.BytesIO(body), 'ETag': e_tag,
+            'LastModified': last_modified, 'ContentLength': len(body)}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        """オブジェクトを削除する."""
+        self._call('delete_object')
+        with self._lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        """オブジェクトを列挙する (1000件を超えても1回で返す)."""
+        self._call('list_objects_v2')
+        with self._lock:
+            contents = [
+                {'Key': k, 'ETag': v[1], 'LastModified': v[2],
+                 'Size': len(v[0])}
+                for ((b, k), v) in self.objects.items()
+                if b == Bucket and k.startswith(Prefix)]
+        contents.sort(key=lambda x: x['Key'])
+        return {'Contents': contents, 'KeyCount': len(contents)}
+
+    def get_paginator(self, name):
+        """ページネーターを取得する (list_objects_v2のみ)."""
+        return LocalPaginator(getattr(self, name))
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        """マルチパートアップロードを開始する."""
+        self._call('create_multipart_upload')
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self._uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        """パートを送る."""
+        self._call('upload_part')
+        body = bytes(Body)
+        e_tag = f'"{hashlib.md5(body).hexdigest()}"'
+        with self._lock:
+            self._uploads[UploadId][PartNumber] = body
+        return {'ETag': e_tag}
+
+    def complete_multipart_upload(
+            self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        """マルチパートアップロードを完了する."""
+        self._call('complete_multipart_upload')
+        with self._lock:
+            parts = self._uploads.pop(UploadId)
+        numbers = [x['PartNumber'] for x in MultipartUpload['Parts']]
+        body = b''.join(parts[x] for x in numbers)
+        digest = hashlib.md5(b''.join(
+            hashlib.md5(parts[x]).digest() for x in numbers)).hexdigest()
+        return self._store(Bucket, Key, body, f'"{digest}-{len(numbers)}"')
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        """マルチパートアップロードを中止する."""
+        self._call('abort_multipart_upload')
+        with self._lock:
+            self._uploads.pop(UploadId, None)
+        return {}
+
+    def Bucket(self, name):
+        """リソースのバケットを取得する."""
+        return LocalBucket(self, name)
+
+
+class LocalPaginator:
+    """S3の代役のページネーター."""
+
+    def __init__(self, method):
+        """コンストラクタ.
+
+        Arguments:
+            method {callable} -- 列挙する操作
+        """
+        self._method = method
+
+    def paginate(self, **kwargs):
+        """全件を1ページとして返す."""
+        yield self._method(**kwargs)
+
+
+class LocalBucket:
+    """S3の代役のリソースのバケット."""
+
+    def __init__(self, s3, name):
+        """コンストラクタ.
+
+        Arguments:
+            s3 {LocalS3} -- S3の代役
+            name {str} -- バケット名
+        """
+        self.name = name
+        self.objects = self
+        self._s3 = s3
+
+    def filter(self, Prefix=''):
+        """オブジェクトの情報を列挙する."""
+        response = self._s3.list_objects_v2(Bucket=self.name, Prefix=Prefix)
+        return [LocalObjectSummary(self._s3, self.name, x)
+                for x in response['Contents']]
+
+
+class LocalObjectSummary:
+    """S3の代役のObjectSummary."""
+
+    def __init__(self, s3, bucket_name, content):
+        """コンストラクタ.
+
+        Arguments:
+            s3 {LocalS3} -- S3の代役
+            bucket_name {str} -- バケット名
+            content {dict} -- list_objects_v2のContentsの要素
+        """
+        self.bucket_name = bucket_name
+        self.key = content['Key']
+        self.e_tag = content['ETag']
+        self.last_modified = content['LastModified']
+        self._s3 = s3
+
+    def get(self):
+        """オブジェクトを取得する."""
+        return self._s3.get_object(Bucket=self.bucket_name, Key=self.key)
+
+
+class LocalSqs:
+    """SQSの代役 (メモリ上のキュー).
+
+    クライアントの操作とリソースのget_queue_by_name()を持つ。
+    呼び出し毎にlatency秒待つ。遅延配信と可視性タイムアウトを扱う。
+    """
+
+    def __init__(self, latency=0, visibility_timeout=30):
+        """コンストラクタ.
+
+        Arguments:
+            latency {float} -- 1回の呼び出しにかかる秒数
+            visibility_timeout {int} -- キューの可視性タイムアウト秒数
+        """
+        self.latency = latency
+        self.visibility_timeout = visibility_timeout
+        self.calls = Counter()
+        self.counts = Counter()
+        self._queues = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Condition()
+
+    def _call(self, name):
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def create_queue(self, name):
+        """キューを作る.
+
+        Arguments:
+            name {str} -- キュー名
+        """
+        with self._lock:
+            self._queues.setdefault(name, {})
+
+    def _get_queue(self, queue_url):
+        name = queue_url.rpartition('/')[2]
+        if name not in self._queues:
+            raise ClientError(
+                {'Error': {'Code': 'AWS.SimpleQueueService.NonExistentQueue',
+                           'Message': name}}, 'GetQueueUrl')
+        return (name, self._queues[name])
+
+    def get_queue_url(self, QueueName, **kwargs):
+        """キューのURLを取得する."""
+        self._call('get_queue_url')
+        with self._lock:
+            self._get_queue(QueueName)
+        return {'QueueUrl': f'local://sqs/{QueueName}'}
+
+    def send_message_batch(self, QueueUrl, Entries, **kwargs):
+        """メッセージをまとめて送る."""
+        self._call('send_message_batch')
+        now = time.monotonic()
+        with self._lock:
+            (name, queue) = self._get_queue(QueueUrl)
+            for x in Entries:
+                message_id = f'{next(self._ids):08}'
+                queue[message_id] = {
+                    'MessageId': message_id, 'Body': x['MessageBody'],
+                    'visible': now + x.get('DelaySeconds', 0),
+                    'delayed': x.get('DelaySeconds', 0) > 0, 'receipt': None}
+                self.counts[f'{name}/sent'] += 1
+            self._lock.notify_all()
+        return {'Successful': [{'Id': x['Id']} for x in Entries]}
+
+    def send_message(self, QueueUrl, MessageBody, DelaySeconds=0, **kwargs):
+        """メッセージを送る."""
+        return self.send_message_batch(QueueUrl, [
+            {'Id': '0', 'MessageBody': MessageBody,
+             'DelaySeconds': DelaySeconds}])
+
+    def _take(self, queue, count, visibility_timeout):
+        now = time.monotonic()
+        messages = []
+        for x in queue.values():
+            if len(messages) >= count:
+                break
+            if x['visible'] <= now:
+                x['visible'] = now + visibility_timeout
+                x['delayed'] = False
+                x['receipt'] = uuid.uuid4().hex
+                messages.append({
+                    'MessageId': x['MessageId'], 'Body': x['Body'],
+                    'ReceiptHandle': f'{x["MessageId"]}:{x["receipt"]}'})
+        return messages
+
+    def receive_message(
+            self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0,
+            VisibilityTimeout=None, **kwargs):
+        """メッセージを受信する (WaitTimeSeconds秒までロングポーリングする)."""
+        self._call('receive_message')
+        timeout = (
+            self.visibility_timeout if VisibilityTimeout is None
+            else VisibilityTimeout)
+        deadline = time.monotonic() + WaitTimeSeconds
+        with self._lock:
+            (name, queue) = self._get_queue(QueueUrl)
+            while True:
+                messages = self._take(queue, MaxNumberOfMessages, timeout)
+                remaining = deadline - time.monotonic()
+                if messages or remaining <= 0:
+                    break
+                # 遅延配信・可視性タイムアウト切れは通知されないので短い間隔で見直す
+                self._lock.wait(min(remaining, 0.1))
+            self.counts[f'{name}/received'] += len(messages)
+        return {'Messages': messages} if messages else {}
+
+    def _find(self, QueueUrl, ReceiptHandle):
+        (name, queue) = self._get_queue(QueueUrl)
+        (message_id, _, receipt) = ReceiptHandle.partition(':')
+        message = queue.get(message_id)
+        if message is None or message['receipt'] != receipt:
+            return (name, None)
+        return (name, message)
+
+    def delete_message(self, QueueUrl, ReceiptHandle, **kwargs):
+        """メッセージを削除する."""
+        self._call('delete_message')
+        with self._lock:
+            (name, message) = self._find(QueueUrl, ReceiptHandle)
+            if message is not None:
+                del self._queues[name][message['MessageId']]
+                self.counts[f'{name}/deleted'] += 1
+        return {}
+
+    def change_message_visibility(
+            self, QueueUrl, ReceiptHandle, VisibilityTimeout, **kwargs):
+        """メッセージの可視性タイムアウトを変更する."""
+        self._call('change_message_visibility')
+        with self._lock:
+            (_, message) = self._find(QueueUrl, ReceiptHandle)
+            if message is not None:
+                message['visible'] = time.monotonic() + VisibilityTimeout
+            self._lock.notify_all()
+        return {}
+
+    def get_queue_attributes(self, QueueUrl, **kwargs):
+        """キューのおおよそのメッセージ数を取得する."""
+        self._call('get_queue_attributes')
+        now = time.monotonic()
+        with self._lock:
+            (_, queue) = self._get_queue(QueueUrl)
+            visible = sum(1 for x in queue.values() if x['visible'] <= now)
+            delayed = sum(
+                1 for x in queue.values()
+                if x['visible'] > now and x['delayed'])
+        return {'Attributes': {
+            'ApproximateNumberOfMessages': str(visible),
+            'ApproximateNumberOfMessagesNotVisible': str(
+                len(queue) - visible - delayed),
+            'ApproximateNumberOfMessagesDelayed': str(delayed)}}
+
+    def get_queue_by_name(self, QueueName):
+        """リソースのキューを取得する."""
+        return LocalQueue(
+            self, self.get_queue_url(QueueName=QueueName)['QueueUrl'])
+
+
+class LocalQueue:
+    """SQSの代役のリソースのキュー."""
+
+    def __init__(self, sqs, url):
+        """コンストラクタ.
+
+        Arguments:
+            sqs {LocalSqs} -- SQSの代役
+            url {str} -- キューのURL
+        """
+        self.url = url
+        self._sqs = sqs
+
+    @property
+    def attributes(self):
+        """キューの属性."""
+        return self._sqs.get_queue_attributes(QueueUrl=self.url)['Attributes']
+
+    def receive_messages(self, **kwargs):
+        """メッセージを受信する."""
+        response = self._sqs.receive_message(QueueUrl=self.url, **kwargs)
+        return [LocalMessage(self._sqs, self.url, x)
+                for x in response.get('Messages', [])]
+
+    def send_messages(self, Entries):
+        """メッセージをまとめて送る."""
+        return self._sqs.send_message_batch(QueueUrl=self.url, Entries=Entries)
+
+    def send_message(self, **kwargs):
+        """メッセージを送る."""
+        return self._sqs.send_message(QueueUrl=self.url, **kwargs)
+
+
+class LocalMessage:
+    """SQSの代役のリソースのメッセージ."""
+
+    def __init__(self, sqs, queue_url, message):
+        """コンストラクタ.
+
+        Arguments:
+            sqs {LocalSqs} -- SQSの代役
+            queue_url {str} -- キューのURL
+            message {dict} -- receive_messageのMessagesの要素
+        """
+        self.queue_url = queue_url
+        self.message_id = message['MessageId']
+        self.body = message['Body']
+        self.receipt_handle = message['ReceiptHandle']
+        self._sqs = sqs
+
+    def delete(self):
+        """メッセージを削除する."""
+        return self._sqs.delete_message(
+            QueueUrl=self.queue_url, ReceiptHandle=self.receipt_handle)
+
+    def change_visibility(self, VisibilityTimeout):
+        """メッセージの可視性タイムアウトを変更する."""
+        return self._sqs.change_message_visibility(
+            QueueUrl=self.queue_url, ReceiptHandle=self.receipt_handle,
+            VisibilityTimeout=VisibilityTimeout)
+
+
+class AsyncBody:
+    """aiobotocoreのget_objectのBodyの代役."""
+
+    def __init__(self, body):
+        """コンストラクタ.
+
+        Arguments:
+            body {io.BytesIO} -- 本文
+        """
+        self._body = body
+
+    async def __aenter__(self):
+        """ストリームを開く."""
+        return self
+
+    async def __aexit__(self, *exc_info):
+        """ストリームを閉じる."""
+
+    async def read(self):
+        """本文を読む."""
+        return self._body.read()
+
+
+class AsyncClient:
+    """代役の操作をaiobotocoreのクライアントとして呼べるようにするクラス.
+
+    操作は共有のexecutorのスレッドで実行する (aiobotocoreの接続プールに相当)。
+    """
+
+    def __init__(self, target, executor):
+        """コンストラクタ.
+
+        Arguments:
+            target {object} -- S3またはSQSの代役
+            executor {Executor} -- 操作の実行先
+        """
+        self._target = target
+        self._executor = executor
+
+    async def __aenter__(self):
+        """クライアントを開く."""
+        return self
+
+    async def __aexit__(self, *exc_info):
+        """クライアントを閉じる."""
+
+    def __getattr__(self, name):
+        """操作を非同期の関数として返す."""
+        method = getattr(self._target, name)
+
+        async def call(**kwargs):
+            loop = asyncio.get_event_loop()
+            response = await loop.run_in_executor(
+                self._executor, lambda: method(**kwargs))
+            if 'Body' in response:
+                response = dict(response, Body=AsyncBody(response['Body']))
+            return response
+
+        return call
+
+
+class LocalSession:
+    """aiobotocoreのセッションの代役."""
+
+    def __init__(self, clients, pool):
+        """コンストラクタ.
+
+        Arguments:
+            clients {dict} -- サービス名と代役
+            pool {int} -- 同時に実行する操作の数
+        """
+        self._clients = clients
+        self._executor = ThreadPoolExecutor(pool)
+
+    def create_client(self, name, **kwargs):
+        """クライアントを作る."""
+        return AsyncClient(self._clients[name], self._executor)
+
+
+def rewrite_uri(uri, base_uri):
+    """JBISのURIを代役サーバーのURIに置き換える.
+
+    Arguments:
+        uri {str} -- URI
+        base_uri {str} -- 代役サーバーのURI
+
+    Returns:
+        str -- 置き換えたURI
+    """
+    if uri.startswith(JBIS_ORIGIN):
+        return base_uri + uri[len(JBIS_ORIGIN):]
+    return uri
+
+
+class RewritingSession:
+    """アクセス先を代役サーバーに振り向けるaiohttpのセッション."""
+
+    def __init__(self, session, base_uri):
+        """コンストラクタ.
+
+        Arguments:
+            session {aiohttp.ClientSession} -- 元のセッション
+            base_uri {str} -- 代役サーバーのURI
+        """
+        self._session = session
+        self._base_uri = base_uri
+
+    async def __aenter__(self):
+        """セッションを開く."""
+        await self._session.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        """セッションを閉じる."""
+        await self._session.__aexit__(*exc_info)
+
+    def get(self, uri, **kwargs):
+        """GETリクエストを送る."""
+        return self._session.get(rewrite_uri(uri, self._base_uri), **kwargs)
+
+
+def stand_in(stack, base_uri, s3, sqs, pool):
+    """boto3・aiobotocore・HTTPアクセスを代役に置き換える.
+
+    Arguments:
+        stack {ExitStack} -- 置き換えを戻す処理の登録先
+        base_uri {str} -- 代役サーバーのURI
+        s3 {LocalS3} -- S3の代役
+        sqs {LocalSqs} -- SQSの代役
+        pool {int} -- 非同期エンジンで同時に実行するS3・SQSの操作の数
+    """
+    clients = {'s3': s3, 'sqs': sqs}
+    get = requests.get
+    client_session = aiohttp.ClientSession
+
+    def http_get(uri, **kwargs):
+        return get(rewrite_uri(uri, base_uri), **kwargs)
+
+    def get_service(name, *args, **kwargs):
+        return clients[name]
+
+    stack.enter_context(mock.patch.object(boto3, 'resource', get_service))
+    stack.enter_context(mock.patch.object(boto3, 'client', get_service))
+    stack.enter_context(mock.patch.object(requests, 'get', http_get))
+    stack.enter_context(mock.patch.object(
+        logic, 'get_session', lambda: LocalSession(clients, pool)))
+    stack.enter_context(mock.patch.object(
+        logic.aiohttp, 'ClientSession',
+        lambda *args, **kwargs: RewritingSession(
+            client_session(*args, **kwargs), base_uri)))
+
+
+def run_round(args, nowtime, s3, sqs):
+    """main_loopを1回動かす.
+
+    Arguments:
+        args {Namespace} -- コマンドライン引数
+        nowtime {datetime} -- 開始時刻
+        s3 {LocalS3} -- S3の代役
+        sqs {LocalSqs} -- SQSの代役
+
+    Returns:
+        dict -- 経過秒数・保存したページ数・毎秒のページ数
+    """
+    # 起動毎にアクセス間隔と上流サイトの状態を初期化する (Lambdaの起動に相当)
+    logic.rate_limiter = logic.IntervalRateLimiter(args.interval)
+    logic.upstream_health = logic.UpstreamHealth(
+        max_concurrency=args.max_concurrency)
+    options = {}
+    if args.engine == 'async':
+        options['max_in_flight'] = args.max_in_flight
+
+    puts = s3.calls['put_object'] + s3.calls['complete_multipart_upload']
+    start = time.monotonic()
+    logic.entry(
+        args.queue, args.bucket, nowtime, engine=args.engine,
+        days_back=args.days_back, days_forward=args.days_forward,
+        dead_letter_queue_name=f'{args.queue}-dlq', journal=args.journal,
+        **options)
+    elapsed = time.monotonic() - start
+    pages = (
+        s3.calls['put_object'] + s3.calls['complete_multipart_upload'] - puts)
+    return {
+        'seconds': round(elapsed, 3), 'pages': pages,
+        'pages_per_second': round(pages / elapsed, 2) if elapsed else None,
+        'circuit_open': logic.upstream_health.is_open}
+
+
+def main(argv=None):
+    """エントリーポイント.
+
+    Arguments:
+        argv {list(str)} -- コマンドライン引数
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--engine', choices=['sync', 'async'], default='sync',
+        help='実行エンジン')
+    parser.add_argument(
+        '--duration', type=float, default=60, help='1回の起動の処理時間秒数')
+    parser.add_argument(
+        '--drain', type=float, default=10, help='非同期エンジンの終了待ち秒数')
+    parser.add_argument(
+        '--rounds', type=int, default=1, help='起動を繰り返す回数')
+    parser.add_argument(
+        '--interval', type=float, default=0, help='JBISへのアクセス間隔秒数')
+    parser.add_argument(
+        '--max-concurrency', type=int, default=8, help='JBISへの並列数の上限')
+    parser.add_argument(
+        '--max-in-flight', type=int, default=100,
+        help='非同期エンジンで同時に処理するメッセージ数の上限')
+    parser.add_argument(
+        '--batch-size', type=int, default=logic.MAX_TASKS_PER_MESSAGE,
+        help='1メッセージあたりのタスク数の上限')
+    parser.add_argument(
+        '--retry-base', type=float, default=logic.RETRY_BASE_SECONDS,
+        help='再試行の遅延の基準秒数')
+    parser.add_argument(
+        '--days-back', type=int, default=7, help='カレンダー取得範囲 (過去方向の日数)')
+    parser.add_argument(
+        '--days-forward', type=int, default=7,
+        help='カレンダー取得範囲 (未来方向の日数)')
+    parser.add_argument(
+        '--s3-latency', type=float, default=0, help='S3の呼び出し毎の秒数')
+    parser.add_argument(
+        '--sqs-latency', type=float, default=0, help='SQSの呼び出し毎の秒数')
+    parser.add_argument(
+        '--aws-pool', type=int, default=10,
+        help='非同期エンジンで同時に実行するS3・SQSの操作の数')
+    parser.add_argument(
+        '--journal', action='store_true',
+        help='クロールジャーナルを記録する (ローカルの一時ファイルはJOURNAL_DIR)')
+    parser.add_argument('--queue', default='load-queue', help='キュー名')
+    parser.add_argument('--bucket', default='load-bucket', help='バケット名')
+    jbis_standin.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    nowtime = datetime.now(timezone.utc)
+    args.today = args.today or nowtime.astimezone(logic.JST).date()
+    server = jbis_standin.make_server(args)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    s3 = LocalS3(args.s3_latency)
+    sqs = LocalSqs(args.sqs_latency)
+    sqs.create_queue(args.queue)
+    sqs.create_queue(f'{args.queue}-dlq')
+
+    rounds = []
+    with ExitStack() as stack:
+        stand_in(stack, server.base_uri, s3, sqs, args.aws_pool)
+        for (name, value) in [
+                ('RUN_SECONDS', args.duration),
+                ('DRAIN_SECONDS', args.drain),
+                ('MAX_TASKS_PER_MESSAGE', args.batch_size),
+                ('RETRY_BASE_SECONDS', args.retry_base)]:
+            stack.enter_context(mock.patch.object(logic, name, value))
+
+        for i in range(args.rounds):
+            # 2回目以降の起動の開始時刻は処理時間の判定に合わせて実時刻にする
+            start = nowtime if i == 0 else datetime.now(timezone.utc)
+            rounds.append(run_round(args, start, s3, sqs))
+
+    server.shutdown()
+    server.server_close()
+    print(json.dumps({
+        'rounds': rounds,
+        's3': {'objects': len(s3.objects), 'calls': dict(s3.calls)},
+        'sqs': {'messages': dict(sqs.counts), 'calls': dict(sqs.calls)},
+        'standin': server.get_stats()}, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()